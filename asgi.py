@@ -0,0 +1,567 @@
+"""
+Async (ASGI) serving mode for the Love Box server.
+
+  uvicorn asgi:app --host 0.0.0.0 --port 5000
+  gunicorn -k uvicorn.workers.UvicornWorker --workers 4 asgi:app
+
+The device API (/api/*) runs on the event loop: a box parked in a long-poll
+(/api/check?wait=N) or on /api/stream is a suspended coroutine instead of a
+worker thread, so one process can hold tens of thousands of idle boxes.
+The same goes for the web UI's status stream (/status?stream=1) once the
+session is logged in. Store and SQLite work still goes through server.py's
+helpers, on a small thread pool, so the JSON every route returns is the
+Flask app's, byte for byte. Everything else (web UI, /status polls,
+/metrics, /health) is handed to the Flask app through a WSGI bridge on its
+own thread pool.
+"""
+import asyncio
+import io
+import json
+import math
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+from flask import session
+from werkzeug.http import parse_etags
+
+import server
+from server import app as flask_app, box_events, metrics
+
+# =========================
+# CONFIG (from Environment)
+# =========================
+ASGI_DB_THREADS   = int(os.environ.get("ASGI_DB_THREADS", str(server.DB_POOL_SIZE)))  # threads running store/SQLite calls
+ASGI_WSGI_THREADS = int(os.environ.get("ASGI_WSGI_THREADS", "16"))  # threads running the Flask app (web UI)
+
+db_executor = ThreadPoolExecutor(ASGI_DB_THREADS, thread_name_prefix="lovebox-db")
+wsgi_executor = ThreadPoolExecutor(ASGI_WSGI_THREADS, thread_name_prefix="lovebox-wsgi")
+
+SSE_HEADERS = [
+    (b"content-type", b"text/event-stream; charset=utf-8"),
+    (b"cache-control", b"no-cache"),
+    (b"x-accel-buffering", b"no"),
+]
+
+
+# =========================
+# Requests / replies
+# =========================
+def query_args(scope) -> dict:
+    args = {}
+    for k, v in parse_qsl(scope["query_string"].decode("latin-1"), keep_blank_values=True):
+        args.setdefault(k, v)  # first value wins, like request.args.get
+    return args
+
+
+class Request:
+    """One /api/* request: parsed query and headers, the body, and client-disconnect tracking."""
+
+    def __init__(self, scope, receive):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.args = query_args(scope)
+        self.headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]}
+        self.body = b""
+        self.disconnected = asyncio.Event()
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+        self._receive = receive
+        self._watcher = None
+
+    async def read_body(self):
+        chunks = []
+        while True:
+            message = await self._receive()
+            if message["type"] == "http.disconnect":
+                self.disconnected.set()
+                break
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+        self.body = b"".join(chunks)
+
+    def json(self) -> dict:
+        """The body as a JSON object, or {} (request.get_json(force=True, silent=True) or {})."""
+        try:
+            data = json.loads(self.body)
+        except ValueError:
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def watch_disconnect(self) -> asyncio.Task:
+        """Task that finishes when the client goes away (started on first wait)."""
+        if self._watcher is None:
+            self._watcher = asyncio.ensure_future(self._watch())
+        return self._watcher
+
+    async def _watch(self):
+        while not self.disconnected.is_set():
+            if (await self._receive())["type"] == "http.disconnect":
+                self.disconnected.set()
+
+    def close(self):
+        if self._watcher is not None and not self._watcher.done():
+            self._watcher.cancel()
+
+
+class Reply:
+    """Response for an API route: a complete body, or an async iterator of str chunks (stream)."""
+
+    def __init__(self, status: int = 200, body: bytes = b"", headers: list = None, stream=None):
+        self.status = status
+        self.body = body
+        self.headers = headers or []
+        self.stream = stream
+
+
+def json_reply(payload: dict, status: int = 200, etag: str = None) -> Reply:
+    """Same bytes and headers as jsonify()."""
+    body = (flask_app.json.dumps(payload, indent=None, separators=(",", ":")) + "\n").encode()
+    headers = [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+    if etag is not None:
+        headers.append((b"etag", f'"{etag}"'.encode()))
+    return Reply(status, body, headers)
+
+
+def not_modified(version: int) -> Reply:
+    return Reply(304, headers=[(b"etag", f'"{version}"'.encode())])
+
+
+def versioned(payload: dict, version: int) -> Reply:
+    return json_reply({**payload, "version": version}, etag=str(version))
+
+
+def client_has_version(req: Request, version: int) -> bool:
+    """server.client_has_version for an ASGI request."""
+    return (str(version) in parse_etags(req.headers.get("if-none-match"))
+            or req.args.get("since_version") == str(version))
+
+
+async def in_thread(req: Request, fn, *args):
+    """
+    Run a blocking server.py helper on the DB thread pool inside an app
+    context (so its pooled connection is released when it returns) and add
+    its SQL count/time to the request's metrics.
+    """
+    def call():
+        server._sql_local.count = 0
+        server._sql_local.seconds = 0.0
+        with flask_app.app_context():
+            result = fn(*args)
+        return result, server._sql_local.count, server._sql_local.seconds
+
+    result, count, seconds = await asyncio.get_running_loop().run_in_executor(db_executor, call)
+    req.sql_count += count
+    req.sql_seconds += seconds
+    return result
+
+
+async def authenticate(req: Request, box_id: str, token: str):
+    """server.auth_box, answered on the event loop when the device is cached and the registry version fresh."""
+    if server.registry_due() or server.device_cache.get(box_id) is None:
+        return await in_thread(req, server.auth_box, box_id, token)
+    return server.auth_box(box_id, token)
+
+
+async def queue_version(req: Request, box_id: str, seq: int) -> int:
+    version = server.version_cache.get(box_id, seq)
+    if version is None:
+        version = await in_thread(req, server.queue_version, box_id)
+    return version
+
+
+# =========================
+# Change notification
+# =========================
+class BoxWaiters:
+    """
+    Event-loop side of server.box_events. Every notify (from any thread) is
+    forwarded with call_soon_threadsafe and resolves the futures parked on
+    that box. A waiter checks the sequence and registers its future in the
+    same loop step, so a notify can never slip in between unseen.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self._futures = {}
+        box_events.add_listener(self._notified)
+
+    def _notified(self, box_id: str):
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._wake, box_id)
+
+    def _wake(self, box_id: str):
+        for fut in self._futures.pop(box_id, ()):
+            if not fut.done():
+                fut.set_result(None)
+
+    async def wait(self, req: Request, box_id: str, seq: int, timeout: float) -> bool:
+        """Like BoxNotifier.wait, but also returns early if the client disconnects. True on change."""
+        return await self.wait_any(req, {box_id: seq}, timeout)
+
+    async def wait_any(self, req: Request, seqs: dict, timeout: float) -> bool:
+        """wait() over several boxes ({box_id: seq}): one future parked on each of them."""
+        def changed():
+            return any(box_events.seq(box_id) != seq for box_id, seq in seqs.items())
+
+        if changed():
+            return True
+        fut = self.loop.create_future()
+        for box_id in seqs:
+            self._futures.setdefault(box_id, set()).add(fut)
+        try:
+            await asyncio.wait((fut, req.watch_disconnect()), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            fut.cancel()
+            for box_id in seqs:
+                parked = self._futures.get(box_id)
+                if parked is not None:
+                    parked.discard(fut)
+                    if not parked:
+                        del self._futures[box_id]
+        return changed()
+
+
+_waiters = None
+
+
+def get_waiters() -> BoxWaiters:
+    global _waiters
+    if _waiters is None:
+        _waiters = BoxWaiters(asyncio.get_running_loop())
+        server.start_background()
+    return _waiters
+
+
+class ClientGone(Exception):
+    """The client disconnected while its request was parked; there is nobody to answer."""
+
+
+async def poll_queue(req: Request, box_id: str, limit: int):
+    """server.poll_queue, parked on the event loop. Raises ClientGone if the client leaves while parked."""
+    deadline = time.monotonic() + server.wait_seconds(req.args.get("wait"))
+    while True:
+        seq = box_events.seq(box_id)
+        version = await queue_version(req, box_id, seq)
+        if client_has_version(req, version):
+            rows = None
+        else:
+            rows, version = await in_thread(req, server.claim_pending, box_id, limit)
+        remaining = deadline - time.monotonic()
+        if rows or remaining <= 0:
+            return rows, version
+        await get_waiters().wait(req, box_id, seq, remaining)
+        if req.disconnected.is_set():
+            # Nobody left to deliver to; don't claim on their behalf.
+            raise ClientGone()
+
+
+def sse_reply(req: Request, feed, lifetime: float = math.inf) -> Reply:
+    """server.sse_response on the event loop: feed steps run on db_executor, waits park on every feed box at once."""
+    waiters = get_waiters()
+
+    async def generate():
+        deadline = time.monotonic() + lifetime
+        yield f"retry: {server.SSE_RETRY_MS}\n\n"
+
+        while not req.disconnected.is_set():
+            seqs = {box_id: box_events.seq(box_id) for box_id in feed.boxes}
+            events, done = await in_thread(req, feed.step)
+            for event in events:
+                yield event
+            remaining = deadline - time.monotonic()
+            if done or remaining <= 0:
+                return
+            if not await waiters.wait_any(req, seqs, min(server.SSE_HEARTBEAT, remaining)):
+                yield server.SSE_PING
+
+    return Reply(headers=SSE_HEADERS, stream=generate())
+
+
+# =========================
+# API for Love Boxes
+# =========================
+async def api_register(req: Request) -> Reply:
+    data = req.json()
+    box_id = data.get("box_id", "")
+    token = data.get("token", "")
+    info = await authenticate(req, box_id, token)
+    if not info:
+        return json_reply({"ok": False, "error": "auth_failed"}, 401)
+    return json_reply({"ok": True, "paired_to": info["paired_to"]})
+
+
+async def api_pending_count(req: Request) -> Reply:
+    box_id = req.args.get("box_id", "")
+    token = req.args.get("token", "")
+    info = await authenticate(req, box_id, token)
+    if not info:
+        return json_reply({"ok": False, "error": "auth_failed"}, 401)
+
+    version = await queue_version(req, box_id, box_events.seq(box_id))
+    if client_has_version(req, version):
+        return not_modified(version)
+
+    counts = await in_thread(req, server.queue_counts, box_id)
+    return versioned({"ok": True, "count": counts["pending"]}, counts["version"])
+
+
+async def api_check(req: Request) -> Reply:
+    box_id = req.args.get("box_id", "")
+    token = req.args.get("token", "")
+    info = await authenticate(req, box_id, token)
+    if not info:
+        return json_reply({"ok": False, "error": "auth_failed"}, 401)
+
+    batch = req.args.get("max")
+    limit = server.check_limit(batch)
+    rows, version = await poll_queue(req, box_id, limit)
+    if rows is None:
+        return not_modified(version)
+    return versioned(server.check_payload(rows, batch is not None), version)
+
+
+async def api_stream(req: Request) -> Reply:
+    box_id = req.args.get("box_id", "")
+    token = req.args.get("token", "")
+    info = await authenticate(req, box_id, token)
+    if not info:
+        return json_reply({"ok": False, "error": "auth_failed"}, 401)
+
+    last_event_id = req.headers.get("last-event-id") or req.args.get("last_event_id", "")
+    return sse_reply(req, server.MessageFeed(box_id, last_event_id))
+
+
+async def api_ack(req: Request) -> Reply:
+    data = req.json()
+    box_id = data.get("box_id", "")
+    token = data.get("token", "")
+
+    info = await authenticate(req, box_id, token)
+    if not info:
+        return json_reply({"ok": False, "error": "auth_failed"}, 401)
+
+    bulk, msg_ids = server.ack_targets(data)
+    acked = await in_thread(req, server.ack_messages, box_id, msg_ids)
+    return json_reply({"ok": True, "acked": acked}) if bulk else json_reply({"ok": True})
+
+
+async def api_send_event(req: Request) -> Reply:
+    data = req.json()
+    info = await authenticate(req, data.get("box_id", ""), data.get("token", ""))
+    if not info:
+        return json_reply({"ok": False, "error": "auth_failed"}, 401)
+    return json_reply(await in_thread(req, server.send_device_event, info, data))
+
+
+def wire_reply(body: bytes, binary: bool, status: int = 200, etag: str = None) -> Reply:
+    mimetype = server.WIRE_MIMETYPE if binary else "application/json"
+    headers = [(b"content-type", mimetype.encode()), (b"content-length", str(len(body)).encode()), (b"vary", b"Accept")]
+    if etag is not None:
+        headers.append((b"etag", f'"{etag}"'.encode()))
+    return Reply(status, body, headers)
+
+
+async def api_v2_check(req: Request) -> Reply:
+    box_id = req.args.get("box_id", "")
+    token = req.args.get("token", "")
+    info = await authenticate(req, box_id, token)
+    if not info:
+        return json_reply({"ok": False, "error": "auth_failed"}, 401)
+
+    binary = server.wire_binary(req.headers.get("accept"))
+    limit = server.check_limit(req.args.get("max"), binary)
+    rows, version = await poll_queue(req, box_id, limit)
+    if rows is None:
+        reply = not_modified(version)
+        reply.headers.append((b"vary", b"Accept"))
+        return reply
+    return wire_reply(server.encode_check(rows, version, binary), binary, etag=str(version))
+
+
+async def api_v2_ack(req: Request) -> Reply:
+    box_id = req.args.get("box_id", "")
+    token = req.args.get("token", "")
+    info = await authenticate(req, box_id, token)
+    if not info:
+        return json_reply({"ok": False, "error": "auth_failed"}, 401)
+
+    content_type = req.headers.get("content-type", "").split(";", 1)[0].strip().lower()
+    msg_ids = server.decode_ack(req.body, content_type == server.WIRE_MIMETYPE)
+    acked = await in_thread(req, server.ack_messages, box_id, msg_ids)
+    binary = server.wire_binary(req.headers.get("accept"))
+    return wire_reply(server.encode_acked(acked, binary), binary)
+
+
+API_ROUTES = {
+    ("POST", "/api/register"): api_register,
+    ("GET", "/api/pending_count"): api_pending_count,
+    ("GET", "/api/check"): api_check,
+    ("GET", "/api/stream"): api_stream,
+    ("POST", "/api/ack"): api_ack,
+    ("POST", "/api/send_event"): api_send_event,
+    ("GET", "/api/v2/check"): api_v2_check,
+    ("POST", "/api/v2/ack"): api_v2_ack,
+}
+
+
+# =========================
+# Web UI status stream
+# =========================
+def logged_in(scope) -> bool:
+    """The Flask session's logged_in flag, read from this request's cookie."""
+    with flask_app.request_context(wsgi_environ(scope, b"")):
+        return bool(session.get("logged_in"))
+
+
+async def web_status_stream(req: Request) -> Reply:
+    """server.web_status's streams on the event loop. The session was checked before dispatch."""
+    feed = await in_thread(req, server.status_feed, req.args)
+    return sse_reply(req, feed, server.STATUS_STREAM_MAX)
+
+
+def web_stream_handler(scope):
+    """
+    web_status_stream for a logged-in /status?stream=1, else None. Everything
+    else on /status (polls, a missing session) is the Flask app's.
+    """
+    if (scope["method"], scope["path"]) != ("GET", "/status"):
+        return None
+    args = query_args(scope)
+    if not args.get("stream") or not logged_in(scope):
+        return None
+    return web_status_stream
+
+
+def finish_metrics(req: Request, status: int, t0: float):
+    """The per-route series finish_request_metrics records for Flask requests."""
+    route = req.path
+    metrics.inc("lovebox_http_requests_total", (("route", route), ("method", req.method), ("status", str(status))))
+    metrics.observe("lovebox_http_request_duration_seconds", time.perf_counter() - t0, (("route", route),))
+    if req.sql_count:
+        metrics.inc("lovebox_sqlite_queries_total", (("route", route),), req.sql_count)
+        metrics.inc("lovebox_sqlite_query_seconds_total", (("route", route),), req.sql_seconds)
+        req.sql_count = 0
+        req.sql_seconds = 0.0
+
+
+async def serve_api(handler, scope, receive, send):
+    get_waiters()
+    t0 = time.perf_counter()
+    req = Request(scope, receive)
+    try:
+        await req.read_body()
+        try:
+            reply = await handler(req)
+        except ClientGone:
+            return
+        except server.RequestError as e:
+            reply = json_reply(e.body, e.status)
+            reply.headers.extend((k.lower().encode(), v.encode()) for k, v in e.headers.items())
+        finish_metrics(req, reply.status, t0)
+        await send({"type": "http.response.start", "status": reply.status, "headers": reply.headers})
+        if reply.stream is None:
+            await send({"type": "http.response.body", "body": reply.body})
+            return
+        async for chunk in reply.stream:
+            await send({"type": "http.response.body", "body": chunk.encode(), "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        req.close()
+
+
+# =========================
+# Everything else: the Flask app over WSGI
+# =========================
+def wsgi_environ(scope, body: bytes) -> dict:
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+    client = scope.get("client")
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode().decode("latin-1"),
+        "PATH_INFO": scope["path"].encode().decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0] if client else "",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1")
+        if name == "content-type":
+            key = "CONTENT_TYPE"
+        elif name == "content-length":
+            key = "CONTENT_LENGTH"
+        else:
+            key = "HTTP_" + name.upper().replace("-", "_")
+        value = value.decode("latin-1")
+        environ[key] = environ[key] + "," + value if key in environ else value
+    return environ
+
+
+async def serve_wsgi(scope, receive, send):
+    req = Request(scope, receive)
+    await req.read_body()
+    environ = wsgi_environ(scope, req.body)
+    loop = asyncio.get_running_loop()
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started["status"] = int(status.split(" ", 1)[0])
+        started["headers"] = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers]
+
+    def call():
+        body = flask_app(environ, start_response)
+        return body, iter(body)
+
+    body, chunks = await loop.run_in_executor(wsgi_executor, call)
+    try:
+        await send({"type": "http.response.start", "status": started["status"], "headers": started["headers"]})
+        # Streamed responses are pulled one chunk at a time.
+        while True:
+            chunk = await loop.run_in_executor(wsgi_executor, next, chunks, None)
+            if chunk is None:
+                break
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        if hasattr(body, "close"):
+            await loop.run_in_executor(wsgi_executor, body.close)
+
+
+# =========================
+# ASGI entry point
+# =========================
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            get_waiters()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            metrics.flush()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+    handler = API_ROUTES.get((scope["method"], scope["path"])) or web_stream_handler(scope)
+    if handler is not None:
+        await serve_api(handler, scope, receive, send)
+    else:
+        await serve_wsgi(scope, receive, send)
@@ -0,0 +1,392 @@
+"""
+Load test / benchmark for the Love Box server.
+
+Simulates a fleet of boxes polling the device API (/api/pending_count,
+/api/check, /api/ack, /api/send_event) alongside logged-in web users
+sending from /send and watching /status, against a throwaway DB_PATH.
+
+  python bench.py                                  # in-process Flask test client
+  python bench.py --mode gunicorn --workers 4      # real gunicorn server
+  python bench.py --mode asgi --workers 4          # gunicorn + uvicorn workers (asgi.py)
+  python bench.py --boxes 500 --interval 2 --duration 30
+  python bench.py --compare bench_results/old.json
+
+Reports throughput and p50/p95/p99 latency per route plus slow SQLite
+statements and lock timeouts, and writes everything to a JSON file so runs
+can be compared. The throwaway database is removed when the run exits.
+"""
+import argparse
+import atexit
+import http.cookiejar
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+EVENTS = ("heartbeat", "rainbow", "breathe", "ping")
+WEB_PASSWORD = "bench-password"
+MSG_ID_RE = re.compile(r'id="msgId">([0-9a-f]+)<')
+
+
+# =========================
+# Clients
+# =========================
+class InProcessClient:
+    """Flask test client; one per thread."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, json_body=None, form=None):
+        r = self.client.open(path, method=method, json=json_body, data=form)
+        if r.is_json:
+            return r.status_code, r.get_json(silent=True)
+        return r.status_code, r.get_data(as_text=True)
+
+
+class HttpClient:
+    """urllib client with its own cookie jar (web users need the session cookie)."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+            NoRedirect(),
+        )
+
+    def request(self, method, path, json_body=None, form=None):
+        data, headers = None, {}
+        if json_body is not None:
+            data = json.dumps(json_body).encode()
+            headers["Content-Type"] = "application/json"
+        elif form is not None:
+            data = urllib.parse.urlencode(form).encode()
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        req = urllib.request.Request(self.base_url + path, data=data, method=method, headers=headers)
+        try:
+            with self.opener.open(req, timeout=60) as r:
+                status, body = r.status, r.read()
+        except urllib.error.HTTPError as e:
+            status, body = e.code, e.read()
+        try:
+            return status, json.loads(body)
+        except ValueError:
+            return status, body.decode("utf-8", "replace")
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+# =========================
+# Recording
+# =========================
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+
+    def timed(self, client, route, method, path, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            status, body = client.request(method, path, **kwargs)
+        except Exception:
+            status, body = 599, None
+        ms = (time.perf_counter() - t0) * 1000.0
+        with self.lock:
+            self.samples.setdefault(route, []).append(ms)
+            if status >= 400 and status != 401:
+                self.errors[route] = self.errors.get(route, 0) + 1
+        return status, body
+
+
+def percentile(sorted_ms, p):
+    if not sorted_ms:
+        return None
+    k = max(0, min(len(sorted_ms) - 1, int(round(p / 100.0 * len(sorted_ms) + 0.5)) - 1))
+    return round(sorted_ms[k], 3)
+
+
+def summarize(recorder, elapsed):
+    routes = {}
+    total = 0
+    for route, ms in sorted(recorder.samples.items()):
+        ms = sorted(ms)
+        total += len(ms)
+        routes[route] = {
+            "count": len(ms),
+            "errors": recorder.errors.get(route, 0),
+            "rps": round(len(ms) / elapsed, 2),
+            "p50_ms": percentile(ms, 50),
+            "p95_ms": percentile(ms, 95),
+            "p99_ms": percentile(ms, 99),
+            "max_ms": round(ms[-1], 3),
+        }
+    return routes, {"count": total, "rps": round(total / elapsed, 2)}
+
+
+# =========================
+# Simulated users
+# =========================
+def box_loop(client, rec, boxes, args, stop):
+    """Each box: pending_count -> check -> ack (if any); sometimes send an event."""
+    next_due = {b["box_id"]: time.monotonic() + random.uniform(0, args.interval) for b in boxes}
+    while not stop.is_set():
+        for box in boxes:
+            if stop.is_set():
+                return
+            wait = next_due[box["box_id"]] - time.monotonic()
+            if wait > 0:
+                stop.wait(min(wait, 0.05))
+                continue
+            next_due[box["box_id"]] = time.monotonic() + args.interval
+
+            q = urllib.parse.urlencode({"box_id": box["box_id"], "token": box["token"]})
+            rec.timed(client, "/api/pending_count", "GET", "/api/pending_count?" + q)
+            status, body = rec.timed(client, "/api/check", "GET", "/api/check?" + q)
+            if status == 200 and isinstance(body, dict) and body.get("has"):
+                rec.timed(client, "/api/ack", "POST", "/api/ack", json_body={
+                    "box_id": box["box_id"], "token": box["token"], "msg_id": body["msg_id"],
+                })
+            if random.random() < args.event_rate:
+                rec.timed(client, "/api/send_event", "POST", "/api/send_event", json_body={
+                    "box_id": box["box_id"], "token": box["token"], "event": random.choice(EVENTS),
+                })
+
+
+def web_loop(client, rec, targets, args, stop):
+    """Log in, then send a message and check its status a few times."""
+    client.request("POST", "/login", form={"password": WEB_PASSWORD})
+    while not stop.is_set():
+        rec.timed(client, "/send [GET]", "GET", "/send")
+        status, body = rec.timed(client, "/send [POST]", "POST", "/send", form={
+            "target": random.choice(targets), "text": "bench " + str(random.random()),
+        })
+        m = MSG_ID_RE.search(body) if isinstance(body, str) else None
+        for _ in range(args.status_polls if m else 0):
+            if stop.is_set():
+                return
+            rec.timed(client, "/status", "GET", "/status?msg_id=" + m.group(1))
+        stop.wait(args.web_interval)
+
+
+# =========================
+# Servers
+# =========================
+def provision(server, n_boxes):
+    """Register bench_box_0..N-1, paired 0<->1, 2<->3, ..."""
+    boxes = [{"box_id": f"bench_box_{i}", "token": f"bench_token_{i}"} for i in range(n_boxes)]
+    with server.app.app_context():
+        server.register_devices([
+            (b["box_id"], b["token"], f"bench_box_{i ^ 1 if i ^ 1 < n_boxes else i}", f"bench_{i >> 1}")
+            for i, b in enumerate(boxes)
+        ])
+    return boxes
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(args, env):
+    port = free_port()
+    cmd = [
+        sys.executable, "-m", "gunicorn",
+        "--bind", f"127.0.0.1:{port}",
+        "--workers", str(args.workers),
+        "--log-level", "warning",
+    ]
+    if args.mode == "asgi":
+        cmd += ["--worker-class", "uvicorn.workers.UvicornWorker", "asgi:app"]
+    else:
+        if args.threads > 1:
+            cmd += ["--worker-class", "gthread", "--threads", str(args.threads)]
+        cmd.append("server:app")
+    proc = subprocess.Popen(cmd, cwd=BASE_DIR, env=env)
+
+    base = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 20
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(base + "/health", timeout=1):
+                return proc, base
+        except OSError:
+            time.sleep(0.1)
+    proc.terminate()
+    raise RuntimeError("gunicorn did not come up")
+
+
+# =========================
+# Main
+# =========================
+def run(args):
+    tmp = tempfile.mkdtemp(prefix="lovebox-bench-")
+    # Registered before server is imported so it runs after server's own
+    # atexit hooks (the last metrics flush writes into tmp).
+    atexit.register(shutil.rmtree, tmp, ignore_errors=True)
+    env = dict(
+        os.environ,
+        DB_PATH=os.path.join(tmp, "bench.db"),
+        WEB_PASSWORD=WEB_PASSWORD,
+        METRICS_DIR=os.path.join(tmp, "metrics"),
+        METRICS_FLUSH="0.5",
+    )
+    # Measure the server, not the throttle: no rate limits unless asked for.
+    env.setdefault("BOX_RATE", "0")
+    env.setdefault("WEB_RATE", "0")
+    os.environ.update(env)
+    sys.path.insert(0, BASE_DIR)
+    import server
+
+    boxes = provision(server, args.boxes)
+    targets = [server.BOX1_ID, server.BOX2_ID]
+
+    proc = None
+    if args.mode in ("gunicorn", "asgi"):
+        proc, base = start_gunicorn(args, env)
+        make_client = lambda: HttpClient(base)
+    else:
+        make_client = lambda: InProcessClient(server.app)
+
+    rec = Recorder()
+    stop = threading.Event()
+    stats_before = dict(server.DB_STATS)
+    threads = []
+    n = max(1, min(args.concurrency, len(boxes)))
+    for i in range(n):
+        threads.append(threading.Thread(target=box_loop, args=(make_client(), rec, boxes[i::n], args, stop)))
+    for _ in range(args.web_users):
+        threads.append(threading.Thread(target=web_loop, args=(make_client(), rec, targets, args, stop)))
+
+    started = time.time()
+    t0 = time.perf_counter()
+    for t in threads:
+        t.daemon = True
+        t.start()
+    time.sleep(args.duration)
+    stop.set()
+    for t in threads:
+        t.join(timeout=30)
+    elapsed = time.perf_counter() - t0
+
+    if proc is not None:
+        # Slow statements happen inside the gunicorn workers; read them from /metrics
+        # once every worker has flushed.
+        time.sleep(1.0)
+        sqlite_stats = scrape_lock_stats(base)
+        proc.terminate()
+        proc.wait(timeout=10)
+    else:
+        sqlite_stats = {k: server.DB_STATS[k] - stats_before[k] for k in stats_before}
+
+    routes, total = summarize(rec, elapsed)
+    return {
+        "meta": {
+            "started_at": int(started),
+            "mode": args.mode,
+            "boxes": args.boxes,
+            "web_users": args.web_users,
+            "concurrency": n,
+            "interval": args.interval,
+            "duration": round(elapsed, 3),
+            "workers": args.workers if args.mode != "inprocess" else None,
+            "threads": args.threads if args.mode == "gunicorn" else None,
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "git_rev": git_rev(),
+        },
+        "routes": routes,
+        "total": total,
+        "sqlite": sqlite_stats,
+    }
+
+
+def scrape_lock_stats(base):
+    stats = {"slow_statements": None, "lock_timeouts": None}
+    try:
+        with urllib.request.urlopen(base + "/metrics", timeout=10) as r:
+            text = r.read().decode()
+    except OSError:
+        return stats
+    for line in text.splitlines():
+        name, _, value = line.partition(" ")
+        if name == "lovebox_sqlite_slow_statements_total":
+            stats["slow_statements"] = int(float(value))
+        elif name == "lovebox_sqlite_lock_timeouts_total":
+            stats["lock_timeouts"] = int(float(value))
+    return stats
+
+
+def git_rev():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR, stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(result, baseline=None):
+    print(f"{'route':<22}{'count':>8}{'err':>6}{'rps':>10}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for route, r in result["routes"].items():
+        line = f"{route:<22}{r['count']:>8}{r['errors']:>6}{r['rps']:>10}{r['p50_ms']:>9}{r['p95_ms']:>9}{r['p99_ms']:>9}"
+        old = (baseline or {}).get("routes", {}).get(route)
+        if old and old["p95_ms"]:
+            line += f"   p95 {100.0 * (r['p95_ms'] - old['p95_ms']) / old['p95_ms']:+.1f}%"
+        print(line)
+    print(f"total {result['total']['count']} requests, {result['total']['rps']} req/s; sqlite {result['sqlite']}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--mode", choices=("inprocess", "gunicorn", "asgi"), default="inprocess")
+    ap.add_argument("--boxes", type=int, default=20, help="simulated boxes")
+    ap.add_argument("--web-users", type=int, default=2, help="simulated logged-in web users")
+    ap.add_argument("--duration", type=float, default=10.0, help="seconds to run")
+    ap.add_argument("--concurrency", type=int, default=8, help="client threads driving the boxes")
+    ap.add_argument("--interval", type=float, default=0.0, help="seconds between polls per box (0 = closed loop)")
+    ap.add_argument("--event-rate", type=float, default=0.1, help="chance a box sends an event per poll")
+    ap.add_argument("--status-polls", type=int, default=3, help="/status calls per web send")
+    ap.add_argument("--web-interval", type=float, default=0.5, help="seconds between web sends")
+    ap.add_argument("--workers", type=int, default=2, help="gunicorn workers")
+    ap.add_argument("--threads", type=int, default=1, help="gunicorn threads per worker (>1 uses gthread)")
+    ap.add_argument("--out", default=None, help="result JSON path (default bench_results/<mode>-<time>.json)")
+    ap.add_argument("--compare", default=None, help="earlier result JSON to diff p95 against")
+    args = ap.parse_args()
+
+    result = run(args)
+
+    out = args.out or os.path.join(
+        BASE_DIR, "bench_results", f"{args.mode}-{time.strftime('%Y%m%d-%H%M%S')}.json",
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+    print("saved", out)
+
+
+if __name__ == "__main__":
+    main()
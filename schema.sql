@@ -1,27 +1,131 @@
--- Devices (same as before)
-CREATE TABLE IF NOT EXISTS devices (
-  box_id TEXT PRIMARY KEY,
-  token TEXT NOT NULL,
-  paired_to TEXT NOT NULL
-);
-
--- Message queue with status lifecycle:
--- sent -> delivered -> seen
-CREATE TABLE IF NOT EXISTS messages (
-  msg_id TEXT PRIMARY KEY,
-  to_box TEXT NOT NULL,
-  from_source TEXT NOT NULL,   -- "web" or "device"
-  msg_type TEXT NOT NULL,      -- "text" or "event"
-  msg_text TEXT,
-  msg_event TEXT,
-  status TEXT NOT NULL,        -- "sent" | "delivered" | "seen"
-  created_at INTEGER NOT NULL,
-  delivered_at INTEGER,
-  seen_at INTEGER
-);
-
-CREATE INDEX IF NOT EXISTS idx_messages_to_status_created
-  ON messages(to_box, status, created_at);
-
-CREATE INDEX IF NOT EXISTS idx_messages_to_created
-  ON messages(to_box, created_at);
+-- Devices (same as before)
+CREATE TABLE IF NOT EXISTS devices (
+  box_id TEXT PRIMARY KEY,
+  token TEXT NOT NULL,
+  paired_to TEXT NOT NULL,
+  group_id TEXT                -- pairing group (e.g. one per couple); NULL = ungrouped
+);
+
+CREATE INDEX IF NOT EXISTS idx_devices_group
+  ON devices(group_id, box_id);
+
+CREATE INDEX IF NOT EXISTS idx_devices_paired_to
+  ON devices(paired_to);
+
+-- Bumped by the triggers below on any devices change, so workers can
+-- tell with one PK lookup whether their cached target list is stale.
+CREATE TABLE IF NOT EXISTS registry_version (
+  id INTEGER PRIMARY KEY CHECK (id = 1),
+  version INTEGER NOT NULL
+);
+
+INSERT OR IGNORE INTO registry_version (id, version) VALUES (1, 0);
+
+DROP TRIGGER IF EXISTS trg_devices_version_insert;
+CREATE TRIGGER trg_devices_version_insert AFTER INSERT ON devices
+BEGIN
+  UPDATE registry_version SET version = version + 1 WHERE id = 1;
+END;
+
+DROP TRIGGER IF EXISTS trg_devices_version_update;
+CREATE TRIGGER trg_devices_version_update AFTER UPDATE ON devices
+BEGIN
+  UPDATE registry_version SET version = version + 1 WHERE id = 1;
+END;
+
+DROP TRIGGER IF EXISTS trg_devices_version_delete;
+CREATE TRIGGER trg_devices_version_delete AFTER DELETE ON devices
+BEGIN
+  UPDATE registry_version SET version = version + 1 WHERE id = 1;
+END;
+
+-- Message queue with status lifecycle:
+-- [scheduled ->] sent -> delivered -> seen
+CREATE TABLE IF NOT EXISTS messages (
+  msg_id TEXT PRIMARY KEY,
+  to_box TEXT NOT NULL,
+  from_source TEXT NOT NULL,   -- "web" or "device"
+  msg_type TEXT NOT NULL,      -- "text" or "event"
+  msg_text TEXT,
+  msg_event TEXT,
+  status TEXT NOT NULL,        -- "scheduled" | "sent" | "delivered" | "seen"
+  created_at INTEGER NOT NULL,
+  delivered_at INTEGER,
+  seen_at INTEGER,
+  broadcast_id TEXT,           -- shared by the rows of one broadcast; NULL for single sends
+  deliver_at INTEGER           -- when it becomes visible to /api/check (created_at unless scheduled)
+);
+
+-- Rows from before deliver_at existed were due when created.
+UPDATE messages SET deliver_at = created_at WHERE deliver_at IS NULL;
+
+CREATE INDEX IF NOT EXISTS idx_messages_to_status_created
+  ON messages(to_box, status, created_at);
+
+-- Queue order: claims read a box's rows by due time, and releasing its
+-- scheduled rows is a range up to now. Replaces (to_box, created_at).
+DROP INDEX IF EXISTS idx_messages_to_created;
+CREATE INDEX IF NOT EXISTS idx_messages_to_deliver
+  ON messages(to_box, deliver_at);
+
+-- Broadcast status lookups; single sends (NULL) stay out of the index.
+CREATE INDEX IF NOT EXISTS idx_messages_broadcast
+  ON messages(broadcast_id) WHERE broadcast_id IS NOT NULL;
+
+-- Per-box queue counters, kept in step with messages by the triggers
+-- below so pending counts and the prune pre-check are one PK lookup.
+CREATE TABLE IF NOT EXISTS box_counters (
+  to_box TEXT PRIMARY KEY,
+  total INTEGER NOT NULL DEFAULT 0,
+  pending INTEGER NOT NULL DEFAULT 0,  -- "sent" + "delivered"
+  seen INTEGER NOT NULL DEFAULT 0,
+  version INTEGER NOT NULL DEFAULT 0   -- bumped on every change to the box's queue
+);
+
+-- Backfill boxes that have messages but no counters row yet (first run
+-- against an older database). Boxes already tracked are left alone.
+INSERT OR IGNORE INTO box_counters (to_box, total, pending, seen)
+  SELECT to_box, COUNT(*), SUM(status IN ('sent','delivered')), SUM(status = 'seen')
+  FROM messages
+  GROUP BY to_box;
+
+-- Triggers are recreated on every start so changes here reach old databases.
+-- apply_schema runs this whole file in one transaction, so no write lands
+-- between a DROP and its CREATE (or between the backfill and the triggers).
+DROP TRIGGER IF EXISTS trg_messages_counters_insert;
+DROP TRIGGER IF EXISTS trg_messages_counters_delete;
+DROP TRIGGER IF EXISTS trg_messages_counters_status;
+
+CREATE TRIGGER trg_messages_counters_insert
+AFTER INSERT ON messages
+BEGIN
+  INSERT INTO box_counters (to_box, total, pending, seen, version)
+  VALUES (NEW.to_box, 1, NEW.status IN ('sent','delivered'), NEW.status = 'seen', 1)
+  ON CONFLICT(to_box) DO UPDATE SET
+    total = total + 1,
+    pending = pending + excluded.pending,
+    seen = seen + excluded.seen,
+    version = version + 1;
+END;
+
+CREATE TRIGGER trg_messages_counters_delete
+AFTER DELETE ON messages
+BEGIN
+  UPDATE box_counters SET
+    total = total - 1,
+    pending = pending - (OLD.status IN ('sent','delivered')),
+    seen = seen - (OLD.status = 'seen'),
+    version = version + 1
+  WHERE to_box = OLD.to_box;
+END;
+
+CREATE TRIGGER trg_messages_counters_status
+AFTER UPDATE OF status ON messages
+WHEN OLD.status IS NOT NEW.status
+BEGIN
+  UPDATE box_counters SET
+    pending = pending - (OLD.status IN ('sent','delivered')) + (NEW.status IN ('sent','delivered')),
+    seen = seen - (OLD.status = 'seen') + (NEW.status = 'seen'),
+    version = version + 1
+  WHERE to_box = NEW.to_box;
+END;
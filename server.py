@@ -1,817 +1,4170 @@
-import os
-import sqlite3
-import time
-import secrets
-from flask import Flask, request, jsonify, redirect, url_for, session, render_template_string, abort
-
-# =========================
-# CONFIG (from Environment)
-# =========================
-APP_SECRET   = os.environ.get("APP_SECRET",   "dev-secret-change-me")
-WEB_PASSWORD = os.environ.get("WEB_PASSWORD", "dev-password-change-me")
-
-BOX1_ID    = os.environ.get("BOX1_ID",    "bryce_box")
-BOX1_TOKEN = os.environ.get("BOX1_TOKEN", "dev_token_box1")
-BOX2_ID    = os.environ.get("BOX2_ID",    "amanda_box")
-BOX2_TOKEN = os.environ.get("BOX2_TOKEN", "dev_token_box2")
-
-DB_PATH = os.environ.get("DB_PATH", "lovebox.db")
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-
-MAX_QUEUE = 5  # per box
-
-
-# =========================
-# INLINE HTML (NO TEMPLATES)
-# =========================
-
-THEME_HEAD = """
-  <meta charset="utf-8" />
-  <meta name="viewport" content="width=device-width, initial-scale=1" />
-  <link rel="preconnect" href="https://fonts.googleapis.com">
-  <link rel="preconnect" href="https://fonts.gstatic.com" crossorigin>
-  <link href="https://fonts.googleapis.com/css2?family=Poppins:wght@400;500;600;700&display=swap" rel="stylesheet">
-  <style>
-    :root{
-      --bg: #07060a;          /* near-black */
-      --panel: #0f0b16;       /* dark purple-black */
-      --panel2: #120d1c;
-      --text: #ffffff;
-      --muted: rgba(255,255,255,.72);
-      --muted2: rgba(255,255,255,.55);
-      --border: rgba(255,255,255,.10);
-
-      --purple: #7c3aed;      /* violet */
-      --pink: #ff4fd8;        /* neon pink */
-      --pink2:#ff2fbf;
-
-      --ok: #22c55e;
-      --bad: #ef4444;
-      --warn:#fbbf24;
-
-      --radius: 16px;
-      --shadow: 0 10px 30px rgba(0,0,0,.35);
-      --shadow2: 0 1px 0 rgba(255,255,255,.05) inset;
-
-      --ring: 0 0 0 3px rgba(255,79,216,.25);
-    }
-
-    * { box-sizing: border-box; }
-    html, body { height: 100%; }
-    body {
-      margin: 0;
-      font-family: "Poppins", system-ui, -apple-system, Segoe UI, Roboto, sans-serif;
-      background:
-        radial-gradient(900px 420px at 15% 0%, rgba(124,58,237,.22), transparent 55%),
-        radial-gradient(900px 420px at 85% 0%, rgba(255,79,216,.18), transparent 55%),
-        linear-gradient(180deg, #06050a, var(--bg));
-      color: var(--text);
-    }
-
-    .wrap{
-      max-width: 920px;
-      margin: 0 auto;
-      padding: 22px 14px 48px;
-    }
-
-    .brand{
-      display:flex;
-      align-items:center;
-      gap:10px;
-      margin: 8px 0 14px;
-    }
-    .logo{
-      width: 38px; height: 38px;
-      border-radius: 12px;
-      background:
-        linear-gradient(135deg, rgba(124,58,237,.95), rgba(255,79,216,.95));
-      box-shadow: var(--shadow);
-    }
-    h1, h2{
-      margin: 0;
-      letter-spacing: -0.02em;
-    }
-    h1{ font-size: 20px; font-weight: 700; }
-    h2{ font-size: 18px; font-weight: 700; }
-
-    .sub{
-      margin: 6px 0 0;
-      color: var(--muted);
-      font-size: 13px;
-      line-height: 1.35;
-    }
-
-    .grid{
-      display: grid;
-      grid-template-columns: 1fr;
-      gap: 14px;
-      margin-top: 14px;
-    }
-    @media (min-width: 860px){
-      .grid{ grid-template-columns: 1.25fr .75fr; gap: 16px; }
-    }
-
-    .card{
-      background: linear-gradient(180deg, rgba(255,255,255,.04), rgba(255,255,255,.02));
-      border: 1px solid var(--border);
-      border-radius: var(--radius);
-      box-shadow: var(--shadow), var(--shadow2);
-      padding: 16px;
-    }
-
-    label{
-      display:block;
-      font-size: 12px;
-      font-weight: 600;
-      color: var(--muted);
-      margin-top: 12px;
-      margin-bottom: 6px;
-      letter-spacing: .02em;
-      text-transform: uppercase;
-    }
-
-    input, textarea, select{
-      width: 100%;
-      padding: 12px 12px;
-      border-radius: 14px;
-      border: 1px solid rgba(255,255,255,.12);
-      background: rgba(10,8,14,.75);
-      color: var(--text);
-      outline: none;
-      font-size: 15px;
-      box-shadow: 0 0 0 1px rgba(0,0,0,.2) inset;
-    }
-    textarea{ min-height: 120px; resize: vertical; }
-    input::placeholder, textarea::placeholder{ color: rgba(255,255,255,.45); }
-
-    input:focus, textarea:focus, select:focus{
-      border-color: rgba(255,79,216,.55);
-      box-shadow: var(--ring);
-    }
-
-    .row{
-      display:flex;
-      gap: 10px;
-      align-items: center;
-      flex-wrap: wrap;
-    }
-
-    .btn{
-      width: 100%;
-      padding: 12px 14px;
-      border: 0;
-      border-radius: 14px;
-      font-weight: 700;
-      font-size: 15px;
-      cursor: pointer;
-      color: white;
-      background: linear-gradient(135deg, rgba(124,58,237,1), rgba(255,79,216,1));
-      box-shadow: 0 10px 24px rgba(124,58,237,.14), 0 10px 24px rgba(255,79,216,.10);
-      transition: transform .06s ease, filter .12s ease;
-      user-select: none;
-      -webkit-tap-highlight-color: transparent;
-    }
-    .btn:active{ transform: translateY(1px); filter: brightness(.98); }
-
-    .btn.secondary{
-      background: rgba(255,255,255,.06);
-      border: 1px solid rgba(255,255,255,.14);
-      box-shadow: none;
-      font-weight: 600;
-      color: var(--text);
-    }
-
-    .btn.ghost{
-      background: rgba(255,255,255,.04);
-      border: 1px solid rgba(255,255,255,.12);
-      box-shadow: none;
-      font-weight: 700;
-    }
-
-    .btn.small{
-      width: auto;
-      padding: 10px 12px;
-      border-radius: 12px;
-      font-size: 14px;
-    }
-
-    .inline{
-      display:flex;
-      gap:10px;
-      align-items: center;
-      flex-wrap: wrap;
-    }
-    .inline select{ flex: 1; min-width: 220px; }
-    .inline .btn.small{ flex: 0 0 auto; }
-
-    .status{
-      margin-top: 14px;
-      padding: 12px;
-      border-radius: 14px;
-      background: rgba(0,0,0,.28);
-      border: 1px solid rgba(255,255,255,.10);
-    }
-
-    .pill{
-      display:inline-flex;
-      align-items:center;
-      gap:8px;
-      padding: 6px 10px;
-      border-radius: 999px;
-      font-size: 12px;
-      font-weight: 700;
-      background: rgba(255,255,255,.06);
-      border: 1px solid rgba(255,255,255,.10);
-    }
-
-    code{
-      font-family: ui-monospace, SFMono-Regular, Menlo, Monaco, Consolas, "Liberation Mono", "Courier New", monospace;
-      font-size: 12px;
-      padding: 2px 6px;
-      border-radius: 8px;
-      background: rgba(0,0,0,.35);
-      border: 1px solid rgba(255,255,255,.10);
-      color: rgba(255,255,255,.9);
-    }
-
-    .small{
-      font-size: 12px;
-      color: var(--muted2);
-      margin-top: 10px;
-      line-height: 1.35;
-    }
-
-    .err{
-      margin-top: 10px;
-      color: #ffd1dc;
-      background: rgba(239,68,68,.12);
-      border: 1px solid rgba(239,68,68,.20);
-      padding: 10px;
-      border-radius: 12px;
-      font-weight: 600;
-      font-size: 13px;
-    }
-
-    .eventGrid{
-      display:grid;
-      grid-template-columns: 1fr 1fr;
-      gap: 10px;
-      margin-top: 10px;
-    }
-
-    .eventBtn{
-      padding: 12px 12px;
-      border-radius: 14px;
-      border: 1px solid rgba(255,255,255,.14);
-      background: rgba(255,255,255,.06);
-      color: white;
-      font-weight: 700;
-      cursor: pointer;
-      transition: transform .06s ease, filter .12s ease;
-    }
-    .eventBtn:active{ transform: translateY(1px); }
-
-    .eventBtn.pink{
-      background: linear-gradient(135deg, rgba(255,79,216,1), rgba(124,58,237,1));
-      border: 0;
-    }
-
-    .hintRow{
-      display:flex;
-      justify-content: space-between;
-      gap: 10px;
-      flex-wrap: wrap;
-      margin-top: 10px;
-    }
-    .hintRow .small{ margin-top: 0; }
-  </style>
-"""
-
-LOGIN_HTML = f"""<!doctype html>
-<html>
-<head>
-{THEME_HEAD}
-  <title>Love Box • Login</title>
-</head>
-<body>
-  <div class="wrap">
-    <div class="brand">
-      <div class="logo" aria-hidden="true"></div>
-      <div>
-        <h1>Love Box</h1>
-        <div class="sub">Enter the password to send messages & events.</div>
-      </div>
-    </div>
-
-    <div class="card">
-      <form method="post" action="/login">
-        <label>Password</label>
-        <input type="password" name="password" placeholder="Password" required />
-        <button class="btn" type="submit">Login</button>
-      </form>
-
-      {{% if error %}}<div class="err">{{{{ error }}}}</div>{{% endif %}}
-
-      <div class="small">Tip: bookmark <code>/send</code> after logging in.</div>
-    </div>
-  </div>
-</body>
-</html>
-"""
-
-SEND_HTML = f"""<!doctype html>
-<html>
-<head>
-{THEME_HEAD}
-  <title>Love Box • Send</title>
-</head>
-<body>
-  <div class="wrap">
-    <div class="brand">
-      <div class="logo" aria-hidden="true"></div>
-      <div>
-        <h1>Send Love</h1>
-        <div class="sub">Queue v2 (max {MAX_QUEUE}). Status: Sent → Delivered → Seen.</div>
-      </div>
-    </div>
-
-    <div class="grid">
-      <!-- LEFT: Message -->
-      <div class="card">
-        <h2>Message</h2>
-        <div class="sub">Pick a box, write a message, drop an emoji tag, send.</div>
-
-        <form method="post" action="/send" id="msgForm">
-          <label>Target box</label>
-          <select name="target" required>
-            <option value="{{{{ box1 }}}}">{{{{ box1 }}}}</option>
-            <option value="{{{{ box2 }}}}">{{{{ box2 }}}}</option>
-          </select>
-
-          <label>Message</label>
-          <textarea id="messageBox" name="text" rows="4" placeholder="Type something sweet…"></textarea>
-
-          <label>Emoji picker</label>
-          <div class="inline">
-            <select id="emojiSelect">
-              <option value="">Select an emoji…</option>
-              <option value="[BEER]">🍺 BEER</option>
-              <option value="[BREAD]">🍞 BREAD</option>
-              <option value="[CRY]">😭 CRY</option>
-              <option value="[GLIZZY]">🌭 GLIZZY</option>
-              <option value="[HEART]">❤️ HEART</option>
-              <option value="[JOY]">🥹 JOY</option>
-              <option value="[KISS]">😘 KISS</option>
-              <option value="[LOVE]">🥰 LOVE</option>
-              <option value="[MAIL]">📫 MAIL</option>
-              <option value="[PANDA]">🐼 PANDA</option>
-              <option value="[SMILE]">😀 SMILE</option>
-              <option value="[SUSHI]">🍣 SUSHI</option>
-              <option value="[UPSIDEDOWN]">🙃 UPSIDEDOWN</option>
-              <option value="[WORM]">🪱 WORM</option>
-            </select>
-
-            <button class="btn ghost small" type="button" onclick="insertEmoji()">Insert</button>
-          </div>
-
-          <button class="btn" type="submit">Send Message</button>
-        </form>
-
-        {{% if msg_id %}}
-          <div class="status">
-            <div class="hintRow">
-              <div class="small"><strong>Message ID:</strong> <code id="msgId">{{{{ msg_id }}}}</code></div>
-              <div class="small"><strong>Status:</strong> <span class="pill" id="statusPill">{{{{ status_text }}}}</span></div>
-            </div>
-            <div class="small">This updates automatically.</div>
-          </div>
-        {{% elif status_text %}}
-          <div class="status"><span class="pill">{{{{ status_text }}}}</span></div>
-        {{% endif %}}
-      </div>
-
-      <!-- RIGHT: Events -->
-      <div class="card">
-        <h2>Quick Events</h2>
-        <div class="sub">Send a quick animation trigger.</div>
-
-        <form method="post" action="/send">
-          <label>Target box</label>
-          <select name="target" required>
-            <option value="{{{{ box1 }}}}">{{{{ box1 }}}}</option>
-            <option value="{{{{ box2 }}}}">{{{{ box2 }}}}</option>
-          </select>
-
-          <input type="hidden" name="text" value="" />
-
-          <div class="eventGrid">
-            <button class="eventBtn pink"  name="event" value="heartbeat" type="submit">❤️ Heartbeat</button>
-            <button class="eventBtn"       name="event" value="rainbow"   type="submit">🌈 Rainbow</button>
-            <button class="eventBtn"       name="event" value="breathe"   type="submit">😌 Breathe</button>
-            <button class="eventBtn pink"  name="event" value="ping"      type="submit">✨ Ping</button>
-          </div>
-
-          <div class="small" style="margin-top:12px;">
-            Tip: emojis render on the box as tags like <code>[HEART]</code>.
-          </div>
-        </form>
-      </div>
-    </div>
-  </div>
-
-  <script>
-    function insertEmoji() {{
-      const select = document.getElementById("emojiSelect");
-      const tag = select.value;
-      if (!tag) return;
-
-      const box = document.getElementById("messageBox");
-      const start = box.selectionStart ?? box.value.length;
-      const end = box.selectionEnd ?? box.value.length;
-
-      box.value = box.value.slice(0, start) + tag + box.value.slice(end);
-      box.focus();
-
-      const newPos = start + tag.length;
-      box.setSelectionRange(newPos, newPos);
-      select.value = "";
-    }}
-
-    async function pollStatus() {{
-      const el = document.getElementById("msgId");
-      const pill = document.getElementById("statusPill");
-      if (!el || !pill) return;
-      const msgId = el.textContent.trim();
-      if (!msgId) return;
-
-      try {{
-        const r = await fetch("/status?msg_id=" + encodeURIComponent(msgId));
-        if (!r.ok) return;
-        const data = await r.json();
-        if (data && data.ok) {{
-          pill.textContent = data.status.toUpperCase();
-        }}
-      }} catch (e) {{}}
-    }}
-
-    if (document.getElementById("msgId")) {{
-      setInterval(pollStatus, 2000);
-    }}
-  </script>
-</body>
-</html>
-"""
-
-
-# =========================
-# APP
-# =========================
-app = Flask(__name__)
-app.secret_key = APP_SECRET
-
-
-# =========================
-# DB Helpers
-# =========================
-def db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA journal_mode=WAL;")
-    conn.execute("PRAGMA synchronous=NORMAL;")
-    return conn
-
-
-def init_db():
-    conn = db()
-    schema_path = os.path.join(BASE_DIR, "schema.sql")
-    with open(schema_path, "r", encoding="utf-8") as f:
-        conn.executescript(f.read())
-    conn.commit()
-
-    conn.execute(
-        "INSERT OR REPLACE INTO devices (box_id, token, paired_to) VALUES (?, ?, ?)",
-        (BOX1_ID, BOX1_TOKEN, BOX2_ID),
-    )
-    conn.execute(
-        "INSERT OR REPLACE INTO devices (box_id, token, paired_to) VALUES (?, ?, ?)",
-        (BOX2_ID, BOX2_TOKEN, BOX1_ID),
-    )
-    conn.commit()
-    conn.close()
-
-
-def auth_box(box_id: str, token: str):
-    conn = db()
-    row = conn.execute(
-        "SELECT box_id, token, paired_to FROM devices WHERE box_id = ?",
-        (box_id,),
-    ).fetchone()
-    conn.close()
-
-    if not row:
-        return None
-    if row["token"] != token:
-        return None
-    return {"box_id": row["box_id"], "paired_to": row["paired_to"]}
-
-
-def prune_queue(to_box: str):
-    """
-    Keep total messages for to_box <= MAX_QUEUE.
-    Delete oldest SEEN first, then oldest overall if needed.
-    """
-    conn = db()
-    total = conn.execute(
-        "SELECT COUNT(*) AS c FROM messages WHERE to_box=?",
-        (to_box,),
-    ).fetchone()["c"]
-
-    if total <= MAX_QUEUE:
-        conn.close()
-        return
-
-    while total > MAX_QUEUE:
-        seen_row = conn.execute(
-            "SELECT msg_id FROM messages WHERE to_box=? AND status='seen' ORDER BY created_at ASC LIMIT 1",
-            (to_box,),
-        ).fetchone()
-        if seen_row:
-            conn.execute("DELETE FROM messages WHERE msg_id=?", (seen_row["msg_id"],))
-            conn.commit()
-        else:
-            break
-
-        total = conn.execute(
-            "SELECT COUNT(*) AS c FROM messages WHERE to_box=?",
-            (to_box,),
-        ).fetchone()["c"]
-
-    while total > MAX_QUEUE:
-        row = conn.execute(
-            "SELECT msg_id FROM messages WHERE to_box=? ORDER BY created_at ASC LIMIT 1",
-            (to_box,),
-        ).fetchone()
-        if not row:
-            break
-        conn.execute("DELETE FROM messages WHERE msg_id=?", (row["msg_id"],))
-        conn.commit()
-        total -= 1
-
-    conn.close()
-
-
-def create_message(to_box: str, from_source: str, msg_type: str, msg_text: str = None, msg_event: str = None):
-    msg_id = secrets.token_hex(8)
-    now = int(time.time())
-
-    conn = db()
-    conn.execute(
-        """
-        INSERT INTO messages (msg_id, to_box, from_source, msg_type, msg_text, msg_event, status, created_at)
-        VALUES (?, ?, ?, ?, ?, ?, 'sent', ?)
-        """,
-        (msg_id, to_box, from_source, msg_type, msg_text, msg_event, now),
-    )
-    conn.commit()
-    conn.close()
-
-    prune_queue(to_box)
-    return msg_id
-
-
-try:
-    init_db()
-except Exception as e:
-    print("DB init failed:", repr(e))
-
-
-# =========================
-# Web UI (session protected)
-# =========================
-@app.get("/")
-def root():
-    if session.get("logged_in"):
-        return redirect(url_for("send_page"))
-    return redirect(url_for("login_page"))
-
-
-@app.get("/login")
-def login_page():
-    return render_template_string(LOGIN_HTML)
-
-
-@app.post("/login")
-def login_post():
-    pwd = request.form.get("password", "")
-    if pwd == WEB_PASSWORD:
-        session["logged_in"] = True
-        return redirect(url_for("send_page"))
-    return render_template_string(LOGIN_HTML, error="Wrong password")
-
-
-@app.get("/send")
-def send_page():
-    if not session.get("logged_in"):
-        return redirect(url_for("login_page"))
-    return render_template_string(SEND_HTML, box1=BOX1_ID, box2=BOX2_ID)
-
-
-@app.post("/send")
-def send_post():
-    if not session.get("logged_in"):
-        return redirect(url_for("login_page"))
-
-    target = request.form.get("target", "")
-    text = (request.form.get("text", "") or "").strip()
-    event = (request.form.get("event", "") or "").strip()
-
-    if target not in (BOX1_ID, BOX2_ID):
-        return render_template_string(SEND_HTML, box1=BOX1_ID, box2=BOX2_ID, status_text="Invalid target")
-
-    if event:
-        if event not in ("heartbeat", "rainbow", "breathe", "ping"):
-            return render_template_string(SEND_HTML, box1=BOX1_ID, box2=BOX2_ID, status_text="Invalid event")
-        msg_id = create_message(target, "web", "event", msg_event=event)
-        return render_template_string(SEND_HTML, box1=BOX1_ID, box2=BOX2_ID, msg_id=msg_id, status_text="SENT")
-
-    if not text:
-        return render_template_string(SEND_HTML, box1=BOX1_ID, box2=BOX2_ID, status_text="Type a message first")
-
-    msg_id = create_message(target, "web", "text", msg_text=text)
-    return render_template_string(SEND_HTML, box1=BOX1_ID, box2=BOX2_ID, msg_id=msg_id, status_text="SENT")
-
-
-@app.get("/status")
-def web_status():
-    if not session.get("logged_in"):
-        abort(401)
-
-    msg_id = request.args.get("msg_id", "")
-    if not msg_id:
-        return jsonify({"ok": False, "error": "missing_msg_id"}), 400
-
-    conn = db()
-    row = conn.execute(
-        "SELECT status, created_at, delivered_at, seen_at FROM messages WHERE msg_id=?",
-        (msg_id,),
-    ).fetchone()
-    conn.close()
-
-    if not row:
-        return jsonify({"ok": False, "error": "not_found"}), 404
-
-    return jsonify({
-        "ok": True,
-        "status": row["status"],
-        "created_at": row["created_at"],
-        "delivered_at": row["delivered_at"],
-        "seen_at": row["seen_at"],
-    })
-
-
-# =========================
-# API for Love Boxes
-# =========================
-@app.post("/api/register")
-def api_register():
-    data = request.get_json(force=True, silent=True) or {}
-    box_id = data.get("box_id", "")
-    token = data.get("token", "")
-    info = auth_box(box_id, token)
-    if not info:
-        return jsonify({"ok": False, "error": "auth_failed"}), 401
-    return jsonify({"ok": True, "paired_to": info["paired_to"]})
-
-
-@app.get("/api/pending_count")
-def api_pending_count():
-    box_id = request.args.get("box_id", "")
-    token = request.args.get("token", "")
-    info = auth_box(box_id, token)
-    if not info:
-        return jsonify({"ok": False, "error": "auth_failed"}), 401
-
-    conn = db()
-    row = conn.execute(
-        "SELECT COUNT(*) AS c FROM messages WHERE to_box=? AND status IN ('sent','delivered')",
-        (box_id,),
-    ).fetchone()
-    conn.close()
-    return jsonify({"ok": True, "count": row["c"]})
-
-
-@app.get("/api/check")
-def api_check():
-    box_id = request.args.get("box_id", "")
-    token = request.args.get("token", "")
-    info = auth_box(box_id, token)
-    if not info:
-        return jsonify({"ok": False, "error": "auth_failed"}), 401
-
-    conn = db()
-    row = conn.execute(
-        """
-        SELECT * FROM messages
-        WHERE to_box=? AND status IN ('sent','delivered')
-        ORDER BY created_at ASC
-        LIMIT 1
-        """,
-        (box_id,),
-    ).fetchone()
-
-    if not row:
-        conn.close()
-        return jsonify({"ok": True, "has": False})
-
-    now = int(time.time())
-    if row["status"] == "sent":
-        conn.execute(
-            "UPDATE messages SET status='delivered', delivered_at=? WHERE msg_id=?",
-            (now, row["msg_id"]),
-        )
-        conn.commit()
-
-    row2 = conn.execute(
-        "SELECT * FROM messages WHERE msg_id=?",
-        (row["msg_id"],),
-    ).fetchone()
-    conn.close()
-
-    return jsonify({
-        "ok": True,
-        "has": True,
-        "msg_id": row2["msg_id"],
-        "type": row2["msg_type"],
-        "text": row2["msg_text"],
-        "event": row2["msg_event"],
-        "status": row2["status"],
-        "created_at": row2["created_at"],
-        "delivered_at": row2["delivered_at"],
-        "seen_at": row2["seen_at"],
-    })
-
-
-@app.post("/api/ack")
-def api_ack():
-    data = request.get_json(force=True, silent=True) or {}
-    box_id = data.get("box_id", "")
-    token = data.get("token", "")
-    msg_id = data.get("msg_id", "")
-
-    info = auth_box(box_id, token)
-    if not info:
-        return jsonify({"ok": False, "error": "auth_failed"}), 401
-
-    conn = db()
-    row = conn.execute(
-        "SELECT msg_id, to_box, status FROM messages WHERE msg_id=?",
-        (msg_id,),
-    ).fetchone()
-
-    if not row:
-        conn.close()
-        return jsonify({"ok": True})
-
-    if row["to_box"] != box_id:
-        conn.close()
-        return jsonify({"ok": False, "error": "wrong_box"}), 403
-
-    now = int(time.time())
-    conn.execute(
-        "UPDATE messages SET status='seen', seen_at=? WHERE msg_id=?",
-        (now, msg_id),
-    )
-    conn.commit()
-    conn.close()
-
-    prune_queue(box_id)
-    return jsonify({"ok": True})
-
-
-@app.post("/api/send_event")
-def api_send_event():
-    data = request.get_json(force=True, silent=True) or {}
-    box_id = data.get("box_id", "")
-    token = data.get("token", "")
-    event = (data.get("event", "") or "").strip()
-
-    info = auth_box(box_id, token)
-    if not info:
-        return jsonify({"ok": False, "error": "auth_failed"}), 401
-
-    allowed = ("heartbeat", "rainbow", "breathe", "ping")
-    if event not in allowed:
-        return jsonify({"ok": False, "error": "bad_event", "allowed": list(allowed)}), 400
-
-    target = info["paired_to"]
-    msg_id = create_message(target, "device", "event", msg_event=event)
-    return jsonify({"ok": True, "sent_to": target, "msg_id": msg_id})
-
-
-@app.get("/health")
-def health():
-    return jsonify({"ok": True})
-
-
-if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+import os
+import atexit
+import collections
+import csv
+import glob
+import hashlib
+import heapq
+import hmac
+import json
+import math
+import queue
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+import secrets
+import socket
+from contextlib import contextmanager
+from datetime import datetime
+import click
+try:
+    import fcntl
+except ImportError:  # Windows: no flock, so every process runs DB maintenance
+    fcntl = None
+try:
+    import redis
+except ImportError:  # only needed for NOTIFY_BUS=redis
+    redis = None
+from flask import Flask, Response, request, jsonify, redirect, url_for, session, render_template, abort, g, has_app_context
+from markupsafe import Markup, escape
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+# =========================
+# CONFIG (from Environment)
+# =========================
+APP_SECRET   = os.environ.get("APP_SECRET",   "dev-secret-change-me")
+WEB_PASSWORD = os.environ.get("WEB_PASSWORD", "dev-password-change-me")
+
+BOX1_ID    = os.environ.get("BOX1_ID",    "bryce_box")
+BOX1_TOKEN = os.environ.get("BOX1_TOKEN", "dev_token_box1")
+BOX2_ID    = os.environ.get("BOX2_ID",    "amanda_box")
+BOX2_TOKEN = os.environ.get("BOX2_TOKEN", "dev_token_box2")
+
+DB_PATH = os.environ.get("DB_PATH", "lovebox.db")
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+MAX_QUEUE = 5  # per box
+
+# Per-worker SQLite connection pool
+DB_POOL_SIZE    = int(os.environ.get("DB_POOL_SIZE", "8"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "10"))  # seconds to wait for a free connection
+DB_BUSY_TIMEOUT = float(os.environ.get("DB_BUSY_TIMEOUT", "5"))   # seconds to wait out "database is locked"
+DB_SLOW_STATEMENT = float(os.environ.get("DB_SLOW_STATEMENT", "0.05"))  # seconds; slower statements are counted
+
+# Pure reads (status, counts, versions, the check pre-read) use their own
+# query_only connections. READ_SNAPSHOT > 0 additionally serves /status polls
+# from an in-memory copy of the database refreshed at most that often.
+DB_READ_POOL_SIZE = int(os.environ.get("DB_READ_POOL_SIZE", str(DB_POOL_SIZE)))
+READ_SNAPSHOT     = float(os.environ.get("READ_SNAPSHOT", "0"))  # seconds; 0 = off
+
+# Background database maintenance, run by one worker at a time
+MAINTENANCE_INTERVAL = float(os.environ.get("MAINTENANCE_INTERVAL", "30"))  # seconds between passes; 0 = off
+WAL_CHECKPOINT_BYTES = int(os.environ.get("WAL_CHECKPOINT_BYTES", str(4 << 20)))   # PASSIVE checkpoint past this
+WAL_TRUNCATE_BYTES   = int(os.environ.get("WAL_TRUNCATE_BYTES", str(64 << 20)))   # TRUNCATE checkpoint past this
+VACUUM_PAGES         = int(os.environ.get("VACUUM_PAGES", "256"))       # free pages returned per pass
+ANALYZE_INTERVAL     = float(os.environ.get("ANALYZE_INTERVAL", "3600"))  # seconds between ANALYZE runs
+
+# Sharded SQLite store: with DB_SHARDS > 1 message queues are spread over that
+# many files next to DB_PATH (lovebox-shard0.db, ...) by box; devices stay in
+# DB_PATH. Queued messages don't move when the shard count changes.
+DB_SHARDS = max(1, min(int(os.environ.get("DB_SHARDS", "1")), 256))
+
+# Message store engine: "sqlite" (default) or "memory". The memory engine is
+# single-process (one worker, not --preload; a second process refuses to
+# start); give it MEMORY_STORE_DIR to survive restarts and crashes.
+STORE            = os.environ.get("STORE", "sqlite")
+MEMORY_STORE_DIR = os.environ.get("MEMORY_STORE_DIR", "")
+MEMORY_FLUSH     = float(os.environ.get("MEMORY_FLUSH", "0.2"))   # seconds between op-log flushes
+MEMORY_SNAPSHOT  = float(os.environ.get("MEMORY_SNAPSHOT", "60")) # seconds between snapshots
+
+# Group commit (SQLite store): with GROUP_COMMIT=1 message inserts and acks go
+# through one writer thread per worker that commits them in batches of up to
+# GROUP_COMMIT_MAX, collected for at most GROUP_COMMIT_WAIT after the first.
+# That thread already serialises the writes, so WRITE_CONCURRENCY is not
+# applied on top (its slots would cap every batch at WRITE_CONCURRENCY).
+GROUP_COMMIT      = os.environ.get("GROUP_COMMIT", "0") == "1"
+GROUP_COMMIT_MAX  = int(os.environ.get("GROUP_COMMIT_MAX", "64"))
+GROUP_COMMIT_WAIT = float(os.environ.get("GROUP_COMMIT_WAIT", "0.002"))  # seconds
+
+# Per-worker device credential cache
+AUTH_CACHE_TTL = float(os.environ.get("AUTH_CACHE_TTL", "300"))  # seconds
+
+# Per-box queue versions are served from memory for this long between DB reads
+VERSION_CACHE_TTL = float(os.environ.get("VERSION_CACHE_TTL", "1"))  # seconds
+
+# Metrics (/metrics). With METRICS_DIR set, every worker flushes its counters
+# there and /metrics sums all of them, so gunicorn workers report as one.
+METRICS_DIR   = os.environ.get("METRICS_DIR", "")
+METRICS_FLUSH = float(os.environ.get("METRICS_FLUSH", "1"))  # seconds between flushes
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")         # optional bearer token for /metrics
+
+# Long-polling (/api/check?wait=N). Kept under gunicorn's 30s worker timeout.
+LONGPOLL_MAX_WAIT = float(os.environ.get("LONGPOLL_MAX_WAIT", "25"))  # seconds
+
+# Batched device API (/api/check?max=N, /api/ack with msg_ids)
+MAX_BATCH = int(os.environ.get("MAX_BATCH", "50"))
+
+# Broadcasts (/broadcast): one message to many boxes in a single transaction
+BROADCAST_MAX = int(os.environ.get("BROADCAST_MAX", "1000"))  # most targets per broadcast
+
+# Scheduled messages (deliver_at): a per-worker timer heap releases them when
+# due, and re-reads pending due times from the store every SCHEDULE_RESCAN
+# (picking up other workers' schedules); 0 = only at startup.
+SCHEDULE_MAX_DAYS = float(os.environ.get("SCHEDULE_MAX_DAYS", "366"))  # furthest ahead a message may be scheduled
+SCHEDULE_RESCAN   = float(os.environ.get("SCHEDULE_RESCAN", "60"))     # seconds
+
+# Admission control for message writes (/api/send_event, /send). Token
+# buckets refill at *_RATE per second up to *_BURST; a rate of 0 turns that
+# limit off. RATE_LIMIT_STORE=sqlite keeps buckets in RATE_LIMIT_DB so every
+# worker draws from the same ones. WRITE_CONCURRENCY caps concurrent message
+# writes across all workers on the host (one flock'd slot file each in
+# WRITE_SLOTS_DIR; per worker where flock is missing); a write that can't get
+# a slot within WRITE_WAIT is refused. Off with GROUP_COMMIT (see above).
+BOX_RATE          = float(os.environ.get("BOX_RATE", "1"))    # events/sec per box
+BOX_BURST         = float(os.environ.get("BOX_BURST", "5"))
+WEB_RATE          = float(os.environ.get("WEB_RATE", "1"))    # sends/sec per web session
+WEB_BURST         = float(os.environ.get("WEB_BURST", "10"))
+RATE_LIMIT_STORE  = os.environ.get("RATE_LIMIT_STORE", "memory")
+RATE_LIMIT_DB     = os.environ.get("RATE_LIMIT_DB", DB_PATH + "-ratelimit")
+WRITE_CONCURRENCY = int(os.environ.get("WRITE_CONCURRENCY", "4"))
+WRITE_WAIT        = float(os.environ.get("WRITE_WAIT", "1"))  # seconds
+WRITE_SLOTS_DIR   = os.environ.get("WRITE_SLOTS_DIR", DB_PATH + "-write-slots")
+
+# Compact wire format (/api/v2/*): encoded message bodies kept per worker
+WIRE_CACHE_SIZE = int(os.environ.get("WIRE_CACHE_SIZE", "4096"))
+
+# Cross-worker change notification: "box X changed" events from each write
+# reach the other workers, so their long-polls and streams wake at once.
+# NOTIFY_BUS=local: a Unix datagram socket per worker in BUS_DIR (one host);
+# redis: a pub/sub channel at BUS_URL (needs the redis package); off.
+NOTIFY_BUS   = os.environ.get("NOTIFY_BUS", "local")
+BUS_DIR      = os.environ.get("BUS_DIR", DB_PATH + "-bus")
+BUS_URL      = os.environ.get("BUS_URL", "redis://localhost:6379/0")
+BUS_COALESCE = float(os.environ.get("BUS_COALESCE", "0.005"))  # seconds a publish waits for the rest of a burst
+
+# Server-Sent Events (/api/stream, /status?stream=1). An open stream holds
+# its worker for as long as it lasts, so serve them from a threaded or async
+# worker (gunicorn -k gthread --threads N, or asgi.py). On a single-threaded
+# worker (gunicorn's default sync) every stream is cut at SYNC_STREAM_MAX,
+# short of the worker timeout, and the client reconnects (EventSource does
+# this by itself, resuming from Last-Event-ID).
+SSE_HEARTBEAT = float(os.environ.get("SSE_HEARTBEAT", "15"))  # seconds between keep-alive comments
+SSE_RETRY_MS  = int(os.environ.get("SSE_RETRY_MS", "3000"))   # client reconnect delay hint
+STATUS_STREAM_MAX = float(os.environ.get("STATUS_STREAM_MAX", "300"))  # /status?stream=1 lifetime before the browser reconnects
+SYNC_STREAM_MAX   = float(os.environ.get("SYNC_STREAM_MAX", "25"))     # stream lifetime on a single-threaded worker
+
+
+# =========================
+# INLINE HTML (NO TEMPLATES)
+# =========================
+
+THEME_HEAD = """
+  <meta charset="utf-8" />
+  <meta name="viewport" content="width=device-width, initial-scale=1" />
+  <link rel="preconnect" href="https://fonts.googleapis.com">
+  <link rel="preconnect" href="https://fonts.gstatic.com" crossorigin>
+  <link href="https://fonts.googleapis.com/css2?family=Poppins:wght@400;500;600;700&display=swap" rel="stylesheet">
+  <style>
+    :root{
+      --bg: #07060a;          /* near-black */
+      --panel: #0f0b16;       /* dark purple-black */
+      --panel2: #120d1c;
+      --text: #ffffff;
+      --muted: rgba(255,255,255,.72);
+      --muted2: rgba(255,255,255,.55);
+      --border: rgba(255,255,255,.10);
+
+      --purple: #7c3aed;      /* violet */
+      --pink: #ff4fd8;        /* neon pink */
+      --pink2:#ff2fbf;
+
+      --ok: #22c55e;
+      --bad: #ef4444;
+      --warn:#fbbf24;
+
+      --radius: 16px;
+      --shadow: 0 10px 30px rgba(0,0,0,.35);
+      --shadow2: 0 1px 0 rgba(255,255,255,.05) inset;
+
+      --ring: 0 0 0 3px rgba(255,79,216,.25);
+    }
+
+    * { box-sizing: border-box; }
+    html, body { height: 100%; }
+    body {
+      margin: 0;
+      font-family: "Poppins", system-ui, -apple-system, Segoe UI, Roboto, sans-serif;
+      background:
+        radial-gradient(900px 420px at 15% 0%, rgba(124,58,237,.22), transparent 55%),
+        radial-gradient(900px 420px at 85% 0%, rgba(255,79,216,.18), transparent 55%),
+        linear-gradient(180deg, #06050a, var(--bg));
+      color: var(--text);
+    }
+
+    .wrap{
+      max-width: 920px;
+      margin: 0 auto;
+      padding: 22px 14px 48px;
+    }
+
+    .brand{
+      display:flex;
+      align-items:center;
+      gap:10px;
+      margin: 8px 0 14px;
+    }
+    .logo{
+      width: 38px; height: 38px;
+      border-radius: 12px;
+      background:
+        linear-gradient(135deg, rgba(124,58,237,.95), rgba(255,79,216,.95));
+      box-shadow: var(--shadow);
+    }
+    h1, h2{
+      margin: 0;
+      letter-spacing: -0.02em;
+    }
+    h1{ font-size: 20px; font-weight: 700; }
+    h2{ font-size: 18px; font-weight: 700; }
+
+    .sub{
+      margin: 6px 0 0;
+      color: var(--muted);
+      font-size: 13px;
+      line-height: 1.35;
+    }
+
+    .grid{
+      display: grid;
+      grid-template-columns: 1fr;
+      gap: 14px;
+      margin-top: 14px;
+    }
+    @media (min-width: 860px){
+      .grid{ grid-template-columns: 1.25fr .75fr; gap: 16px; }
+      .grid .wide{ grid-column: 1 / -1; }
+    }
+
+    .card{
+      background: linear-gradient(180deg, rgba(255,255,255,.04), rgba(255,255,255,.02));
+      border: 1px solid var(--border);
+      border-radius: var(--radius);
+      box-shadow: var(--shadow), var(--shadow2);
+      padding: 16px;
+    }
+
+    label{
+      display:block;
+      font-size: 12px;
+      font-weight: 600;
+      color: var(--muted);
+      margin-top: 12px;
+      margin-bottom: 6px;
+      letter-spacing: .02em;
+      text-transform: uppercase;
+    }
+
+    input, textarea, select{
+      width: 100%;
+      padding: 12px 12px;
+      border-radius: 14px;
+      border: 1px solid rgba(255,255,255,.12);
+      background: rgba(10,8,14,.75);
+      color: var(--text);
+      outline: none;
+      font-size: 15px;
+      box-shadow: 0 0 0 1px rgba(0,0,0,.2) inset;
+    }
+    textarea{ min-height: 120px; resize: vertical; }
+    input::placeholder, textarea::placeholder{ color: rgba(255,255,255,.45); }
+
+    input:focus, textarea:focus, select:focus{
+      border-color: rgba(255,79,216,.55);
+      box-shadow: var(--ring);
+    }
+
+    .row{
+      display:flex;
+      gap: 10px;
+      align-items: center;
+      flex-wrap: wrap;
+    }
+
+    .btn{
+      width: 100%;
+      padding: 12px 14px;
+      border: 0;
+      border-radius: 14px;
+      font-weight: 700;
+      font-size: 15px;
+      cursor: pointer;
+      color: white;
+      background: linear-gradient(135deg, rgba(124,58,237,1), rgba(255,79,216,1));
+      box-shadow: 0 10px 24px rgba(124,58,237,.14), 0 10px 24px rgba(255,79,216,.10);
+      transition: transform .06s ease, filter .12s ease;
+      user-select: none;
+      -webkit-tap-highlight-color: transparent;
+    }
+    .btn:active{ transform: translateY(1px); filter: brightness(.98); }
+
+    .btn.secondary{
+      background: rgba(255,255,255,.06);
+      border: 1px solid rgba(255,255,255,.14);
+      box-shadow: none;
+      font-weight: 600;
+      color: var(--text);
+    }
+
+    .btn.ghost{
+      background: rgba(255,255,255,.04);
+      border: 1px solid rgba(255,255,255,.12);
+      box-shadow: none;
+      font-weight: 700;
+    }
+
+    .btn.small{
+      width: auto;
+      padding: 10px 12px;
+      border-radius: 12px;
+      font-size: 14px;
+    }
+
+    .inline{
+      display:flex;
+      gap:10px;
+      align-items: center;
+      flex-wrap: wrap;
+    }
+    .inline select{ flex: 1; min-width: 220px; }
+    .inline .btn.small{ flex: 0 0 auto; }
+
+    .status{
+      margin-top: 14px;
+      padding: 12px;
+      border-radius: 14px;
+      background: rgba(0,0,0,.28);
+      border: 1px solid rgba(255,255,255,.10);
+    }
+
+    .pill{
+      display:inline-flex;
+      align-items:center;
+      gap:8px;
+      padding: 6px 10px;
+      border-radius: 999px;
+      font-size: 12px;
+      font-weight: 700;
+      background: rgba(255,255,255,.06);
+      border: 1px solid rgba(255,255,255,.10);
+    }
+
+    code{
+      font-family: ui-monospace, SFMono-Regular, Menlo, Monaco, Consolas, "Liberation Mono", "Courier New", monospace;
+      font-size: 12px;
+      padding: 2px 6px;
+      border-radius: 8px;
+      background: rgba(0,0,0,.35);
+      border: 1px solid rgba(255,255,255,.10);
+      color: rgba(255,255,255,.9);
+    }
+
+    .small{
+      font-size: 12px;
+      color: var(--muted2);
+      margin-top: 10px;
+      line-height: 1.35;
+    }
+
+    .err{
+      margin-top: 10px;
+      color: #ffd1dc;
+      background: rgba(239,68,68,.12);
+      border: 1px solid rgba(239,68,68,.20);
+      padding: 10px;
+      border-radius: 12px;
+      font-weight: 600;
+      font-size: 13px;
+    }
+
+    .eventGrid{
+      display:grid;
+      grid-template-columns: 1fr 1fr;
+      gap: 10px;
+      margin-top: 10px;
+    }
+
+    .eventBtn{
+      padding: 12px 12px;
+      border-radius: 14px;
+      border: 1px solid rgba(255,255,255,.14);
+      background: rgba(255,255,255,.06);
+      color: white;
+      font-weight: 700;
+      cursor: pointer;
+      transition: transform .06s ease, filter .12s ease;
+    }
+    .eventBtn:active{ transform: translateY(1px); }
+
+    .eventBtn.pink{
+      background: linear-gradient(135deg, rgba(255,79,216,1), rgba(124,58,237,1));
+      border: 0;
+    }
+
+    .hintRow{
+      display:flex;
+      justify-content: space-between;
+      gap: 10px;
+      flex-wrap: wrap;
+      margin-top: 10px;
+    }
+    .hintRow .small{ margin-top: 0; }
+  </style>
+"""
+
+LOGIN_HTML = f"""<!doctype html>
+<html>
+<head>
+{THEME_HEAD}
+  <title>Love Box • Login</title>
+</head>
+<body>
+  <div class="wrap">
+    <div class="brand">
+      <div class="logo" aria-hidden="true"></div>
+      <div>
+        <h1>Love Box</h1>
+        <div class="sub">Enter the password to send messages & events.</div>
+      </div>
+    </div>
+
+    <div class="card">
+      <form method="post" action="/login">
+        <label>Password</label>
+        <input type="password" name="password" placeholder="Password" required />
+        <button class="btn" type="submit">Login</button>
+      </form>
+
+      {{% if error %}}<div class="err">{{{{ error }}}}</div>{{% endif %}}
+
+      <div class="small">Tip: bookmark <code>/send</code> after logging in.</div>
+    </div>
+  </div>
+</body>
+</html>
+"""
+
+SEND_HTML = f"""<!doctype html>
+<html>
+<head>
+{THEME_HEAD}
+  <title>Love Box • Send</title>
+</head>
+<body>
+  <datalist id="groupList">
+    {{{{ group_options }}}}
+  </datalist>
+
+  <div class="wrap">
+    <div class="brand">
+      <div class="logo" aria-hidden="true"></div>
+      <div>
+        <h1>Send Love</h1>
+        <div class="sub">Queue v2 (max {MAX_QUEUE}). Status: Sent → Delivered → Seen.</div>
+      </div>
+    </div>
+
+    <div class="grid">
+      <!-- LEFT: Message -->
+      <div class="card">
+        <h2>Message</h2>
+        <div class="sub">Pick a box, write a message, drop an emoji tag, send.</div>
+
+        <form method="post" action="/send" id="msgForm">
+          <label>Group (empty for ungrouped boxes)</label>
+          <input class="groupPick" list="groupList" value="default" autocomplete="off" />
+
+          <label>Target box</label>
+          <select name="target" class="boxPick" required></select>
+
+          <label>Message</label>
+          <textarea id="messageBox" name="text" rows="4" placeholder="Type something sweet…"></textarea>
+
+          <label>Emoji picker</label>
+          <div class="inline">
+            <select id="emojiSelect">
+              <option value="">Select an emoji…</option>
+              <option value="[BEER]">🍺 BEER</option>
+              <option value="[BREAD]">🍞 BREAD</option>
+              <option value="[CRY]">😭 CRY</option>
+              <option value="[GLIZZY]">🌭 GLIZZY</option>
+              <option value="[HEART]">❤️ HEART</option>
+              <option value="[JOY]">🥹 JOY</option>
+              <option value="[KISS]">😘 KISS</option>
+              <option value="[LOVE]">🥰 LOVE</option>
+              <option value="[MAIL]">📫 MAIL</option>
+              <option value="[PANDA]">🐼 PANDA</option>
+              <option value="[SMILE]">😀 SMILE</option>
+              <option value="[SUSHI]">🍣 SUSHI</option>
+              <option value="[UPSIDEDOWN]">🙃 UPSIDEDOWN</option>
+              <option value="[WORM]">🪱 WORM</option>
+            </select>
+
+            <button class="btn ghost small" type="button" onclick="insertEmoji()">Insert</button>
+          </div>
+
+          <label>Deliver at (optional, your local time)</label>
+          <input type="datetime-local" class="deliverLocal" />
+          <input type="hidden" name="deliver_at" value="" />
+
+          <button class="btn" type="submit" style="margin-top:12px;">Send Message</button>
+        </form>
+
+        {{% if msg_id %}}
+          <div class="status">
+            <div class="hintRow">
+              <div class="small"><strong>Message ID:</strong> <code id="msgId">{{{{ msg_id }}}}</code></div>
+              <div class="small"><strong>Status:</strong> <span class="pill" id="statusPill">{{{{ status_text }}}}</span></div>
+            </div>
+            <div class="small">This updates automatically.</div>
+          </div>
+        {{% elif status_text %}}
+          <div class="status"><span class="pill">{{{{ status_text }}}}</span></div>
+        {{% endif %}}
+      </div>
+
+      <!-- RIGHT: Events -->
+      <div class="card">
+        <h2>Quick Events</h2>
+        <div class="sub">Send a quick animation trigger.</div>
+
+        <form method="post" action="/send">
+          <label>Group (empty for ungrouped boxes)</label>
+          <input class="groupPick" list="groupList" value="default" autocomplete="off" />
+
+          <label>Target box</label>
+          <select name="target" class="boxPick" required></select>
+
+          <input type="hidden" name="text" value="" />
+
+          <div class="eventGrid">
+            <button class="eventBtn pink"  name="event" value="heartbeat" type="submit">❤️ Heartbeat</button>
+            <button class="eventBtn"       name="event" value="rainbow"   type="submit">🌈 Rainbow</button>
+            <button class="eventBtn"       name="event" value="breathe"   type="submit">😌 Breathe</button>
+            <button class="eventBtn pink"  name="event" value="ping"      type="submit">✨ Ping</button>
+          </div>
+
+          <div class="small" style="margin-top:12px;">
+            Tip: emojis render on the box as tags like <code>[HEART]</code>.
+          </div>
+        </form>
+      </div>
+
+      <!-- BOTTOM: Broadcast -->
+      <div class="card wide">
+        <h2>Broadcast</h2>
+        <div class="sub">One message or event to a whole group and/or any boxes you pick (up to {BROADCAST_MAX}).</div>
+
+        <form method="post" action="/broadcast">
+          <label>Whole group</label>
+          <input name="group" list="groupList" placeholder="No group" autocomplete="off" />
+
+          <label>Boxes from a group (Ctrl/Cmd-click for several)</label>
+          <input class="groupPick" list="groupList" value="default" autocomplete="off" />
+          <select name="targets" class="boxPick" multiple size="5"></select>
+
+          <label>Message</label>
+          <textarea name="text" rows="2" placeholder="Same words for everyone…"></textarea>
+
+          <label>Or an event</label>
+          <select name="event">
+            <option value="">No event (send the message)</option>
+            <option value="heartbeat">❤️ Heartbeat</option>
+            <option value="rainbow">🌈 Rainbow</option>
+            <option value="breathe">😌 Breathe</option>
+            <option value="ping">✨ Ping</option>
+          </select>
+
+          <label>Deliver at (optional, your local time)</label>
+          <input type="datetime-local" class="deliverLocal" />
+          <input type="hidden" name="deliver_at" value="" />
+
+          <button class="btn" type="submit" style="margin-top:12px;">Broadcast</button>
+        </form>
+
+        {{% if broadcast_id %}}
+          <div class="status">
+            <div class="hintRow">
+              <div class="small"><strong>Broadcast ID:</strong> <code id="broadcastId">{{{{ broadcast_id }}}}</code></div>
+              <div class="small"><strong>Status:</strong> <span class="pill" id="broadcastPill">{{{{ broadcast_text }}}}</span></div>
+            </div>
+            <div class="small">This updates automatically.</div>
+          </div>
+        {{% elif broadcast_text %}}
+          <div class="status"><span class="pill">{{{{ broadcast_text }}}}</span></div>
+        {{% endif %}}
+      </div>
+    </div>
+  </div>
+
+  <script>
+    function insertEmoji() {{
+      const select = document.getElementById("emojiSelect");
+      const tag = select.value;
+      if (!tag) return;
+
+      const box = document.getElementById("messageBox");
+      const start = box.selectionStart ?? box.value.length;
+      const end = box.selectionEnd ?? box.value.length;
+
+      box.value = box.value.slice(0, start) + tag + box.value.slice(end);
+      box.focus();
+
+      const newPos = start + tag.length;
+      box.setSelectionRange(newPos, newPos);
+      select.value = "";
+    }}
+
+    async function pollStatus(msgId, pill) {{
+      try {{
+        const r = await fetch("/status?msg_id=" + encodeURIComponent(msgId));
+        if (!r.ok) return r.status === 404 ? "gone" : null;
+        const data = await r.json();
+        if (data && data.ok) {{
+          pill.textContent = data.status.toUpperCase();
+          return data.status;
+        }}
+      }} catch (e) {{}}
+      return null;
+    }}
+
+    function watchStatus() {{
+      const el = document.getElementById("msgId");
+      const pill = document.getElementById("statusPill");
+      if (!el || !pill) return;
+      const msgId = el.textContent.trim();
+      if (!msgId) return;
+
+      // Old browsers: fall back to polling, but stop once there is nothing left to see.
+      if (!window.EventSource) {{
+        const timer = setInterval(async () => {{
+          const s = await pollStatus(msgId, pill);
+          if (s === "seen" || s === "gone") clearInterval(timer);
+        }}, 2000);
+        return;
+      }}
+
+      const es = new EventSource("/status?stream=1&msg_id=" + encodeURIComponent(msgId));
+      es.addEventListener("status", (e) => {{
+        const data = JSON.parse(e.data);
+        pill.textContent = data.status.toUpperCase();
+        if (data.status === "seen") es.close();
+      }});
+      es.addEventListener("gone", () => es.close());
+    }}
+
+    function showBroadcast(pill, data) {{
+      pill.textContent = (data.scheduled ? data.scheduled + " SCHEDULED · " : "") +
+        data.delivered + " DELIVERED · " + data.seen + "/" + data.total + " SEEN";
+      return data.seen === data.total;
+    }}
+
+    function watchBroadcast() {{
+      const el = document.getElementById("broadcastId");
+      const pill = document.getElementById("broadcastPill");
+      if (!el || !pill) return;
+      const url = "/status?broadcast_id=" + encodeURIComponent(el.textContent.trim());
+
+      // Old browsers: poll, backing off to 30s and giving up after 10 minutes.
+      if (!window.EventSource) {{
+        let delay = 2000;
+        const giveUp = Date.now() + 600000;
+        const poll = async () => {{
+          try {{
+            const r = await fetch(url);
+            if (r.status === 404) return;
+            if (r.ok && showBroadcast(pill, await r.json())) return;
+          }} catch (e) {{}}
+          delay = Math.min(delay * 1.5, 30000);
+          if (Date.now() < giveUp) setTimeout(poll, delay);
+        }};
+        poll();
+        return;
+      }}
+
+      // Counts across every target; the stream ends once all are seen or the rows are gone.
+      const es = new EventSource(url + "&stream=1");
+      es.addEventListener("status", (e) => {{
+        if (showBroadcast(pill, JSON.parse(e.data))) es.close();
+      }});
+      es.addEventListener("gone", () => es.close());
+    }}
+
+    // Boxes are fetched per group, so the page never lists the whole fleet.
+    async function loadBoxes(groupPick) {{
+      const boxPick = groupPick.form.querySelector(".boxPick");
+      try {{
+        const r = await fetch("/boxes?group=" + encodeURIComponent(groupPick.value));
+        if (!r.ok) return;
+        const data = await r.json();
+        if (data.group !== groupPick.value) return;  // a later pick is already loading
+        boxPick.replaceChildren(...data.boxes.map((id) => new Option(id, id)));
+      }} catch (e) {{}}
+    }}
+
+    document.querySelectorAll(".groupPick").forEach((pick) => {{
+      pick.addEventListener("change", () => loadBoxes(pick));
+      loadBoxes(pick);
+    }});
+
+    // datetime-local is the browser's wall clock; send the server an absolute time.
+    document.querySelectorAll("form").forEach((form) => {{
+      const local = form.querySelector(".deliverLocal");
+      if (!local) return;
+      form.addEventListener("submit", () => {{
+        form.elements["deliver_at"].value = local.value ? Math.floor(new Date(local.value).getTime() / 1000) : "";
+      }});
+    }});
+
+    watchStatus();
+    watchBroadcast();
+  </script>
+</body>
+</html>
+"""
+
+
+# =========================
+# APP
+# =========================
+app = Flask(__name__)
+app.secret_key = APP_SECRET
+
+
+class WorkerThreads:
+    """
+    Base for objects that run background threads in each worker. start()
+    runs _start() once per process: threads don't survive a fork, so a
+    gunicorn worker starts its own even if the master already had them.
+    """
+
+    def __init__(self):
+        self._started_pid = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        pid = os.getpid()
+        if self._started_pid == pid:
+            return
+        with self._start_lock:
+            if self._started_pid == pid:
+                return
+            self._started_pid = pid
+            self._start()
+
+    def _start(self):
+        raise NotImplementedError
+
+
+# =========================
+# Metrics
+# =========================
+LATENCY_BUCKETS  = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+DELIVERY_BUCKETS = (1, 2, 5, 10, 30, 60, 300, 900, 3600, 21600, 86400)
+BATCH_BUCKETS    = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+class Metrics(WorkerThreads):
+    """
+    In-process counters and histograms. Label sets are stored as JSON keys
+    so a snapshot can be written to METRICS_DIR and merged by whichever
+    worker serves /metrics; start() runs this worker's flush loop.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name: str, labels: tuple = (), n: float = 1):
+        key = json.dumps(labels)
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + n
+
+    def observe(self, name: str, value: float, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        key = json.dumps(labels)
+        with self._lock:
+            series = self.histograms.setdefault(name, {})
+            h = series.get(key)
+            if h is None:
+                h = series[key] = {"le": list(buckets), "counts": [0] * len(buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(h["le"]):
+                if value <= bound:
+                    h["counts"][i] += 1
+                    break
+            h["sum"] += value
+            h["count"] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            snap = json.loads(json.dumps({"counters": self.counters, "histograms": self.histograms}))
+        with _db_stats_lock:
+            snap["counters"]["lovebox_sqlite_slow_statements_total"] = {"[]": DB_STATS["slow_statements"]}
+            snap["counters"]["lovebox_sqlite_lock_timeouts_total"] = {"[]": DB_STATS["lock_timeouts"]}
+        return snap
+
+    def flush(self):
+        if not METRICS_DIR:
+            return
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = os.path.join(METRICS_DIR, f"worker-{os.getpid()}.json")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(path + ".tmp", path)
+
+    def _start(self):
+        if not METRICS_DIR:
+            return
+
+        def loop():
+            while True:
+                time.sleep(METRICS_FLUSH)
+                try:
+                    self.flush()
+                except OSError:
+                    pass
+
+        threading.Thread(target=loop, name="metrics-flush", daemon=True).start()
+        atexit.register(self.flush)
+
+    def collect(self) -> dict:
+        """This worker's live numbers plus every other worker's last flush."""
+        merged = self.snapshot()
+        if not METRICS_DIR:
+            return merged
+        own = f"worker-{os.getpid()}.json"
+        for path in glob.glob(os.path.join(METRICS_DIR, "worker-*.json")):
+            if os.path.basename(path) == own:
+                continue
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    other = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for name, series in other.get("counters", {}).items():
+                dst = merged["counters"].setdefault(name, {})
+                for key, v in series.items():
+                    dst[key] = dst.get(key, 0) + v
+            for name, series in other.get("histograms", {}).items():
+                dst = merged["histograms"].setdefault(name, {})
+                for key, h in series.items():
+                    mine = dst.get(key)
+                    if mine is None:
+                        dst[key] = h
+                    else:
+                        mine["counts"] = [a + b for a, b in zip(mine["counts"], h["counts"])]
+                        mine["sum"] += h["sum"]
+                        mine["count"] += h["count"]
+        return merged
+
+
+metrics = Metrics()
+
+# SQL counts/time for the request running on this thread, flushed per route.
+_sql_local = threading.local()
+
+
+def record_sql(seconds: float):
+    _sql_local.count = getattr(_sql_local, "count", 0) + 1
+    _sql_local.seconds = getattr(_sql_local, "seconds", 0.0) + seconds
+
+
+def observe_delivery(stage: str, seconds: float):
+    metrics.observe("lovebox_delivery_latency_seconds", max(0, seconds), (("stage", stage),), DELIVERY_BUCKETS)
+
+
+def queued_at(row) -> int:
+    """When a message joined its queue: created_at, or deliver_at for a scheduled one."""
+    return row.get("deliver_at") or row["created_at"]
+
+
+def metric_labels(key: str) -> str:
+    pairs = json.loads(key)
+    if not pairs:
+        return ""
+    body = ",".join(
+        '%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in pairs
+    )
+    return "{" + body + "}"
+
+
+def render_metrics(data: dict, gauges: list) -> str:
+    """Prometheus text exposition format."""
+    out = []
+    for name in sorted(data["counters"]):
+        out.append(f"# TYPE {name} counter")
+        for key, v in sorted(data["counters"][name].items()):
+            out.append(f"{name}{metric_labels(key)} {v}")
+    for name in sorted(data["histograms"]):
+        out.append(f"# TYPE {name} histogram")
+        for key, h in sorted(data["histograms"][name].items()):
+            pairs = json.loads(key)
+            running = 0
+            for bound, n in zip(h["le"], h["counts"]):
+                running += n
+                out.append(f"{name}_bucket{metric_labels(json.dumps(pairs + [['le', str(bound)]]))} {running}")
+            out.append(f"{name}_bucket{metric_labels(json.dumps(pairs + [['le', '+Inf']]))} {h['count']}")
+            out.append(f"{name}_sum{metric_labels(key)} {h['sum']}")
+            out.append(f"{name}_count{metric_labels(key)} {h['count']}")
+    for name, kind, samples in gauges:
+        out.append(f"# TYPE {name} {kind}")
+        for labels, v in samples:
+            out.append(f"{name}{metric_labels(json.dumps(labels))} {v}")
+    return "\n".join(out) + "\n"
+
+
+def metric_route() -> str:
+    return request.url_rule.rule if request.url_rule else "unmatched"
+
+
+@app.before_request
+def start_request_metrics():
+    g.metrics_t0 = time.perf_counter()
+    _sql_local.count = 0
+    _sql_local.seconds = 0.0
+
+
+@app.after_request
+def finish_request_metrics(resp):
+    t0 = g.pop("metrics_t0", None)
+    if t0 is None:
+        return resp
+    route = metric_route()
+    metrics.inc("lovebox_http_requests_total", (("route", route), ("method", request.method), ("status", str(resp.status_code))))
+    metrics.observe("lovebox_http_request_duration_seconds", time.perf_counter() - t0, (("route", route),))
+    if _sql_local.count:
+        metrics.inc("lovebox_sqlite_queries_total", (("route", route),), _sql_local.count)
+        metrics.inc("lovebox_sqlite_query_seconds_total", (("route", route),), _sql_local.seconds)
+        _sql_local.count = 0
+        _sql_local.seconds = 0.0
+    return resp
+
+
+# =========================
+# DB Helpers
+# =========================
+DB_STATS = {"slow_statements": 0, "lock_timeouts": 0}
+_db_stats_lock = threading.Lock()
+
+
+def count_db_stat(name: str, n: int = 1):
+    with _db_stats_lock:
+        DB_STATS[name] += n
+
+
+class TrackedConnection(sqlite3.Connection):
+    """
+    sqlite3.Connection that times every statement. Lock waits happen in
+    SQLite's own busy handler (connections open with timeout=DB_BUSY_TIMEOUT),
+    so they are counted from outside: a statement slower than
+    DB_SLOW_STATEMENT counts as slow (under write contention that is almost
+    always a wait for the lock), and "database is locked" escaping the
+    handler counts as a lock timeout.
+    """
+
+    def _timed(self, fn, *args):
+        t0 = time.perf_counter()
+        try:
+            return fn(*args)
+        except sqlite3.OperationalError as e:
+            if "locked" in str(e):
+                count_db_stat("lock_timeouts")
+            raise
+        finally:
+            elapsed = time.perf_counter() - t0
+            record_sql(elapsed)
+            if elapsed >= DB_SLOW_STATEMENT:
+                count_db_stat("slow_statements")
+
+    def execute(self, sql, params=()):
+        return self._timed(super().execute, sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self._timed(super().executemany, sql, seq_of_params)
+
+    def executescript(self, script):
+        return self._timed(super().executescript, script)
+
+    def commit(self):
+        return self._timed(super().commit)
+
+
+class ConnectionPool:
+    """
+    Bounded pool of SQLite connections for one worker process.
+    Pragmas are applied once when a connection is opened; every checkout
+    runs a cheap health check and replaces connections that went bad.
+    A readonly pool's connections are query_only: under WAL they read a
+    snapshot without ever taking the write lock.
+    """
+
+    def __init__(self, path: str, size: int, readonly: bool = False):
+        self.path = path
+        self.size = size
+        self.readonly = readonly
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT, check_same_thread=False, factory=TrackedConnection)
+        conn.row_factory = sqlite3.Row
+        if self.readonly:
+            conn.execute("PRAGMA query_only=ON;")
+        else:
+            # Only takes effect on a new, empty database (it must precede WAL there).
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+            conn.execute("PRAGMA journal_mode=WAL;")
+            conn.execute("PRAGMA synchronous=NORMAL;")
+        return conn
+
+    def dedicated(self):
+        """
+        A connection set up like this pool's but outside its size, for a
+        long-lived owner (the group-commit writer) that must never wait on
+        connections its own callers are holding.
+        """
+        return self._connect()
+
+    @staticmethod
+    def _healthy(conn) -> bool:
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    @staticmethod
+    def _discard(conn):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def acquire(self):
+        if not self._slots.acquire(timeout=DB_POOL_TIMEOUT):
+            raise RuntimeError("db pool exhausted")
+        try:
+            while True:
+                try:
+                    conn = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._connect()
+                if self._healthy(conn):
+                    return conn
+                self._discard(conn)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put(conn)
+        except sqlite3.Error:
+            self._discard(conn)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """Checkout for code running outside a request (e.g. streaming generators)."""
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+
+_pools = {}
+_pools_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool(path: str = None, readonly: bool = False) -> ConnectionPool:
+    """
+    Pool for a database file in the current process (rebuilt after fork,
+    so gunicorn workers never share sockets). Defaults to DB_PATH.
+    """
+    global _pools, _pools_pid
+    key = (path or DB_PATH, readonly)
+    pid = os.getpid()
+    pool = _pools.get(key) if _pools_pid == pid else None
+    if pool is None:
+        with _pool_lock:
+            if _pools_pid != pid:
+                _pools, _pools_pid = {}, pid
+            pool = _pools.get(key)
+            if pool is None:
+                size = DB_READ_POOL_SIZE if readonly else DB_POOL_SIZE
+                pool = _pools[key] = ConnectionPool(key[0], size, readonly)
+    return pool
+
+
+def db(pool: ConnectionPool = None):
+    """Connection shared by everything running in the current app context (one per pool)."""
+    pool = pool or get_pool()
+    conns = g.setdefault("db_conns", {})
+    conn = conns.get(pool)
+    if conn is None:
+        conn = conns[pool] = pool.acquire()
+    return conn
+
+
+@app.teardown_appcontext
+def release_db(exc=None):
+    for pool, conn in g.pop("db_conns", {}).items():
+        pool.release(conn)
+
+
+def shard_paths() -> list:
+    """Database files of the sharded message store (empty when DB_SHARDS is 1)."""
+    if DB_SHARDS == 1:
+        return []
+    root, ext = os.path.splitext(DB_PATH)
+    return [f"{root}-shard{i}{ext}" for i in range(DB_SHARDS)]
+
+
+# =========================
+# DB maintenance
+# =========================
+class DBMaintenance(WorkerThreads):
+    """
+    Background upkeep for the SQLite files (DB_PATH and any shards). Every MAINTENANCE_INTERVAL it
+    checkpoints the WAL once it outgrows WAL_CHECKPOINT_BYTES (PASSIVE) or
+    WAL_TRUNCATE_BYTES (TRUNCATE), returns up to VACUUM_PAGES free pages to
+    the filesystem (databases created with auto_vacuum=INCREMENTAL, i.e.
+    new ones), and every ANALYZE_INTERVAL refreshes planner statistics.
+
+    Only the worker holding <DB_PATH>-maintenance.lock runs a pass; the others
+    try again each interval, so one takes over if the holder exits. It all
+    happens on its own thread, on its own connections with busy_timeout=0:
+    a TRUNCATE checkpoint blocks new writers while it waits for readers, so
+    a step that finds the database busy gives up at once (counted in
+    lovebox_db_maintenance_busy_total) and is retried on the next pass.
+    Each step's time goes to /metrics.
+    """
+
+    def __init__(self, paths: list, interval: float):
+        super().__init__()
+        self.paths = paths
+        self.interval = interval
+        self._lock_file = None
+        self._conns = {}
+        self._next_analyze = {}
+
+    def _start(self):
+        if self.interval <= 0:
+            return
+        self._lock_file = None
+        self._conns = {}
+        threading.Thread(target=self._run, name="db-maintenance", daemon=True).start()
+
+    def _holds_lock(self) -> bool:
+        if fcntl is None:
+            return True
+        if self._lock_file is None:
+            self._lock_file = open(self.paths[0] + "-maintenance.lock", "a")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            return False
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                if self._holds_lock():
+                    for path in self.paths:
+                        self.run_once(path)
+            except Exception as e:
+                print("DB maintenance failed:", repr(e))
+
+    @staticmethod
+    def wal_bytes(path: str) -> int:
+        try:
+            return os.path.getsize(path + "-wal")
+        except OSError:
+            return 0
+
+    def _connection(self, path: str):
+        # A plain connection: its busy steps are this class's metric, not the
+        # request-side lock_timeouts TrackedConnection counts.
+        conn = self._conns.get(path)
+        if conn is None:
+            conn = self._conns[path] = sqlite3.connect(path, timeout=0)
+        return conn
+
+    @staticmethod
+    def _timed(task: str, conn, *statements):
+        """Rows of the last statement, or None if the database was busy."""
+        t0 = time.perf_counter()
+        rows = []
+        try:
+            for sql in statements:
+                rows = conn.execute(sql).fetchall()
+        except sqlite3.OperationalError as e:
+            if "locked" not in str(e) and "busy" not in str(e):
+                raise
+            if conn.in_transaction:
+                conn.rollback()
+            metrics.inc("lovebox_db_maintenance_busy_total", (("task", task),))
+            return None
+        metrics.observe("lovebox_db_maintenance_seconds", time.perf_counter() - t0, (("task", task),))
+        return rows
+
+    def run_once(self, path: str):
+        conn = self._connection(path)
+        wal = self.wal_bytes(path)
+        if wal >= WAL_CHECKPOINT_BYTES:
+            mode = "TRUNCATE" if wal >= WAL_TRUNCATE_BYTES else "PASSIVE"
+            rows = self._timed(f"checkpoint_{mode.lower()}", conn, f"PRAGMA wal_checkpoint({mode})")
+            if rows and rows[0][0]:
+                metrics.inc("lovebox_db_maintenance_busy_total", (("task", f"checkpoint_{mode.lower()}"),))
+
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2 and conn.execute("PRAGMA freelist_count").fetchone()[0]:
+            self._timed("incremental_vacuum", conn, f"PRAGMA incremental_vacuum({VACUUM_PAGES})")
+
+        if time.monotonic() >= self._next_analyze.get(path, 0.0):
+            if self._timed("analyze", conn, "PRAGMA analysis_limit=1000", "ANALYZE", "PRAGMA optimize") is not None:
+                self._next_analyze[path] = time.monotonic() + ANALYZE_INTERVAL
+
+
+maintenance = DBMaintenance([DB_PATH] + shard_paths(), MAINTENANCE_INTERVAL)
+
+
+# =========================
+# Change notification
+# =========================
+class BoxNotifier:
+    """
+    Per-box change counters. Writers bump a box after committing; waiters
+    block on that box's condition until its counter moves, so a write wakes
+    exactly the requests waiting on the box it touched. Listeners are called
+    with the box id after every bump, on the notifying thread (the ASGI app
+    uses one to wake its coroutines). Local bumps also go out on the
+    notification bus, whose events from other workers come back in here
+    with publish=False.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._seq = {}
+        self._conds = {}
+        self._waiting = {}
+        self._multi = {}
+        self._listeners = []
+        self.bus = None
+
+    def add_listener(self, fn):
+        self._listeners.append(fn)
+
+    def seq(self, box_id: str) -> int:
+        return self._seq.get(box_id, 0)
+
+    def notify(self, box_id: str, publish: bool = True):
+        with self._lock:
+            self._seq[box_id] = self._seq.get(box_id, 0) + 1
+            cond = self._conds.get(box_id)
+            if cond is not None:
+                cond.notify_all()
+            for cond in self._multi.get(box_id, ()):
+                cond.notify_all()
+        for fn in self._listeners:
+            fn(box_id)
+        if publish and self.bus is not None:
+            self.bus.publish(box_id)
+
+    def wait(self, box_id: str, seq: int, timeout: float) -> bool:
+        """Block until box_id changes past seq or timeout expires. Returns True on change."""
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            cond = self._conds.get(box_id)
+            if cond is None:
+                cond = self._conds[box_id] = threading.Condition(self._lock)
+            self._waiting[box_id] = self._waiting.get(box_id, 0) + 1
+            try:
+                while self._seq.get(box_id, 0) == seq:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    cond.wait(remaining)
+                return True
+            finally:
+                self._waiting[box_id] -= 1
+                if not self._waiting[box_id]:
+                    del self._waiting[box_id]
+                    del self._conds[box_id]
+
+    def wait_any(self, seqs: dict, timeout: float) -> bool:
+        """wait() over several boxes ({box_id: seq}): True as soon as any of them changes."""
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            cond = threading.Condition(self._lock)
+            for box_id in seqs:
+                self._multi.setdefault(box_id, set()).add(cond)
+            try:
+                while all(self._seq.get(box_id, 0) == seq for box_id, seq in seqs.items()):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    cond.wait(remaining)
+                return True
+            finally:
+                for box_id in seqs:
+                    conds = self._multi[box_id]
+                    conds.discard(cond)
+                    if not conds:
+                        del self._multi[box_id]
+
+
+box_events = BoxNotifier()
+
+
+class VersionCache:
+    """
+    Last known box_counters.version per box. An entry is only trusted while
+    the box's notifier sequence is unchanged since it was read (any local
+    write bumps it) and for at most `ttl` seconds, which bounds how long a
+    write made by another worker can go unnoticed.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._entries = {}
+
+    def get(self, box_id: str, seq: int):
+        entry = self._entries.get(box_id)
+        if entry is None or entry[1] != seq or entry[2] < time.monotonic():
+            return None
+        return entry[0]
+
+    def put(self, box_id: str, version: int, seq: int):
+        self._entries[box_id] = (version, seq, time.monotonic() + self.ttl)
+
+
+version_cache = VersionCache(VERSION_CACHE_TTL)
+
+
+# =========================
+# Cross-worker notification bus
+# =========================
+class NotifyBus(WorkerThreads):
+    """
+    "Box X changed" events between workers. publish() only marks the box; a
+    sender thread waits BUS_COALESCE for the rest of a burst and sends the
+    set, so many writes to a box go out as one event. Each batch received is
+    de-duplicated too and replayed into box_events without re-publishing;
+    the bumped sequence also retires that box's version_cache entry.
+
+    Transports implement _send(box_ids) and _listen(), which blocks
+    receiving and hands each batch of box ids to _deliver().
+    """
+
+    def __init__(self, coalesce: float):
+        super().__init__()
+        self.coalesce = coalesce
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._wake = threading.Event()
+
+    def _start(self):
+        """This worker's sender and listener threads."""
+        with self._lock:
+            self._pending = set()
+            self._wake = threading.Event()
+        threading.Thread(target=self._run_sender, name="bus-send", daemon=True).start()
+        threading.Thread(target=self._run_listener, name="bus-listen", daemon=True).start()
+
+    def publish(self, box_id: str):
+        self.start()
+        with self._lock:
+            self._pending.add(box_id)
+        self._wake.set()
+
+    def _run_sender(self):
+        while True:
+            self._wake.wait()
+            time.sleep(self.coalesce)
+            with self._lock:
+                batch, self._pending = self._pending, set()
+                self._wake.clear()
+            if not batch:
+                continue
+            try:
+                self._send(sorted(batch))
+                metrics.inc("lovebox_bus_events_total", (("direction", "out"),), len(batch))
+            except Exception as e:
+                print("notify bus send failed:", repr(e))
+
+    def _run_listener(self):
+        while True:
+            try:
+                self._listen()
+            except Exception as e:
+                print("notify bus listener failed:", repr(e))
+                time.sleep(1)
+
+    def _deliver(self, box_ids):
+        boxes = [b for b in dict.fromkeys(box_ids) if b]
+        for box_id in boxes:
+            box_events.notify(box_id, publish=False)
+        metrics.inc("lovebox_bus_events_total", (("direction", "in"),), len(boxes))
+
+    def _send(self, box_ids: list):
+        raise NotImplementedError
+
+    def _listen(self):
+        raise NotImplementedError
+
+
+class LocalSocketBus(NotifyBus):
+    """
+    Workers on one host: each binds a Unix datagram socket <directory>/<pid>.sock
+    and sends every batch to all the others there. A socket that refuses
+    (its worker is gone) is removed; a peer whose buffer is full misses the
+    event, and its waiters find the change when their wait times out.
+    """
+
+    PACKET = 4096  # bytes of newline-separated box ids per datagram
+    PEERS_TTL = 1.0  # seconds between directory listings
+
+    def __init__(self, directory: str, coalesce: float):
+        super().__init__(coalesce)
+        self.directory = directory
+        self._out = (None, None)
+        self._peers = ([], 0.0)
+
+    def _path(self) -> str:
+        return os.path.join(self.directory, f"{os.getpid()}.sock")
+
+    def _peer_paths(self, refresh: bool = False) -> list:
+        paths, listed = self._peers
+        if refresh or time.monotonic() - listed > self.PEERS_TTL:
+            own = self._path()
+            paths = [p for p in glob.glob(os.path.join(self.directory, "*.sock")) if p != own]
+            self._peers = (paths, time.monotonic())
+        return paths
+
+    @classmethod
+    def packets(cls, box_ids: list) -> list:
+        out, current, size = [], [], 0
+        for box_id in box_ids:
+            data = box_id.encode()
+            if current and size + len(data) + 1 > cls.PACKET:
+                out.append(b"\n".join(current))
+                current, size = [], 0
+            current.append(data)
+            size += len(data) + 1
+        if current:
+            out.append(b"\n".join(current))
+        return out
+
+    def _send(self, box_ids: list):
+        pid, sock = self._out
+        if pid != os.getpid():
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            self._out = (os.getpid(), sock)
+        packets = self.packets(box_ids)
+        gone = False
+        for peer in self._peer_paths():
+            try:
+                for packet in packets:
+                    sock.sendto(packet, peer)
+            except ConnectionRefusedError:
+                gone = True
+                try:
+                    os.unlink(peer)
+                except OSError:
+                    pass
+            except FileNotFoundError:
+                gone = True
+            except BlockingIOError:
+                metrics.inc("lovebox_bus_dropped_total")
+        if gone:
+            self._peer_paths(refresh=True)
+
+    def _listen(self):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path()
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(path)
+        atexit.register(self._unlink, path)
+        try:
+            while True:
+                # Block for one datagram, then drain whatever else is queued into the same batch.
+                box_ids = sock.recv(65536).decode().split("\n")
+                sock.setblocking(False)
+                try:
+                    while True:
+                        box_ids += sock.recv(65536).decode().split("\n")
+                except BlockingIOError:
+                    pass
+                finally:
+                    sock.setblocking(True)
+                self._deliver(box_ids)
+        finally:
+            sock.close()
+
+    @staticmethod
+    def _unlink(path: str):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+class BrokerBus(NotifyBus):
+    """
+    The bus over an external pub/sub broker, for workers on several hosts.
+    `broker` needs publish(channel, data) and a blocking listen(channel,
+    callback) that calls callback(data) for every message on the channel:
+    RedisBroker, or LocalBroker as an in-process stand-in. Events carry their
+    sender's id, so a worker skips its own.
+    """
+
+    def __init__(self, broker, coalesce: float, channel: str = "lovebox:boxes"):
+        super().__init__(coalesce)
+        self.broker = broker
+        self.channel = channel
+        self._origin = (None, None)
+
+    def origin(self) -> str:
+        pid, origin = self._origin
+        if pid != os.getpid():
+            origin = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+            self._origin = (os.getpid(), origin)
+        return origin
+
+    def _send(self, box_ids: list):
+        self.broker.publish(self.channel, json.dumps({"from": self.origin(), "boxes": box_ids}))
+
+    def _listen(self):
+        self.broker.listen(self.channel, self._received)
+
+    def _received(self, data):
+        event = json.loads(data)
+        if event.get("from") != self.origin():
+            self._deliver(event.get("boxes") or [])
+
+
+class LocalBroker:
+    """In-process stand-in for a pub/sub broker: every listener on a channel gets every message."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+
+    def publish(self, channel: str, data):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for q in subscribers:
+            q.put(data)
+
+    def listen(self, channel: str, callback):
+        q = queue.Queue()
+        with self._lock:
+            self._subscribers.setdefault(channel, []).append(q)
+        try:
+            while True:
+                callback(q.get())
+        finally:
+            with self._lock:
+                self._subscribers[channel].remove(q)
+
+
+class RedisBroker:
+    """publish / listen over Redis pub/sub (NOTIFY_BUS=redis)."""
+
+    def __init__(self, url: str):
+        self.url = url
+        self._client = (None, None)
+
+    def _redis(self):
+        pid, client = self._client
+        if pid != os.getpid():
+            client = redis.Redis.from_url(self.url)
+            self._client = (os.getpid(), client)
+        return client
+
+    def publish(self, channel: str, data):
+        self._redis().publish(channel, data)
+
+    def listen(self, channel: str, callback):
+        pubsub = self._redis().pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(channel)
+        try:
+            for message in pubsub.listen():
+                if message and message["type"] == "message":
+                    callback(message["data"])
+        finally:
+            pubsub.close()
+
+
+def make_bus():
+    """The NOTIFY_BUS transport, or None when there isn't one."""
+    if NOTIFY_BUS == "local" and hasattr(socket, "AF_UNIX"):
+        return LocalSocketBus(BUS_DIR, BUS_COALESCE)
+    if NOTIFY_BUS == "redis":
+        if redis is None:
+            print("NOTIFY_BUS=redis needs the redis package; cross-worker notification is off")
+            return None
+        return BrokerBus(RedisBroker(BUS_URL), BUS_COALESCE)
+    return None
+
+
+box_events.bus = make_bus()
+
+
+# Columns added after a table first shipped: (table, column, declaration).
+# CREATE TABLE IF NOT EXISTS leaves existing tables alone, so older
+# databases get these through ALTER TABLE before schema.sql runs.
+SCHEMA_COLUMNS = [
+    ("box_counters", "version", "INTEGER NOT NULL DEFAULT 0"),
+    ("devices", "group_id", "TEXT"),
+    ("messages", "broadcast_id", "TEXT"),
+    ("messages", "deliver_at", "INTEGER"),
+]
+
+
+def migrate_columns(conn):
+    for table, column, decl in SCHEMA_COLUMNS:
+        cols = {r["name"] for r in conn.execute(f"PRAGMA table_info({table})")}
+        if cols and column not in cols:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+def schema_statements(script: str) -> list:
+    """schema.sql split into whole statements (a trigger's BEGIN ... END stays in one piece)."""
+    statements, buf = [], ""
+    for line in script.splitlines(keepends=True):
+        buf += line
+        if sqlite3.complete_statement(buf):
+            statements.append(buf)
+            buf = ""
+    return statements
+
+
+def apply_schema(conn):
+    """
+    Column migrations plus schema.sql as one write transaction. Every worker
+    runs this at import; executescript would run each statement in
+    autocommit, so a message written between a trigger's DROP and CREATE
+    would miss its box_counters update.
+    """
+    schema_path = os.path.join(BASE_DIR, "schema.sql")
+    with open(schema_path, "r", encoding="utf-8") as f:
+        statements = schema_statements(f.read())
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        migrate_columns(conn)
+        for sql in statements:
+            conn.execute(sql)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+
+def init_db():
+    apply_schema(db())
+    get_store().init_schema()
+
+    # The pair from the environment; the rest of the fleet comes from `flask provision`.
+    register_devices([
+        (BOX1_ID, BOX1_TOKEN, BOX2_ID, "default"),
+        (BOX2_ID, BOX2_TOKEN, BOX1_ID, "default"),
+    ])
+
+
+# =========================
+# Device credentials
+# =========================
+class DeviceCache:
+    """
+    Per-worker TTL cache of devices rows keyed by box_id. Only hits are
+    cached, so unknown ids cannot grow it. Writers in this worker invalidate
+    explicitly; writes from anywhere else (other workers, `flask provision`)
+    bump registry_version, and get_device clears the cache when it moves.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._version = None
+
+    def get(self, box_id: str):
+        entry = self._entries.get(box_id)
+        if entry is None or entry[1] < time.monotonic():
+            return None
+        return entry[0]
+
+    def put(self, box_id: str, device: dict):
+        with self._lock:
+            self._entries[box_id] = (device, time.monotonic() + self.ttl)
+
+    def invalidate(self, box_id: str = None):
+        with self._lock:
+            if box_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(box_id, None)
+
+    def sync(self, version: int):
+        """Drop every entry if the devices registry_version has moved since the last call."""
+        if version != self._version:
+            with self._lock:
+                self._entries.clear()
+                self._version = version
+
+
+device_cache = DeviceCache(AUTH_CACHE_TTL)
+
+
+def register_device(box_id: str, token: str, paired_to: str, group_id: str = None):
+    """Add a device or rotate its token/pairing."""
+    register_devices([(box_id, token, paired_to, group_id)])
+
+
+def register_devices(devices: list):
+    """Add or replace many (box_id, token, paired_to, group_id) devices in one transaction."""
+    conn = db()
+    conn.executemany(
+        "INSERT OR REPLACE INTO devices (box_id, token, paired_to, group_id) VALUES (?, ?, ?, ?)",
+        devices,
+    )
+    conn.commit()
+    if len(devices) > 100:
+        device_cache.invalidate()
+    else:
+        for device in devices:
+            device_cache.invalidate(device[0])
+    _registry["checked"] = 0.0
+
+
+# Last devices registry_version seen by this worker, re-read at most every VERSION_CACHE_TTL.
+_registry = {"version": None, "checked": 0.0}
+
+
+def registry_version() -> int:
+    now = time.monotonic()
+    if now - _registry["checked"] > VERSION_CACHE_TTL:
+        row = db().execute("SELECT version FROM registry_version WHERE id = 1").fetchone()
+        _registry["version"] = row[0] if row else 0
+        _registry["checked"] = now
+    return _registry["version"]
+
+
+def registry_due() -> bool:
+    """True when the next registry_version() call will read the database."""
+    return time.monotonic() - _registry["checked"] > VERSION_CACHE_TTL
+
+
+def get_device(box_id: str):
+    device_cache.sync(registry_version())
+    device = device_cache.get(box_id)
+    if device is not None:
+        return device
+
+    row = db().execute(
+        "SELECT box_id, token, paired_to FROM devices WHERE box_id = ?",
+        (box_id,),
+    ).fetchone()
+    if not row:
+        return None
+    device = dict(row)
+    device_cache.put(box_id, device)
+    return device
+
+
+def auth_box(box_id: str, token: str):
+    device = get_device(box_id)
+    if not device:
+        return None
+    if not hmac.compare_digest(str(device["token"]).encode(), str(token).encode()):
+        return None
+    return {"box_id": device["box_id"], "paired_to": device["paired_to"]}
+
+
+# =========================
+# Message store
+# =========================
+# UPDATE ... RETURNING needs SQLite 3.35+; older builds take the write lock up front instead.
+HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+
+class MessageStore:
+    """
+    Storage behind the message queue. Rows are plain dicts with the
+    messages columns plus "cursor", a per-store increasing position that
+    /api/stream resumes from. Engines only store; notifying waiters and
+    recording metrics stays with the callers (create_message, claim_pending, ...).
+    """
+
+    def init_schema(self):
+        """Prepare storage beyond DB_PATH, which init_db has already set up."""
+
+    def new_msg_id(self, to_box: str) -> str:
+        return secrets.token_hex(8)
+
+    def create(self, msg: dict):
+        """Insert a new message ('sent', or 'scheduled' until deliver_at) and prune its box, atomically."""
+        raise NotImplementedError
+
+    def create_many(self, msgs: list):
+        """create() for many messages (a broadcast) in one transaction, pruning each box once."""
+        raise NotImplementedError
+
+    def claim(self, box_id: str, limit: int, now: int):
+        """Oldest `limit` pending rows marked delivered -> (rows, newly delivered ids, version)."""
+        raise NotImplementedError
+
+    def claim_after(self, box_id: str, cursor: int, now: int):
+        """Pending rows past cursor, in order, marked delivered -> (rows, newly delivered ids)."""
+        raise NotImplementedError
+
+    def cursor_for(self, box_id: str, msg_id: str) -> int:
+        """Cursor of msg_id in box_id's queue, or 0 if it is unknown."""
+        raise NotImplementedError
+
+    def ack(self, box_id: str, msg_ids: list, now: int):
+        """Mark seen and prune. Rows as they were before the ack; None if any id belongs to another box."""
+        raise NotImplementedError
+
+    def get(self, msg_id: str):
+        raise NotImplementedError
+
+    def peek(self, msg_id: str):
+        """get(), allowed to be slightly stale (READ_SNAPSHOT). Used by /status polling."""
+        return self.get(msg_id)
+
+    def broadcast_rows(self, broadcast_id: str) -> list:
+        """Rows of one broadcast still in storage (pruned ones are gone), any order."""
+        raise NotImplementedError
+
+    def counts(self, box_id: str) -> dict:
+        """total / pending / seen / version for a box."""
+        raise NotImplementedError
+
+    def prune(self, box_id: str) -> int:
+        raise NotImplementedError
+
+    def release_due(self, box_id: str, now: int) -> list:
+        """
+        Scheduled messages of box_id due by now, moved to 'sent' and behind
+        everything already queued (new cursors). Returns the released rows.
+        """
+        raise NotImplementedError
+
+    def due_times(self) -> list:
+        """(box, earliest deliver_at) for every box with scheduled messages."""
+        raise NotImplementedError
+
+    def depths(self) -> list:
+        """(box, pending, seen) for every box with a queue."""
+        raise NotImplementedError
+
+
+class WriteOp:
+    """One operation queued on a GroupCommitWriter: fn(conn), and its outcome once committed."""
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.result = None
+        self.error = None
+        self.sql = (0, 0.0)  # queries / seconds it ran, credited to the caller's route
+        self.done = threading.Event()
+
+    def run(self, conn):
+        _sql_local.count = 0
+        _sql_local.seconds = 0.0
+        try:
+            self.result = self.fn(conn)
+        finally:
+            self.sql = (_sql_local.count, _sql_local.seconds)
+
+
+class GroupCommitWriter(WorkerThreads):
+    """
+    Write-behind thread for a SQLiteStore. Callers queue a function of a
+    connection and block; the thread runs everything that has queued up in
+    one transaction, each operation in its own savepoint so one failure
+    doesn't sink the rest, and wakes every caller after that single commit.
+    Commits (and fsyncs) then grow with batches, not with requests.
+
+    The thread writes on its own connection, not a pooled one: a caller
+    blocked in submit() may hold the request's pooled connection, and with
+    every pooled connection held that way a pooled writer would never run.
+    """
+
+    def __init__(self, path: str, max_ops: int, wait: float):
+        super().__init__()
+        self.path = path
+        self.max_ops = max(1, max_ops)
+        self.wait = wait
+        self._queue = queue.Queue()
+        self._conn = None
+
+    def _start(self):
+        self._queue = queue.Queue()
+        self._conn = None
+        threading.Thread(target=self._run, name="lovebox-group-commit", daemon=True).start()
+
+    def submit(self, fn):
+        """Run fn(conn) in the next batch; returns its result once the batch is durable."""
+        self.start()
+        op = WriteOp(fn)
+        self._queue.put(op)
+        op.done.wait()
+        _sql_local.count = getattr(_sql_local, "count", 0) + op.sql[0]
+        _sql_local.seconds = getattr(_sql_local, "seconds", 0.0) + op.sql[1]
+        if op.error is not None:
+            raise op.error
+        return op.result
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.wait
+            while len(batch) < self.max_ops:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._commit(batch)
+            metrics.observe("lovebox_group_commit_ops", len(batch), (), BATCH_BUCKETS)
+            for op in batch:
+                op.done.set()
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = get_pool(self.path).dedicated()
+        return self._conn
+
+    def _rollback(self):
+        """End a failed transaction; a connection that can't even roll back is replaced."""
+        if self._conn is None:
+            return
+        try:
+            self._conn.rollback()
+        except sqlite3.Error:
+            try:
+                self._conn.close()
+            except sqlite3.Error:
+                pass
+            self._conn = None
+
+    def _commit(self, batch: list):
+        try:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            for op in batch:
+                conn.execute("SAVEPOINT write_op")
+                try:
+                    op.run(conn)
+                except Exception as e:
+                    conn.execute("ROLLBACK TO write_op")
+                    op.error = e
+                conn.execute("RELEASE write_op")
+            conn.commit()
+        except Exception:
+            # The shared transaction failed as a whole, so none of it is durable:
+            # give every operation its own transaction instead.
+            self._rollback()
+            for op in batch:
+                op.result = op.error = None
+                try:
+                    conn = self._connection()
+                    op.run(conn)
+                    conn.commit()
+                except Exception as e:
+                    op.error = e
+                    self._rollback()
+
+
+class ReadSnapshot:
+    """
+    In-memory copy of a database file, taken with the backup API. Whichever
+    reader first finds it older than `interval` refreshes it; readers that
+    arrive meanwhile keep using the previous copy.
+    """
+
+    def __init__(self, path: str, interval: float):
+        self.path = path
+        self.interval = interval
+        self._copy = None
+        self._taken = 0.0
+        self._refresh_lock = threading.Lock()
+        self._read_lock = threading.Lock()
+
+    def _refresh(self):
+        copy = sqlite3.connect(":memory:", check_same_thread=False)
+        copy.row_factory = sqlite3.Row
+        with get_pool(self.path, readonly=True).connection() as conn:
+            conn.backup(copy)
+        with self._read_lock:
+            old, self._copy, self._taken = self._copy, copy, time.monotonic()
+        if old is not None:
+            old.close()
+
+    def query(self, sql: str, params: tuple = ()) -> list:
+        if self._copy is None or time.monotonic() - self._taken > self.interval:
+            # Only the first reader waits for a copy; later ones read the old one while it refreshes.
+            if self._refresh_lock.acquire(blocking=self._copy is None):
+                try:
+                    if self._copy is None or time.monotonic() - self._taken > self.interval:
+                        self._refresh()
+                finally:
+                    self._refresh_lock.release()
+        with self._read_lock:
+            return self._copy.execute(sql, params).fetchall()
+
+
+class SQLiteStore(MessageStore):
+    """
+    The messages / box_counters schema in one SQLite file. Inside a request
+    it uses the request's pooled connections; elsewhere (stream generators)
+    it checks one out per call. Pure reads go to the query_only read pool.
+    With GROUP_COMMIT, creates and acks are committed in batches by a
+    GroupCommitWriter instead.
+    """
+
+    INSERT_SQL = """
+        INSERT INTO messages (msg_id, to_box, from_source, msg_type, msg_text, msg_event, status, created_at,
+                              broadcast_id, deliver_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._writer = GroupCommitWriter(path, GROUP_COMMIT_MAX, GROUP_COMMIT_WAIT) if GROUP_COMMIT else None
+        self._snapshot = ReadSnapshot(path, READ_SNAPSHOT) if READ_SNAPSHOT > 0 else None
+
+    @property
+    def pool(self) -> ConnectionPool:
+        return get_pool(self.path)
+
+    @property
+    def read_pool(self) -> ConnectionPool:
+        return get_pool(self.path, readonly=True)
+
+    def _write(self, fn):
+        """fn(conn) committed: through the group-commit writer when enabled, else on its own."""
+        if self._writer is not None:
+            return self._writer.submit(fn)
+        with self._conn() as conn:
+            result = fn(conn)
+            conn.commit()
+        return result
+
+    @contextmanager
+    def _conn(self, readonly: bool = False):
+        pool = self.read_pool if readonly else self.pool
+        if has_app_context():
+            yield db(pool)
+        else:
+            with pool.connection() as conn:
+                yield conn
+
+    @staticmethod
+    def _counts(conn, box_id: str) -> dict:
+        row = conn.execute(
+            "SELECT total, pending, seen, version FROM box_counters WHERE to_box=?",
+            (box_id,),
+        ).fetchone()
+        if not row:
+            return {"total": 0, "pending": 0, "seen": 0, "version": 0}
+        return dict(row)
+
+    @staticmethod
+    def _rows(rows) -> list:
+        out = []
+        for r in rows:
+            item = dict(r)
+            item["cursor"] = item.pop("rowid")
+            out.append(item)
+        return out
+
+    def _prune(self, conn, box_id: str) -> int:
+        """
+        Keep total messages for box_id <= MAX_QUEUE.
+        Delete oldest SEEN first, then oldest delivered. Messages not yet
+        delivered ('sent' / 'scheduled') are never evicted, so a queue of
+        those alone may stay over the limit until they are claimed.
+
+        Runs inside the caller's transaction as a single set-based DELETE,
+        and is skipped via box_counters when the queue is not over the limit.
+        """
+        if self._counts(conn, box_id)["total"] <= MAX_QUEUE:
+            return 0
+
+        # Rank what we keep: undelivered first, then delivered, then seen, newest
+        # first; whatever delivered or seen falls past MAX_QUEUE goes.
+        cur = conn.execute(
+            """
+            DELETE FROM messages WHERE msg_id IN (
+              SELECT msg_id FROM (
+                SELECT msg_id, status, ROW_NUMBER() OVER (
+                  ORDER BY (status IN ('sent','scheduled')) DESC, (status = 'seen') ASC, created_at DESC, rowid DESC
+                ) AS keep_rank
+                FROM messages
+                WHERE to_box=?
+              )
+              WHERE keep_rank > ? AND status IN ('delivered','seen')
+            )
+            """,
+            (box_id, MAX_QUEUE),
+        )
+        return cur.rowcount
+
+    def _prune_boxes(self, conn, box_ids: list) -> int:
+        """
+        _prune for many boxes as one DELETE: box_counters picks out the boxes
+        over MAX_QUEUE and each is ranked in its own window partition.
+        """
+        cur = conn.execute(
+            """
+            DELETE FROM messages WHERE msg_id IN (
+              SELECT msg_id FROM (
+                SELECT msg_id, status, ROW_NUMBER() OVER (
+                  PARTITION BY to_box
+                  ORDER BY (status IN ('sent','scheduled')) DESC, (status = 'seen') ASC, created_at DESC, rowid DESC
+                ) AS keep_rank
+                FROM messages
+                WHERE to_box IN (
+                  SELECT to_box FROM box_counters
+                  WHERE to_box IN (SELECT value FROM json_each(?)) AND total > ?
+                )
+              )
+              WHERE keep_rank > ? AND status IN ('delivered','seen')
+            )
+            """,
+            (json.dumps(box_ids), MAX_QUEUE, MAX_QUEUE),
+        )
+        return cur.rowcount
+
+    @staticmethod
+    def _insert_params(msg: dict) -> tuple:
+        return (msg["msg_id"], msg["to_box"], msg["from_source"], msg["msg_type"],
+                msg["msg_text"], msg["msg_event"], msg.get("status", "sent"), msg["created_at"],
+                msg.get("broadcast_id"), msg.get("deliver_at") or msg["created_at"])
+
+    def create(self, msg: dict):
+        def insert(conn):
+            conn.execute(self.INSERT_SQL, self._insert_params(msg))
+            self._prune(conn, msg["to_box"])
+
+        self._write(insert)
+
+    def create_many(self, msgs: list):
+        def insert(conn):
+            conn.executemany(self.INSERT_SQL, [self._insert_params(m) for m in msgs])
+            self._prune_boxes(conn, sorted({m["to_box"] for m in msgs}))
+
+        self._write(insert)
+
+    def claim(self, box_id: str, limit: int, now: int):
+        # Most polls have nothing new to deliver: answer those from one read
+        # snapshot, so only a claim that moves a row takes the write lock.
+        with self._conn(readonly=True) as conn:
+            conn.execute("BEGIN")
+            rows = self._rows(conn.execute(
+                """
+                SELECT rowid, * FROM messages
+                WHERE to_box=? AND status IN ('sent','delivered')
+                ORDER BY deliver_at ASC, rowid ASC
+                LIMIT ?
+                """,
+                (box_id, limit),
+            ).fetchall())
+            version = self._counts(conn, box_id)["version"]
+            conn.commit()
+        if not any(r["status"] == "sent" for r in rows):
+            return rows, set(), version
+
+        with self._conn() as conn:
+            if HAS_RETURNING:
+                # The UPDATE takes the write lock and reports exactly which rows it
+                # moved sent -> delivered; the slice is then re-read in the same
+                # transaction (it is unchanged: both statuses are still pending).
+                fresh = {r["msg_id"] for r in conn.execute(
+                    """
+                    UPDATE messages
+                    SET status='delivered', delivered_at=?
+                    WHERE status='sent' AND msg_id IN (
+                      SELECT msg_id FROM messages
+                      WHERE to_box=? AND status IN ('sent','delivered')
+                      ORDER BY deliver_at ASC, rowid ASC
+                      LIMIT ?
+                    )
+                    RETURNING msg_id
+                    """,
+                    (now, box_id, limit),
+                ).fetchall()}
+                rows = self._rows(conn.execute(
+                    """
+                    SELECT rowid, * FROM messages
+                    WHERE to_box=? AND status IN ('sent','delivered')
+                    ORDER BY deliver_at ASC, rowid ASC
+                    LIMIT ?
+                    """,
+                    (box_id, limit),
+                ).fetchall())
+                version = self._counts(conn, box_id)["version"]
+                conn.commit()
+                return rows, fresh, version
+
+            conn.execute("BEGIN IMMEDIATE")
+            rows = self._rows(conn.execute(
+                """
+                SELECT rowid, * FROM messages
+                WHERE to_box=? AND status IN ('sent','delivered')
+                ORDER BY deliver_at ASC, rowid ASC
+                LIMIT ?
+                """,
+                (box_id, limit),
+            ).fetchall())
+            fresh = {r["msg_id"] for r in rows if r["status"] == "sent"}
+            if fresh:
+                conn.executemany(
+                    "UPDATE messages SET status='delivered', delivered_at=? WHERE msg_id=?",
+                    [(now, m) for m in fresh],
+                )
+            version = self._counts(conn, box_id)["version"]
+            conn.commit()
+            for r in rows:
+                if r["msg_id"] in fresh:
+                    r["status"], r["delivered_at"] = "delivered", now
+            return rows, fresh, version
+
+    def claim_after(self, box_id: str, cursor: int, now: int):
+        with self._conn() as conn:
+            rows = self._rows(conn.execute(
+                """
+                SELECT rowid, * FROM messages
+                WHERE to_box=? AND status IN ('sent','delivered') AND rowid > ?
+                ORDER BY rowid ASC
+                """,
+                (box_id, cursor),
+            ).fetchall())
+            fresh = {r["msg_id"] for r in rows if r["status"] == "sent"}
+            if fresh:
+                conn.executemany(
+                    "UPDATE messages SET status='delivered', delivered_at=? WHERE msg_id=? AND status='sent'",
+                    [(now, m) for m in fresh],
+                )
+                conn.commit()
+            for r in rows:
+                if r["msg_id"] in fresh:
+                    r["status"], r["delivered_at"] = "delivered", now
+            return rows, fresh
+
+    def cursor_for(self, box_id: str, msg_id: str) -> int:
+        with self._conn(readonly=True) as conn:
+            row = conn.execute(
+                "SELECT rowid FROM messages WHERE msg_id=? AND to_box=?",
+                (msg_id, box_id),
+            ).fetchone()
+        return row["rowid"] if row else 0
+
+    def ack(self, box_id: str, msg_ids: list, now: int):
+        if not msg_ids:
+            return []
+        marks = ",".join("?" * len(msg_ids))
+
+        def mark_seen(conn):
+            rows = conn.execute(
+                f"SELECT msg_id, to_box, status, created_at, delivered_at, deliver_at FROM messages WHERE msg_id IN ({marks})",
+                msg_ids,
+            ).fetchall()
+            if not rows:
+                return []
+            if any(row["to_box"] != box_id for row in rows):
+                return None
+
+            conn.execute(
+                f"UPDATE messages SET status='seen', seen_at=? WHERE to_box=? AND msg_id IN ({marks})",
+                [now, box_id, *msg_ids],
+            )
+            self._prune(conn, box_id)
+            return [dict(r) for r in rows]
+
+        return self._write(mark_seen)
+
+    def get(self, msg_id: str):
+        with self._conn(readonly=True) as conn:
+            row = conn.execute(
+                "SELECT rowid, * FROM messages WHERE msg_id=?",
+                (msg_id,),
+            ).fetchone()
+        return self._rows([row])[0] if row else None
+
+    def peek(self, msg_id: str):
+        if self._snapshot is None:
+            return self.get(msg_id)
+        rows = self._snapshot.query("SELECT rowid, * FROM messages WHERE msg_id=?", (msg_id,))
+        # Messages newer than the copy aren't in it yet.
+        return self._rows(rows)[0] if rows else self.get(msg_id)
+
+    def broadcast_rows(self, broadcast_id: str) -> list:
+        with self._conn(readonly=True) as conn:
+            return self._rows(conn.execute(
+                "SELECT rowid, * FROM messages WHERE broadcast_id=?",
+                (broadcast_id,),
+            ).fetchall())
+
+    def counts(self, box_id: str) -> dict:
+        with self._conn(readonly=True) as conn:
+            return self._counts(conn, box_id)
+
+    def prune(self, box_id: str) -> int:
+        with self._conn() as conn:
+            evicted = self._prune(conn, box_id)
+            conn.commit()
+        return evicted
+
+    def release_due(self, box_id: str, now: int) -> list:
+        def release(conn):
+            if not conn.in_transaction:
+                conn.execute("BEGIN IMMEDIATE")
+            rows = [dict(r) for r in conn.execute(
+                """
+                SELECT * FROM messages
+                WHERE to_box=? AND status='scheduled' AND deliver_at <= ?
+                ORDER BY deliver_at ASC, rowid ASC
+                """,
+                (box_id, now),
+            ).fetchall()]
+            if not rows:
+                return []
+            # Re-inserted rather than updated so they get new rowids: /api/stream
+            # resumes by rowid and would otherwise never see them.
+            conn.executemany("DELETE FROM messages WHERE msg_id=?", [(r["msg_id"],) for r in rows])
+            for r in rows:
+                r["status"] = "sent"
+            conn.executemany(self.INSERT_SQL, [self._insert_params(r) for r in rows])
+            return rows
+
+        return self._write(release)
+
+    def due_times(self) -> list:
+        with self._conn(readonly=True) as conn:
+            return [(r[0], r[1]) for r in conn.execute(
+                "SELECT to_box, MIN(deliver_at) FROM messages WHERE status='scheduled' GROUP BY to_box"
+            )]
+
+    def depths(self) -> list:
+        with self._conn(readonly=True) as conn:
+            return [(r["to_box"], r["pending"], r["seen"])
+                    for r in conn.execute("SELECT to_box, pending, seen FROM box_counters")]
+
+
+class StoreInUse(RuntimeError):
+    """The memory store's lock is held by another process."""
+
+
+class MemoryStore(MessageStore):
+    """
+    Whole queue in process memory: a deque per box in delivery order (no
+    longer than MAX_QUEUE after a write, undelivered messages aside) plus a
+    msg_id index. With a directory it is
+    crash-recoverable: every change is appended to an op log by a background
+    thread (never on the request path) and the state is snapshotted every
+    MEMORY_SNAPSHOT seconds, after which the log starts over.
+
+    State lives in one process, so serve it from a single worker
+    (threads are fine); devices and auth still come from SQLite. The
+    process holds an exclusive flock on the directory (or, without one,
+    next to DB_PATH) and a second one raises StoreInUse instead of
+    splitting the queues or overwriting the snapshot and log.
+    """
+
+    def __init__(self, directory: str = ""):
+        self.directory = directory
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._owner = self._claim(os.path.join(directory, "lock") if directory else DB_PATH + "-memory.lock")
+        self._lock = threading.Lock()
+        self._queues = {}
+        self._index = {}
+        self._versions = {}
+        self._cursor = 0
+        self._seq = 0
+        self._log = []
+        if directory:
+            self._recover()
+            threading.Thread(target=self._persist_loop, name="memory-store", daemon=True).start()
+            atexit.register(self._flush_log)
+
+    @staticmethod
+    def _claim(path: str):
+        if fcntl is None:
+            return None
+        f = open(path, "a")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            raise StoreInUse(f"{path} is locked: another process holds the memory store (STORE=memory needs a single worker)")
+        return f
+
+    # ---- state transitions (shared by live writes and log replay) ----
+    def _bump(self, box_id: str):
+        self._versions[box_id] = self._versions.get(box_id, 0) + 1
+
+    def _apply(self, op: dict):
+        kind = op["op"]
+        if kind == "create":
+            msg = dict(op["msg"])
+            self._cursor = max(self._cursor, msg["cursor"])
+            self._queues.setdefault(msg["to_box"], collections.deque()).append(msg)
+            self._index[msg["msg_id"]] = msg
+            self._bump(msg["to_box"])
+            self._prune(msg["to_box"])
+        elif kind == "deliver":
+            changed = False
+            for msg_id in op["ids"]:
+                msg = self._index.get(msg_id)
+                if msg and msg["status"] == "sent":
+                    msg["status"], msg["delivered_at"] = "delivered", op["at"]
+                    changed = True
+            if changed:
+                self._bump(op["box"])
+        elif kind == "ack":
+            for msg_id in op["ids"]:
+                msg = self._index.get(msg_id)
+                if msg:
+                    msg["status"], msg["seen_at"] = "seen", op["at"]
+            self._bump(op["box"])
+            self._prune(op["box"])
+        elif kind == "release":
+            q = self._queues[op["box"]]
+            for msg_id, cursor in op["ids"]:
+                msg = self._index[msg_id]
+                msg["status"], msg["cursor"] = "sent", cursor
+                self._cursor = max(self._cursor, cursor)
+                q.remove(msg)
+                q.append(msg)
+            self._bump(op["box"])
+        elif kind == "prune":
+            self._prune(op["box"])
+        self._seq = max(self._seq, op.get("seq", 0))
+
+    def _write(self, op: dict):
+        """Apply a change (lock held) and queue it for the op log."""
+        if self.directory:
+            op["seq"] = self._seq + 1
+        self._apply(op)
+        if self.directory:
+            self._log.append(op)
+
+    def _prune(self, box_id: str) -> int:
+        q = self._queues.get(box_id)
+        if not q or len(q) <= MAX_QUEUE:
+            return 0
+        # Same policy as SQLite: undelivered always stay, then delivered before seen, newest first.
+        ranked = sorted(q, key=lambda m: (m["status"] not in ("sent", "scheduled"), m["status"] == "seen",
+                                          -m["created_at"], -m["cursor"]))
+        keep_ids = {m["msg_id"] for i, m in enumerate(ranked)
+                    if i < MAX_QUEUE or m["status"] in ("sent", "scheduled")}
+        evicted = 0
+        for msg in list(q):
+            if msg["msg_id"] not in keep_ids:
+                del self._index[msg["msg_id"]]
+                evicted += 1
+        if not evicted:
+            return 0
+        self._queues[box_id] = collections.deque(m for m in q if m["msg_id"] in keep_ids)
+        self._bump(box_id)
+        return evicted
+
+    def _stored(self, msg: dict) -> dict:
+        return {
+            "status": "sent", **msg, "deliver_at": msg.get("deliver_at") or msg["created_at"],
+            "delivered_at": None, "seen_at": None, "cursor": self._cursor + 1,
+        }
+
+    # ---- MessageStore ----
+    def create(self, msg: dict):
+        with self._lock:
+            self._write({"op": "create", "msg": self._stored(msg)})
+
+    def create_many(self, msgs: list):
+        with self._lock:
+            for msg in msgs:
+                self._write({"op": "create", "msg": self._stored(msg)})
+
+    def claim(self, box_id: str, limit: int, now: int):
+        with self._lock:
+            rows = [m for m in self._queues.get(box_id, ()) if m["status"] in ("sent", "delivered")][:limit]
+            fresh = {m["msg_id"] for m in rows if m["status"] == "sent"}
+            if fresh:
+                self._write({"op": "deliver", "box": box_id, "ids": sorted(fresh), "at": now})
+            return [dict(m) for m in rows], fresh, self._versions.get(box_id, 0)
+
+    def claim_after(self, box_id: str, cursor: int, now: int):
+        with self._lock:
+            rows = [m for m in self._queues.get(box_id, ())
+                    if m["status"] in ("sent", "delivered") and m["cursor"] > cursor]
+            fresh = {m["msg_id"] for m in rows if m["status"] == "sent"}
+            if fresh:
+                self._write({"op": "deliver", "box": box_id, "ids": sorted(fresh), "at": now})
+            return [dict(m) for m in rows], fresh
+
+    def cursor_for(self, box_id: str, msg_id: str) -> int:
+        msg = self._index.get(msg_id)
+        return msg["cursor"] if msg and msg["to_box"] == box_id else 0
+
+    def ack(self, box_id: str, msg_ids: list, now: int):
+        with self._lock:
+            rows = [dict(self._index[m]) for m in msg_ids if m in self._index]
+            if not rows:
+                return []
+            if any(r["to_box"] != box_id for r in rows):
+                return None
+            self._write({"op": "ack", "box": box_id, "ids": [r["msg_id"] for r in rows], "at": now})
+            return rows
+
+    def get(self, msg_id: str):
+        msg = self._index.get(msg_id)
+        return dict(msg) if msg else None
+
+    def broadcast_rows(self, broadcast_id: str) -> list:
+        with self._lock:
+            return [dict(m) for m in self._index.values() if m.get("broadcast_id") == broadcast_id]
+
+    def counts(self, box_id: str) -> dict:
+        with self._lock:
+            q = self._queues.get(box_id, ())
+            pending = sum(1 for m in q if m["status"] in ("sent", "delivered"))
+            seen = sum(1 for m in q if m["status"] == "seen")
+            return {"total": len(q), "pending": pending, "seen": seen,
+                    "version": self._versions.get(box_id, 0)}
+
+    def prune(self, box_id: str) -> int:
+        with self._lock:
+            before = len(self._queues.get(box_id, ()))
+            if before > MAX_QUEUE:
+                self._write({"op": "prune", "box": box_id})
+            return before - len(self._queues.get(box_id, ()))
+
+    def depths(self) -> list:
+        with self._lock:
+            out = []
+            for box_id, q in self._queues.items():
+                pending = sum(1 for m in q if m["status"] in ("sent", "delivered"))
+                seen = sum(1 for m in q if m["status"] == "seen")
+                out.append((box_id, pending, seen))
+            return out
+
+    def release_due(self, box_id: str, now: int) -> list:
+        with self._lock:
+            due = sorted((m for m in self._queues.get(box_id, ())
+                          if m["status"] == "scheduled" and m["deliver_at"] <= now),
+                         key=lambda m: (m["deliver_at"], m["cursor"]))
+            if not due:
+                return []
+            ids = [[m["msg_id"], self._cursor + i] for i, m in enumerate(due, 1)]
+            self._write({"op": "release", "box": box_id, "ids": ids})
+            return [dict(self._index[msg_id]) for msg_id, _ in ids]
+
+    def due_times(self) -> list:
+        with self._lock:
+            due = {}
+            for msg in self._index.values():
+                if msg["status"] == "scheduled":
+                    due[msg["to_box"]] = min(due.get(msg["to_box"], msg["deliver_at"]), msg["deliver_at"])
+            return list(due.items())
+
+    # ---- persistence ----
+    def _paths(self):
+        return os.path.join(self.directory, "snapshot.json"), os.path.join(self.directory, "ops.log")
+
+    def _recover(self):
+        snap_path, log_path = self._paths()
+        if os.path.exists(snap_path):
+            with open(snap_path, "r", encoding="utf-8") as f:
+                snap = json.load(f)
+            for msg in snap["messages"]:
+                self._queues.setdefault(msg["to_box"], collections.deque()).append(msg)
+                self._index[msg["msg_id"]] = msg
+            self._versions = snap["versions"]
+            self._cursor = snap["cursor"]
+            self._seq = snap["seq"]
+        if os.path.exists(log_path):
+            with open(log_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        op = json.loads(line)
+                    except ValueError:
+                        break  # torn final write
+                    if op["seq"] > self._seq:
+                        self._apply(op)
+
+    def _flush_log(self):
+        with self._lock:
+            batch, self._log = self._log, []
+        if not batch:
+            return
+        _, log_path = self._paths()
+        with open(log_path, "a", encoding="utf-8") as f:
+            f.write("".join(json.dumps(op, separators=(",", ":")) + "\n" for op in batch))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _snapshot(self):
+        # Everything already in the log file is covered by this snapshot,
+        # so the log can start over; later ops are still queued in self._log.
+        self._flush_log()
+        with self._lock:
+            snap = {
+                "seq": self._seq,
+                "cursor": self._cursor,
+                "versions": dict(self._versions),
+                "messages": [dict(m) for q in self._queues.values() for m in q],
+            }
+        snap_path, log_path = self._paths()
+        with open(snap_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(snap, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(snap_path + ".tmp", snap_path)
+        open(log_path, "w").close()
+
+    def _persist_loop(self):
+        next_snapshot = time.monotonic() + MEMORY_SNAPSHOT
+        while True:
+            time.sleep(MEMORY_FLUSH)
+            try:
+                if time.monotonic() >= next_snapshot:
+                    self._snapshot()
+                    next_snapshot = time.monotonic() + MEMORY_SNAPSHOT
+                else:
+                    self._flush_log()
+            except OSError as e:
+                print("memory store persist failed:", repr(e))
+
+
+class ShardedStore(MessageStore):
+    """
+    Message queues spread over several SQLite files, each a SQLiteStore with
+    its own pools (and group-commit writer / read snapshot), so writers to
+    different shards never share a lock. A box's whole queue lives in the
+    shard its id hashes to; msg_ids start with their shard's byte, so a
+    lookup by id goes straight to one shard.
+    """
+
+    def __init__(self, paths: list):
+        self.shards = [SQLiteStore(p) for p in paths]
+
+    def shard_index(self, box_id: str) -> int:
+        return zlib.crc32(box_id.encode()) % len(self.shards)
+
+    def shard_for(self, box_id: str) -> SQLiteStore:
+        return self.shards[self.shard_index(box_id)]
+
+    def shard_of(self, msg_id: str):
+        """Shard a msg_id was created in, or None if it can't be one of ours."""
+        try:
+            i = int(msg_id[:2], 16)
+        except ValueError:
+            return None
+        return self.shards[i] if i < len(self.shards) else None
+
+    def init_schema(self):
+        for shard in self.shards:
+            with shard.pool.connection() as conn:
+                apply_schema(conn)
+
+    def new_msg_id(self, to_box: str) -> str:
+        return f"{self.shard_index(to_box):02x}{secrets.token_hex(7)}"
+
+    def create(self, msg: dict):
+        self.shard_for(msg["to_box"]).create(msg)
+
+    def create_many(self, msgs: list):
+        # One transaction per shard touched: shards are separate files.
+        by_shard = {}
+        for msg in msgs:
+            by_shard.setdefault(self.shard_index(msg["to_box"]), []).append(msg)
+        for i, batch in by_shard.items():
+            self.shards[i].create_many(batch)
+
+    def claim(self, box_id: str, limit: int, now: int):
+        return self.shard_for(box_id).claim(box_id, limit, now)
+
+    def claim_after(self, box_id: str, cursor: int, now: int):
+        return self.shard_for(box_id).claim_after(box_id, cursor, now)
+
+    def cursor_for(self, box_id: str, msg_id: str) -> int:
+        return self.shard_for(box_id).cursor_for(box_id, msg_id)
+
+    def ack(self, box_id: str, msg_ids: list, now: int):
+        shard = self.shard_for(box_id)
+        # Ids from another shard can't be this box's; if one exists there, it's someone else's.
+        for msg_id in msg_ids:
+            other = self.shard_of(msg_id)
+            if other is not None and other is not shard and other.get(msg_id):
+                return None
+        return shard.ack(box_id, msg_ids, now)
+
+    def get(self, msg_id: str):
+        shard = self.shard_of(msg_id)
+        return shard.get(msg_id) if shard else None
+
+    def peek(self, msg_id: str):
+        shard = self.shard_of(msg_id)
+        return shard.peek(msg_id) if shard else None
+
+    def broadcast_rows(self, broadcast_id: str) -> list:
+        return [r for shard in self.shards for r in shard.broadcast_rows(broadcast_id)]
+
+    def counts(self, box_id: str) -> dict:
+        return self.shard_for(box_id).counts(box_id)
+
+    def prune(self, box_id: str) -> int:
+        return self.shard_for(box_id).prune(box_id)
+
+    def release_due(self, box_id: str, now: int) -> list:
+        return self.shard_for(box_id).release_due(box_id, now)
+
+    def due_times(self) -> list:
+        return [d for shard in self.shards for d in shard.due_times()]
+
+    def depths(self) -> list:
+        return [d for shard in self.shards for d in shard.depths()]
+
+
+_store = None
+_store_pid = None
+_store_lock = threading.Lock()
+
+
+def get_store() -> MessageStore:
+    """The configured message store for this process (STORE=sqlite|memory, DB_SHARDS)."""
+    global _store, _store_pid
+    pid = os.getpid()
+    if _store is None or _store_pid != pid:
+        with _store_lock:
+            if _store is None or _store_pid != pid:
+                if STORE == "memory":
+                    _store = MemoryStore(MEMORY_STORE_DIR)
+                elif DB_SHARDS > 1:
+                    _store = ShardedStore(shard_paths())
+                else:
+                    _store = SQLiteStore(DB_PATH)
+                _store_pid = pid
+    return _store
+
+
+def queue_counts(to_box: str) -> dict:
+    """total / pending / seen / version for a box."""
+    return get_store().counts(to_box)
+
+
+def queue_version(to_box: str) -> int:
+    """Current queue version for a box, from memory when nothing has changed."""
+    seq = box_events.seq(to_box)
+    version = version_cache.get(to_box, seq)
+    if version is None:
+        version = queue_counts(to_box)["version"]
+        version_cache.put(to_box, version, seq)
+    return version
+
+
+def prune_queue(to_box: str) -> int:
+    """
+    Keep total messages for to_box <= MAX_QUEUE.
+    Delete oldest SEEN first, then oldest overall if needed.
+    create_message and acks already prune in their own transaction.
+    """
+    evicted = get_store().prune(to_box)
+    if evicted:
+        box_events.notify(to_box)
+    return evicted
+
+
+def deliver_time(raw, now: int):
+    """
+    A request's deliver_at -- Unix seconds, or ISO 8601 with a UTC offset
+    (e.g. 2026-02-14T08:00:00+01:00) -- as Unix seconds; None to send now
+    (missing, or not in the future). Raises ValueError if it can't be read
+    or is more than SCHEDULE_MAX_DAYS ahead.
+    """
+    if raw is None or raw == "":
+        return None
+    if isinstance(raw, bool):
+        raise ValueError(raw)
+    if isinstance(raw, (int, float)):
+        if not math.isfinite(raw):
+            raise ValueError("deliver_at must be finite")
+        at = int(raw)
+    elif str(raw).strip().isdigit():
+        at = int(str(raw).strip())
+    else:
+        when = datetime.fromisoformat(str(raw).strip())
+        if when.tzinfo is None:
+            raise ValueError("deliver_at needs a UTC offset")
+        at = int(when.timestamp())
+    if at > now + SCHEDULE_MAX_DAYS * 86400:
+        raise ValueError("deliver_at too far ahead")
+    return at if at > now else None
+
+
+def new_message(store: MessageStore, to_box: str, from_source: str, msg_type: str,
+                msg_text: str, msg_event: str, now: int, deliver_at: int = None) -> dict:
+    """Row for store.create(): 'sent' now, or 'scheduled' until deliver_at."""
+    return {
+        "msg_id": store.new_msg_id(to_box),
+        "to_box": to_box,
+        "from_source": from_source,
+        "msg_type": msg_type,
+        "msg_text": msg_text,
+        "msg_event": msg_event,
+        "status": "scheduled" if deliver_at else "sent",
+        "created_at": now,
+        "deliver_at": deliver_at or now,
+    }
+
+
+def create_message(to_box: str, from_source: str, msg_type: str, msg_text: str = None, msg_event: str = None,
+                   deliver_at: int = None):
+    store = get_store()
+    msg = new_message(store, to_box, from_source, msg_type, msg_text, msg_event, int(time.time()), deliver_at)
+    store.create(msg)
+
+    # A scheduled message wakes nobody until the scheduler releases it.
+    if deliver_at:
+        scheduler.add(to_box, deliver_at)
+    else:
+        box_events.notify(to_box)
+    return msg["msg_id"]
+
+
+def broadcast_targets(targets: list, group: str = "") -> list:
+    """
+    Registered, de-duplicated box ids for a broadcast: the listed targets
+    plus every box in group. Raises ValueError with the API error code.
+    """
+    wanted = list(dict.fromkeys(t for t in targets if t))
+    conn = db()
+    known = {r["box_id"] for r in conn.execute(
+        "SELECT box_id FROM devices WHERE box_id IN (SELECT value FROM json_each(?))",
+        (json.dumps(wanted),),
+    )}
+    if len(known) != len(wanted):
+        raise ValueError("unknown_target")
+    if group:
+        members = [r["box_id"] for r in conn.execute(
+            "SELECT box_id FROM devices WHERE group_id=? ORDER BY box_id", (group,),
+        )]
+        if not members:
+            raise ValueError("unknown_group")
+        wanted = list(dict.fromkeys(wanted + members))
+    if not wanted:
+        raise ValueError("missing_targets")
+    if len(wanted) > BROADCAST_MAX:
+        raise ValueError("too_many_targets")
+    return wanted
+
+
+def create_broadcast(targets: list, from_source: str, msg_type: str, msg_text: str = None, msg_event: str = None,
+                     deliver_at: int = None):
+    """
+    The same message to every box in targets, written in one transaction
+    (one per shard touched). Returns (broadcast_id, {box_id: msg_id}).
+    """
+    store = get_store()
+    broadcast_id = secrets.token_hex(8)
+    now = int(time.time())
+
+    msgs = [{**new_message(store, to_box, from_source, msg_type, msg_text, msg_event, now, deliver_at),
+             "broadcast_id": broadcast_id} for to_box in targets]
+    store.create_many(msgs)
+    metrics.observe("lovebox_broadcast_targets", len(msgs), (), BATCH_BUCKETS)
+
+    for msg in msgs:
+        if deliver_at:
+            scheduler.add(msg["to_box"], deliver_at)
+        else:
+            box_events.notify(msg["to_box"])
+    return broadcast_id, {m["to_box"]: m["msg_id"] for m in msgs}
+
+
+def broadcast_status(broadcast_id: str):
+    """Status counts across a broadcast plus each target's message, or None if nothing of it is left."""
+    rows = get_store().broadcast_rows(broadcast_id)
+    if not rows:
+        return None
+    counts = collections.Counter(r["status"] for r in rows)
+    return {
+        "ok": True,
+        "broadcast_id": broadcast_id,
+        "total": len(rows),
+        **{status: counts.get(status, 0) for status in ("scheduled", "sent", "delivered", "seen")},
+        "targets": {r["to_box"]: {"msg_id": r["msg_id"], "status": r["status"]}
+                    for r in sorted(rows, key=lambda r: r["to_box"])},
+    }
+
+
+# =========================
+# Scheduled messages
+# =========================
+class DueTimers(WorkerThreads):
+    """
+    Per-worker min-heap of (deliver_at, box_id) for scheduled messages. One
+    thread sleeps until the earliest entry is due, releases that box's due
+    messages to 'sent' and notifies its waiters -- long-polls and streams
+    wake exactly then, and no poll ever scans for ready rows. Every
+    SCHEDULE_RESCAN it reloads due times from the store, which picks up
+    messages scheduled by other workers or before a restart; releasing is
+    idempotent, so several workers holding the same entry is harmless.
+    """
+
+    def __init__(self, rescan: float):
+        super().__init__()
+        self.rescan = rescan
+        self._cond = threading.Condition()
+        self._heap = []
+        self._queued = set()
+
+    def _start(self):
+        threading.Thread(target=self._run, name="due-timers", daemon=True).start()
+
+    def add(self, box_id: str, at: int):
+        entry = (at, box_id)
+        with self._cond:
+            if entry in self._queued:
+                return
+            self._queued.add(entry)
+            heapq.heappush(self._heap, entry)
+            if self._heap[0] == entry:
+                self._cond.notify()
+
+    def _due(self, next_scan: float) -> list:
+        """Wait for the earliest entry (or the next rescan); pop and return the boxes now due."""
+        with self._cond:
+            while True:
+                now = time.time()
+                due = []
+                while self._heap and self._heap[0][0] <= now:
+                    entry = heapq.heappop(self._heap)
+                    self._queued.discard(entry)
+                    due.append(entry[1])
+                if due:
+                    return list(dict.fromkeys(due))
+                timeout = next_scan - time.monotonic()
+                if self._heap:
+                    timeout = min(timeout, self._heap[0][0] - now)
+                if timeout <= 0:
+                    return []
+                self._cond.wait(None if timeout == math.inf else timeout)
+
+    def _run(self):
+        next_scan = 0.0
+        while True:
+            try:
+                if time.monotonic() >= next_scan:
+                    for box_id, at in get_store().due_times():
+                        self.add(box_id, at)
+                    next_scan = time.monotonic() + self.rescan if self.rescan > 0 else math.inf
+                for box_id in self._due(next_scan):
+                    if get_store().release_due(box_id, int(time.time())):
+                        box_events.notify(box_id)
+            except Exception as e:
+                print("scheduler failed:", repr(e))
+                time.sleep(1)
+
+
+scheduler = DueTimers(SCHEDULE_RESCAN)
+
+
+@app.before_request
+def start_background():
+    """
+    Start this worker's background threads: the metrics flush, DB
+    maintenance, the scheduler and the notify bus. Runs before every
+    request; each starts once per process (asgi.py calls it at startup).
+    """
+    metrics.start()
+    maintenance.start()
+    scheduler.start()
+    if box_events.bus is not None:
+        box_events.bus.start()
+
+
+try:
+    with app.app_context():
+        init_db()
+except StoreInUse:
+    raise
+except Exception as e:
+    print("DB init failed:", repr(e))
+
+
+# =========================
+# Admission control
+# =========================
+class TokenBuckets:
+    """Per-worker token buckets by key: key -> (tokens, last refill time, time it is full again)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def take(self, key: str, rate: float, burst: float, now: float) -> float:
+        """Take one token. Returns 0 if granted, else seconds until one is available."""
+        with self._lock:
+            tokens, updated, _ = self._buckets.get(key, (burst, now, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            granted = tokens >= 1
+            if granted:
+                tokens -= 1
+            self._buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+            if len(self._buckets) > 10000:
+                # A bucket that has refilled to burst is the same as no bucket.
+                self._buckets = {k: v for k, v in self._buckets.items() if v[2] > now}
+            return 0.0 if granted else (1 - tokens) / rate
+
+
+class SQLiteTokenBuckets:
+    """
+    Token buckets in a SQLite table shared by every worker. Kept in their own
+    database file so throttling never queues behind the message writer.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._ready_pid = None
+
+    def _conn(self):
+        pool = get_pool(self.path)
+        if self._ready_pid != os.getpid():
+            with pool.connection() as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS rate_buckets ("
+                    " key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+                )
+                conn.commit()
+            self._ready_pid = os.getpid()
+        return pool.connection()
+
+    def take(self, key: str, rate: float, burst: float, now: float) -> float:
+        params = {"key": key, "rate": rate, "burst": burst, "now": now}
+        with self._conn() as conn:
+            granted = conn.execute(
+                """
+                INSERT INTO rate_buckets (key, tokens, updated) VALUES (:key, :burst - 1, :now)
+                ON CONFLICT(key) DO UPDATE SET
+                    tokens = MIN(:burst, tokens + (:now - updated) * :rate) - 1,
+                    updated = :now
+                WHERE MIN(:burst, tokens + (:now - updated) * :rate) >= 1
+                """,
+                params,
+            ).rowcount
+            conn.commit()
+            if granted:
+                return 0.0
+            row = conn.execute(
+                "SELECT MIN(:burst, tokens + (:now - updated) * :rate) FROM rate_buckets WHERE key = :key",
+                params,
+            ).fetchone()
+        return (1 - row[0]) / rate
+
+
+class WriteSlots:
+    """
+    A fixed number of write slots shared by every worker on the host: slot i
+    is an exclusive flock on file i in `directory`, held for one write. A
+    worker's threads first pass a local semaphore of the same size and each
+    tries only files no other thread of its process holds (flock would let
+    two threads sharing one open file both in).
+    """
+
+    def __init__(self, directory: str, size: int):
+        self.directory = directory
+        self.size = size
+        self._lock = threading.Lock()
+        self._local = None
+        self._files = {}
+        self._free = []
+        self._pid = None
+
+    def _local_slots(self) -> threading.BoundedSemaphore:
+        """This process's semaphore and slot files (a forked worker starts with its own)."""
+        with self._lock:
+            if self._pid != os.getpid():
+                os.makedirs(self.directory, exist_ok=True)
+                self._local = threading.BoundedSemaphore(self.size)
+                self._files = {i: open(os.path.join(self.directory, str(i)), "a") for i in range(self.size)}
+                self._free = list(range(self.size))
+                self._pid = os.getpid()
+            return self._local
+
+    def acquire(self, timeout: float):
+        """A held slot, or None if none frees up within timeout."""
+        deadline = time.monotonic() + timeout
+        local = self._local_slots()
+        if not local.acquire(timeout=timeout):
+            return None
+        delay = 0.001
+        while True:
+            with self._lock:
+                for slot in list(self._free):
+                    try:
+                        fcntl.flock(self._files[slot], fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except OSError:
+                        continue
+                    self._free.remove(slot)
+                    return slot
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                local.release()
+                return None
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.02)
+
+    def release(self, slot):
+        with self._lock:
+            fcntl.flock(self._files[slot], fcntl.LOCK_UN)
+            self._free.append(slot)
+        self._local.release()
+
+
+class LocalSlots:
+    """WriteSlots for one worker only (no flock on this platform)."""
+
+    def __init__(self, size: int):
+        self._sem = threading.BoundedSemaphore(size)
+
+    def acquire(self, timeout: float):
+        return True if self._sem.acquire(timeout=timeout) else None
+
+    def release(self, slot):
+        self._sem.release()
+
+
+rate_buckets = SQLiteTokenBuckets(RATE_LIMIT_DB) if RATE_LIMIT_STORE == "sqlite" else TokenBuckets()
+if GROUP_COMMIT and STORE == "sqlite":
+    write_gate = None
+elif fcntl is None:
+    write_gate = LocalSlots(max(1, WRITE_CONCURRENCY))
+else:
+    write_gate = WriteSlots(WRITE_SLOTS_DIR, max(1, WRITE_CONCURRENCY))
+
+
+def rate_limit(scope: str, key: str) -> int:
+    """
+    Take a token from the `scope` ("box" or "web") bucket for key. Returns 0
+    if the write may go ahead, else the Retry-After in whole seconds.
+    """
+    rate, burst = (BOX_RATE, BOX_BURST) if scope == "box" else (WEB_RATE, WEB_BURST)
+    if rate <= 0:
+        return 0
+    wait = rate_buckets.take(f"{scope}:{key}", rate, max(1.0, burst), time.time())
+    if not wait:
+        return 0
+    metrics.inc("lovebox_throttled_total", (("scope", scope), ("reason", "rate")))
+    return max(1, math.ceil(wait))
+
+
+def admit_write(fn, *args, **kwargs):
+    """fn(*args, **kwargs) once a write slot is free. None if none frees up within WRITE_WAIT."""
+    if write_gate is None:
+        return fn(*args, **kwargs)
+    slot = write_gate.acquire(WRITE_WAIT)
+    if slot is None:
+        metrics.inc("lovebox_throttled_total", (("scope", "write"), ("reason", "busy")))
+        return None
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        write_gate.release(slot)
+
+
+def try_create_message(*args, **kwargs):
+    """create_message through the write gate; None if busy."""
+    return admit_write(create_message, *args, **kwargs)
+
+
+class RequestError(Exception):
+    """
+    A refused device API request: status, JSON error body and extra headers.
+    Raised by the helpers the Flask and ASGI routes share; request_error (and
+    asgi.serve_api) turn it into the response.
+    """
+
+    def __init__(self, status: int, error: str, headers: dict = None, **fields):
+        super().__init__(error)
+        self.status = status
+        self.body = {"ok": False, "error": error, **fields}
+        self.headers = headers or {}
+
+
+@app.errorhandler(RequestError)
+def request_error(e):
+    return jsonify(e.body), e.status, e.headers
+
+
+def throttled(retry_after: int) -> RequestError:
+    return RequestError(429, "rate_limited", {"Retry-After": str(retry_after)}, retry_after=retry_after)
+
+
+def busy() -> RequestError:
+    return RequestError(503, "busy", {"Retry-After": "1"})
+
+
+def web_sid() -> str:
+    """Per-login id for the web rate limit (older sessions get one on first send)."""
+    if "sid" not in session:
+        session["sid"] = secrets.token_hex(8)
+    return session["sid"]
+
+
+# =========================
+# Page templates
+# =========================
+TEMPLATE_SOURCES = {
+    "login": LOGIN_HTML,
+    "send": SEND_HTML,
+}
+
+_templates = {}
+# (registry version, {name: rendered}) -- swapped whole when the registry changes.
+_page_cache = (None, {})
+
+
+def page_template(name: str):
+    """Compiled Jinja template for a page, built once per worker."""
+    tmpl = _templates.get(name)
+    if tmpl is None:
+        tmpl = _templates[name] = app.jinja_env.from_string(TEMPLATE_SOURCES[name])
+    return tmpl
+
+
+def page_cache() -> dict:
+    """Rendered pages and options for the current device registry (pages embed the target list)."""
+    global _page_cache
+    version = registry_version()
+    if _page_cache[0] != version:
+        _page_cache = (version, {})
+    return _page_cache[1]
+
+
+def group_boxes(group: str) -> list:
+    """
+    box_ids in a pairing group ("" = ungrouped), at most BROADCAST_MAX, for
+    the send page's target pickers. One idx_devices_group range per group,
+    cached per registry version.
+    """
+    cache = page_cache()
+    key = ("boxes", group)
+    boxes = cache.get(key)
+    if boxes is None:
+        rows = db().execute(
+            "SELECT box_id FROM devices WHERE group_id IS ? ORDER BY box_id LIMIT ?",
+            (group or None, BROADCAST_MAX),
+        )
+        boxes = cache[key] = [r["box_id"] for r in rows]
+    return boxes
+
+
+def group_options() -> Markup:
+    """<option> list of pairing groups for the send page's datalist, rendered once per registry version."""
+    cache = page_cache()
+    opts = cache.get("group_options")
+    if opts is None:
+        rows = db().execute("SELECT DISTINCT group_id FROM devices WHERE group_id IS NOT NULL ORDER BY group_id")
+        opts = cache["group_options"] = Markup("\n".join(
+            f'<option value="{escape(r["group_id"])}">{escape(r["group_id"])}</option>' for r in rows
+        ))
+    return opts
+
+
+def render_page(name: str, **ctx) -> str:
+    if name == "send":
+        ctx.setdefault("group_options", group_options())
+    return render_template(page_template(name), **ctx)
+
+
+def static_page(name: str):
+    """
+    GET response for a page with no per-request state. The body is rendered
+    once and served with an ETag/Last-Modified, so revalidation is a 304.
+    """
+    cache = page_cache()
+    cached = cache.get(name)
+    if cached is None:
+        body = render_page(name).encode("utf-8")
+        etag = hashlib.sha1(body).hexdigest()[:20]
+        cached = cache[name] = (body, etag, int(time.time()))
+
+    body, etag, rendered_at = cached
+    resp = Response(body, mimetype="text/html")
+    resp.set_etag(etag)
+    resp.last_modified = rendered_at
+    resp.cache_control.private = True
+    resp.cache_control.no_cache = True
+    return resp.make_conditional(request)
+
+
+def compile_templates():
+    for name in TEMPLATE_SOURCES:
+        page_template(name)
+
+
+compile_templates()
+
+
+# =========================
+# Web UI (session protected)
+# =========================
+@app.get("/")
+def root():
+    if session.get("logged_in"):
+        return redirect(url_for("send_page"))
+    return redirect(url_for("login_page"))
+
+
+@app.get("/login")
+def login_page():
+    return static_page("login")
+
+
+@app.post("/login")
+def login_post():
+    pwd = request.form.get("password", "")
+    if pwd == WEB_PASSWORD:
+        session["logged_in"] = True
+        session["sid"] = secrets.token_hex(8)
+        return redirect(url_for("send_page"))
+    return render_page("login", error="Wrong password")
+
+
+@app.get("/send")
+def send_page():
+    if not session.get("logged_in"):
+        return redirect(url_for("login_page"))
+    return static_page("send")
+
+
+@app.post("/send")
+def send_post():
+    if not session.get("logged_in"):
+        return redirect(url_for("login_page"))
+
+    target = request.form.get("target", "")
+    text = (request.form.get("text", "") or "").strip()
+    event = (request.form.get("event", "") or "").strip()
+
+    if not target or not get_device(target):
+        return render_page("send", status_text="Invalid target")
+
+    try:
+        deliver_at = deliver_time(request.form.get("deliver_at"), int(time.time()))
+    except ValueError:
+        return render_page("send", status_text="Invalid delivery time")
+
+    if event:
+        if event not in ("heartbeat", "rainbow", "breathe", "ping"):
+            return render_page("send", status_text="Invalid event")
+    elif not text:
+        return render_page("send", status_text="Type a message first")
+
+    retry_after = rate_limit("web", web_sid())
+    if retry_after:
+        return render_page("send", status_text=f"Slow down, try again in {retry_after}s"), 429, {"Retry-After": str(retry_after)}
+
+    if event:
+        msg_id = try_create_message(target, "web", "event", msg_event=event, deliver_at=deliver_at)
+    else:
+        msg_id = try_create_message(target, "web", "text", msg_text=text, deliver_at=deliver_at)
+    if msg_id is None:
+        return render_page("send", status_text="Busy, try again"), 503, {"Retry-After": "1"}
+    return render_page("send", msg_id=msg_id, status_text="SCHEDULED" if deliver_at else "SENT")
+
+
+@app.post("/broadcast")
+def broadcast_post():
+    """
+    One message or event to many boxes: "targets" (box ids) and/or "group".
+    The send page posts a form and gets the page back; JSON callers get the
+    broadcast_id and each target's msg_id. The whole broadcast takes one
+    rate-limit token and one write slot.
+    """
+    as_json = request.is_json
+    if not session.get("logged_in"):
+        if as_json:
+            abort(401)
+        return redirect(url_for("login_page"))
+
+    if as_json:
+        data = request.get_json(silent=True) or {}
+        targets = data.get("targets") or []
+        if not isinstance(targets, list) or not all(isinstance(t, str) for t in targets):
+            return jsonify({"ok": False, "error": "bad_targets"}), 400
+        group = str(data.get("group") or "")
+        text = str(data.get("text") or "").strip()
+        event = str(data.get("event") or "").strip()
+        deliver_at = data.get("deliver_at")
+    else:
+        targets = request.form.getlist("targets")
+        group = request.form.get("group", "")
+        text = (request.form.get("text", "") or "").strip()
+        event = (request.form.get("event", "") or "").strip()
+        deliver_at = request.form.get("deliver_at")
+
+    def refuse(error: str, status_text: str, code: int = 400, headers: dict = None):
+        if as_json:
+            return jsonify({"ok": False, "error": error}), code, headers or {}
+        # Like /send, the page answers bad input with 200 and only throttling with an error status.
+        return render_page("send", broadcast_text=status_text), (200 if code == 400 else code), headers or {}
+
+    try:
+        targets = broadcast_targets(targets, group)
+    except ValueError as e:
+        return refuse(str(e), "Pick a group or some boxes" if str(e) == "missing_targets" else "Invalid targets")
+
+    try:
+        deliver_at = deliver_time(deliver_at, int(time.time()))
+    except ValueError:
+        return refuse("bad_deliver_at", "Invalid delivery time")
+
+    if event:
+        if event not in DEVICE_EVENTS:
+            return refuse("bad_event", "Invalid event")
+    elif not text:
+        return refuse("missing_text", "Type a message first")
+
+    retry_after = rate_limit("web", web_sid())
+    if retry_after:
+        return refuse("rate_limited", f"Slow down, try again in {retry_after}s", 429, {"Retry-After": str(retry_after)})
+
+    if event:
+        sent = admit_write(create_broadcast, targets, "web", "event", msg_event=event, deliver_at=deliver_at)
+    else:
+        sent = admit_write(create_broadcast, targets, "web", "text", msg_text=text, deliver_at=deliver_at)
+    if sent is None:
+        return refuse("busy", "Busy, try again", 503, {"Retry-After": "1"})
+
+    broadcast_id, msg_ids = sent
+    if as_json:
+        return jsonify({"ok": True, "broadcast_id": broadcast_id, "msg_ids": msg_ids, "deliver_at": deliver_at})
+    verb = "SCHEDULED FOR" if deliver_at else "SENT TO"
+    return render_page("send", broadcast_id=broadcast_id, broadcast_text=f"{verb} {len(msg_ids)}")
+
+
+def broadcast_event(payload: dict) -> str:
+    """A broadcast's counts as an SSE status event (the per-target map stays out: it can be BROADCAST_MAX long)."""
+    counts = {k: v for k, v in payload.items() if k != "targets"}
+    return f"event: status\ndata: {json.dumps(counts, separators=(',', ':'))}\n\n"
+
+
+@app.get("/boxes")
+def web_boxes():
+    """Targets in one pairing group (?group=, empty for ungrouped), loaded by the send page on demand."""
+    if not session.get("logged_in"):
+        abort(401)
+    group = request.args.get("group", "")
+    return jsonify({"ok": True, "group": group, "boxes": group_boxes(group)})
+
+
+@app.get("/status")
+def web_status():
+    if not session.get("logged_in"):
+        abort(401)
+
+    if request.args.get("stream"):
+        return sse_response(status_feed(request.args), stream_lifetime(STATUS_STREAM_MAX))
+
+    broadcast_id = request.args.get("broadcast_id", "")
+    if broadcast_id:
+        payload = broadcast_status(broadcast_id)
+        if payload is None:
+            return jsonify({"ok": False, "error": "not_found"}), 404
+        return jsonify(payload)
+
+    msg_id = request.args.get("msg_id", "")
+    if not msg_id:
+        return jsonify({"ok": False, "error": "missing_msg_id"}), 400
+
+    # Polls may read the READ_SNAPSHOT copy; streams (status_feed) follow live changes.
+    row = get_store().peek(msg_id)
+    if not row:
+        return jsonify({"ok": False, "error": "not_found"}), 404
+    return jsonify(status_payload(row))
+
+
+def status_payload(row) -> dict:
+    return {
+        "ok": True,
+        "status": row["status"],
+        "created_at": row["created_at"],
+        "deliver_at": queued_at(row),
+        "delivered_at": row["delivered_at"],
+        "seen_at": row["seen_at"],
+    }
+
+
+def stream_lifetime(limit: float) -> float:
+    """
+    How long a stream opened by this request may run: limit, or SYNC_STREAM_MAX
+    on a single-threaded worker, which a longer stream would hold past its timeout.
+    """
+    if request.environ.get("wsgi.multithread"):
+        return limit
+    return min(limit, SYNC_STREAM_MAX)
+
+
+STATUS_GONE = 'event: gone\ndata: {"ok":false,"error":"not_found"}\n\n'
+
+
+def status_event(row) -> str:
+    return f"event: status\ndata: {json.dumps(status_payload(row), separators=(',', ':'))}\n\n"
+
+
+SSE_PING = ": heartbeat\n\n"
+
+
+class StreamFeed:
+    """
+    What an SSE stream sends, apart from how it waits. `boxes` are the boxes
+    whose notifier wakes it; step() reads the store once (blocking) and
+    returns (events, done). sse_response runs a feed on the request thread,
+    asgi.sse_reply on the event loop.
+    """
+
+    boxes = ()
+
+    def step(self) -> tuple:
+        raise NotImplementedError
+
+
+class StatusFeed(StreamFeed):
+    """One message's status: an event per change (sent -> delivered -> seen), done once seen or gone."""
+
+    def __init__(self, msg_id: str, to_box: str):
+        self.msg_id = msg_id
+        self.boxes = (to_box,)
+        self.last = None
+
+    def step(self) -> tuple:
+        row = get_store().get(self.msg_id)
+        if not row:
+            return [STATUS_GONE], True
+        events = []
+        if row["status"] != self.last:
+            self.last = row["status"]
+            events.append(status_event(row))
+        return events, self.last == "seen"
+
+
+class BroadcastFeed(StreamFeed):
+    """A broadcast's counts: an event whenever they change, done once every target has seen it or the rows are gone."""
+
+    def __init__(self, broadcast_id: str, boxes: list):
+        self.broadcast_id = broadcast_id
+        self.boxes = boxes
+        self.last = None
+
+    def step(self) -> tuple:
+        payload = broadcast_status(self.broadcast_id)
+        if payload is None:
+            return [STATUS_GONE], True
+        events = []
+        event = broadcast_event(payload)
+        if event != self.last:
+            self.last = event
+            events.append(event)
+        return events, payload["seen"] == payload["total"]
+
+
+def status_feed(args) -> StreamFeed:
+    """The feed a /status?stream=1 request follows (?broadcast_id= or ?msg_id=). RequestError if there is none."""
+    broadcast_id = args.get("broadcast_id", "")
+    if broadcast_id:
+        payload = broadcast_status(broadcast_id)
+        if payload is None:
+            raise RequestError(404, "not_found")
+        return BroadcastFeed(broadcast_id, list(payload["targets"]))
+
+    msg_id = args.get("msg_id", "")
+    if not msg_id:
+        raise RequestError(400, "missing_msg_id")
+    row = get_store().get(msg_id)
+    if not row:
+        raise RequestError(404, "not_found")
+    return StatusFeed(msg_id, row["to_box"])
+
+
+def sse_response(feed: StreamFeed, lifetime: float):
+    """
+    Stream a feed: a step, then park on its boxes' notifiers until one of
+    them changes (a heartbeat every SSE_HEARTBEAT of quiet), until the feed
+    is done or `lifetime` runs out. Nothing is polled while nothing changes.
+    """
+
+    def generate():
+        deadline = time.monotonic() + lifetime
+        yield f"retry: {SSE_RETRY_MS}\n\n"
+
+        while True:
+            seqs = {box_id: box_events.seq(box_id) for box_id in feed.boxes}
+            events, done = feed.step()
+            yield from events
+            remaining = deadline - time.monotonic()
+            if done or remaining <= 0:
+                return
+            if not box_events.wait_any(seqs, min(SSE_HEARTBEAT, remaining)):
+                yield SSE_PING
+
+    return Response(
+        generate(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# =========================
+# API for Love Boxes
+# =========================
+@app.post("/api/register")
+def api_register():
+    data = request.get_json(force=True, silent=True) or {}
+    box_id = data.get("box_id", "")
+    token = data.get("token", "")
+    info = auth_box(box_id, token)
+    if not info:
+        return jsonify({"ok": False, "error": "auth_failed"}), 401
+    return jsonify({"ok": True, "paired_to": info["paired_to"]})
+
+
+@app.get("/api/pending_count")
+def api_pending_count():
+    box_id = request.args.get("box_id", "")
+    token = request.args.get("token", "")
+    info = auth_box(box_id, token)
+    if not info:
+        return jsonify({"ok": False, "error": "auth_failed"}), 401
+
+    version = queue_version(box_id)
+    if client_has_version(version):
+        return not_modified(version)
+
+    counts = queue_counts(box_id)
+    return versioned({"ok": True, "count": counts["pending"]}, counts["version"])
+
+
+def claim_pending(box_id: str, limit: int = 1):
+    """
+    Up to `limit` oldest pending messages for box_id, marked delivered, as one
+    atomic claim. Returns (rows in deliver_at order, queue version after the
+    claim); rows is empty if the queue is empty.
+    """
+    now = int(time.time())
+    rows, fresh, version = get_store().claim(box_id, limit, now)
+    if fresh:
+        for r in rows:
+            if r["msg_id"] in fresh:
+                observe_delivery("created_to_delivered", now - queued_at(r))
+        box_events.notify(box_id)
+    return rows, version
+
+
+def message_fields(row) -> dict:
+    return {
+        "msg_id": row["msg_id"],
+        "type": row["msg_type"],
+        "text": row["msg_text"],
+        "event": row["msg_event"],
+        "status": row["status"],
+        "created_at": row["created_at"],
+        "delivered_at": row["delivered_at"],
+        "seen_at": row["seen_at"],
+    }
+
+
+def message_payload(row) -> dict:
+    """Device-facing JSON for one message row (shared by /api/check and /api/stream)."""
+    return {"ok": True, "has": True, **message_fields(row)}
+
+
+def client_has_version(version: int) -> bool:
+    """True if the device says it already has this queue version (If-None-Match or ?since_version=)."""
+    return (str(version) in request.if_none_match
+            or request.args.get("since_version") == str(version))
+
+
+def not_modified(version: int):
+    resp = Response(status=304)
+    resp.set_etag(str(version))
+    return resp
+
+
+def versioned(payload: dict, version: int):
+    resp = jsonify({**payload, "version": version})
+    resp.set_etag(str(version))
+    return resp
+
+
+def batch_limit(raw) -> int:
+    """Parse a ?max= value, clamped to [1, MAX_BATCH]. ValueError if it is not an integer."""
+    return max(1, min(int(raw), MAX_BATCH))
+
+
+def check_limit(raw, binary: bool = False) -> int:
+    """How many messages a check claims: 1 without ?max=, else batch_limit (at most 255 for the binary wire format's u8 count)."""
+    if raw is None:
+        return 1
+    try:
+        limit = batch_limit(raw)
+    except ValueError:
+        raise RequestError(400, "bad_max")
+    return min(limit, 255) if binary else limit
+
+
+def check_payload(rows: list, batched: bool) -> dict:
+    """/api/check body for the claimed rows (the queue version is added by the caller)."""
+    if batched:
+        return {
+            "ok": True,
+            "has": bool(rows),
+            "count": len(rows),
+            "messages": [message_fields(r) for r in rows],
+        }
+    if not rows:
+        return {"ok": True, "has": False}
+    return message_payload(rows[0])
+
+
+def wait_seconds(raw) -> float:
+    """Parse a ?wait= value, clamped to [0, LONGPOLL_MAX_WAIT]. Garbage means no wait."""
+    try:
+        wait = float(raw or 0)
+    except ValueError:
+        return 0.0
+    if wait != wait:  # NaN
+        return 0.0
+    return max(0.0, min(wait, LONGPOLL_MAX_WAIT))
+
+
+def poll_queue(box_id: str, limit: int, wait: float, has_version):
+    """
+    The /api/check loop: claim up to `limit` pending messages, parking up to
+    `wait` seconds for one to arrive. has_version(version) is asked before
+    every claim; if the device already has that queue version the claim is
+    skipped. Returns (rows, version), rows None when the device is current.
+    """
+    deadline = time.monotonic() + wait
+    while True:
+        seq = box_events.seq(box_id)
+        version = queue_version(box_id)
+        if has_version(version):
+            # Same queue the device already saw, so the same answer: skip the claim.
+            rows = None
+        else:
+            rows, version = claim_pending(box_id, limit)
+        remaining = deadline - time.monotonic()
+        if rows or remaining <= 0:
+            return rows, version
+        # Hand the connection back while parked; create_message wakes us directly.
+        release_db()
+        box_events.wait(box_id, seq, remaining)
+
+
+@app.get("/api/check")
+def api_check():
+    box_id = request.args.get("box_id", "")
+    token = request.args.get("token", "")
+    info = auth_box(box_id, token)
+    if not info:
+        return jsonify({"ok": False, "error": "auth_failed"}), 401
+
+    batch = request.args.get("max")
+    limit = check_limit(batch)
+    rows, version = poll_queue(box_id, limit, wait_seconds(request.args.get("wait")), client_has_version)
+    if rows is None:
+        return not_modified(version)
+    return versioned(check_payload(rows, batch is not None), version)
+
+
+def stream_cursor(box_id: str, last_event_id: str) -> int:
+    """Store cursor to resume after. Unknown/pruned ids restart from the whole pending queue."""
+    return get_store().cursor_for(box_id, last_event_id) if last_event_id else 0
+
+
+def claim_after(box_id: str, cursor: int) -> list:
+    """Pending messages for box_id past cursor, in order, marked delivered."""
+    now = int(time.time())
+    rows, fresh = get_store().claim_after(box_id, cursor, now)
+    if fresh:
+        for r in rows:
+            if r["msg_id"] in fresh:
+                observe_delivery("created_to_delivered", now - queued_at(r))
+        box_events.notify(box_id)
+    return rows
+
+
+def message_event(row) -> str:
+    data = json.dumps(message_payload(row), separators=(",", ":"))
+    return f"id: {row['msg_id']}\nevent: message\ndata: {data}\n\n"
+
+
+class MessageFeed(StreamFeed):
+    """/api/stream: a box's pending messages past the resume point, claimed as they arrive. Never done."""
+
+    def __init__(self, box_id: str, last_event_id: str):
+        self.box_id = box_id
+        self.boxes = (box_id,)
+        self.last_event_id = last_event_id
+        self.cursor = None
+
+    def step(self) -> tuple:
+        if self.cursor is None:
+            self.cursor = stream_cursor(self.box_id, self.last_event_id)
+        events = []
+        for row in claim_after(self.box_id, self.cursor):
+            self.cursor = row["cursor"]
+            events.append(message_event(row))
+        return events, False
+
+
+@app.get("/api/stream")
+def api_stream():
+    box_id = request.args.get("box_id", "")
+    token = request.args.get("token", "")
+    info = auth_box(box_id, token)
+    if not info:
+        return jsonify({"ok": False, "error": "auth_failed"}), 401
+
+    last_event_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id", "")
+    return sse_response(MessageFeed(box_id, last_event_id), stream_lifetime(math.inf))
+
+
+def ack_targets(data: dict):
+    """
+    (bulk, msg_ids) named by an /api/ack body: msg_ids (a list, deduplicated)
+    or the single msg_id. RequestError if msg_ids is malformed.
+    """
+    msg_ids = data.get("msg_ids")
+    if msg_ids is None:
+        return False, [data.get("msg_id", "")]
+    if (not isinstance(msg_ids, list) or len(msg_ids) > MAX_BATCH
+            or not all(isinstance(m, str) for m in msg_ids)):
+        raise RequestError(400, "bad_msg_ids", max=MAX_BATCH)
+    return True, list(dict.fromkeys(msg_ids))
+
+
+def ack_messages(box_id: str, msg_ids: list):
+    """Mark msg_ids seen for box_id. Returns how many were acked; RequestError if one belongs to another box."""
+    now = int(time.time())
+    rows = get_store().ack(box_id, msg_ids, now)
+    if rows is None:
+        raise RequestError(403, "wrong_box")
+    if not rows:
+        return 0
+
+    for row in rows:
+        if row["status"] != "seen":
+            observe_delivery("created_to_seen", now - queued_at(row))
+            if row["delivered_at"] is not None:
+                observe_delivery("delivered_to_seen", now - row["delivered_at"])
+    box_events.notify(box_id)
+    return len(rows)
+
+
+@app.post("/api/ack")
+def api_ack():
+    data = request.get_json(force=True, silent=True) or {}
+    box_id = data.get("box_id", "")
+    token = data.get("token", "")
+
+    info = auth_box(box_id, token)
+    if not info:
+        return jsonify({"ok": False, "error": "auth_failed"}), 401
+
+    bulk, msg_ids = ack_targets(data)
+    acked = ack_messages(box_id, msg_ids)
+    return jsonify({"ok": True, "acked": acked}) if bulk else jsonify({"ok": True})
+
+
+DEVICE_EVENTS = ("heartbeat", "rainbow", "breathe", "ping")
+
+
+def send_device_event(info: dict, data: dict) -> dict:
+    """
+    /api/send_event after auth: check the event and deliver_at, take a rate
+    token and queue the event for the paired box. Returns the response body;
+    RequestError if refused.
+    """
+    event = (data.get("event", "") or "").strip()
+    if event not in DEVICE_EVENTS:
+        raise RequestError(400, "bad_event", allowed=list(DEVICE_EVENTS))
+
+    try:
+        deliver_at = deliver_time(data.get("deliver_at"), int(time.time()))
+    except ValueError:
+        raise RequestError(400, "bad_deliver_at")
+
+    retry_after = rate_limit("box", info["box_id"])
+    if retry_after:
+        raise throttled(retry_after)
+
+    target = info["paired_to"]
+    msg_id = try_create_message(target, "device", "event", msg_event=event, deliver_at=deliver_at)
+    if msg_id is None:
+        raise busy()
+    return {"ok": True, "sent_to": target, "msg_id": msg_id, "deliver_at": deliver_at}
+
+
+@app.post("/api/send_event")
+def api_send_event():
+    data = request.get_json(force=True, silent=True) or {}
+    info = auth_box(data.get("box_id", ""), data.get("token", ""))
+    if not info:
+        return jsonify({"ok": False, "error": "auth_failed"}), 401
+    return jsonify(send_device_event(info, data))
+
+
+# =========================
+# Device API v2 (compact wire format)
+# =========================
+# For boxes that would rather not parse JSON. Auth and long-poll/version
+# parameters are the v1 query string; the body format is negotiated with
+# Accept (responses) / Content-Type (ack bodies):
+#
+#   application/x-lovebox   binary, big-endian
+#     check: u8 format, u8 count, u32 queue version, then per message:
+#            u8 status, 8 bytes msg_id, u8 type, u16 length, payload (UTF-8)
+#            ("no message" is those first 6 bytes)
+#     ack:   request u8 format, u8 count, count * 8 bytes msg_id
+#            response u8 format, u8 acked
+#   application/json        the same fields as fixed-position arrays
+#     check: [version, [[status, msg_id, type, payload], ...]]
+#     ack:   request [msg_id, ...], response [acked]
+#
+# payload is the text for text messages and the event name for events.
+# Errors keep the v1 status codes and JSON error bodies.
+WIRE_MIMETYPE = "application/x-lovebox"
+WIRE_FORMAT = 1
+WIRE_TYPES = {"text": 1, "event": 2}
+WIRE_STATUSES = {"sent": 0, "delivered": 1, "seen": 2}
+WIRE_HEADER = struct.Struct(">BBI")
+
+
+def wire_binary(accept: str) -> bool:
+    """
+    True if an Accept header asks for the binary format: it must name
+    application/x-lovebox itself with q > 0, at least as high as JSON's.
+    Wildcards (*/*, application/*) and a missing header get JSON.
+    """
+    parsed = parse_accept_header(accept, MIMEAccept)
+    binary_q = max((q for value, q in parsed if value.lower() == WIRE_MIMETYPE), default=0)
+    return binary_q > 0 and binary_q >= parsed.quality("application/json")
+
+
+class WireCache:
+    """
+    Encoded (binary, JSON) forms of messages by msg_id, least recently used
+    evicted past `size`. Everything encoded here is fixed at creation; the
+    status, which changes, is written per response.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def get(self, row) -> tuple:
+        msg_id = row["msg_id"]
+        with self._lock:
+            entry = self._entries.get(msg_id)
+            if entry is not None:
+                self._entries.move_to_end(msg_id)
+                return entry
+        entry = encode_message(row)
+        with self._lock:
+            self._entries[msg_id] = entry
+            if len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return entry
+
+
+def encode_message(row) -> tuple:
+    """(binary, JSON) encodings of a message's fixed fields; the JSON one is the array body after status."""
+    msg_type = WIRE_TYPES.get(row["msg_type"], 0)
+    payload = (row["msg_text"] if row["msg_type"] == "text" else row["msg_event"]) or ""
+    data = payload.encode()[:0xFFFF].decode(errors="ignore").encode()
+    binary = bytes.fromhex(row["msg_id"]) + struct.pack(">BH", msg_type, len(data)) + data
+    text = json.dumps([row["msg_id"], msg_type, data.decode()], separators=(",", ":"))[1:-1]
+    return binary, text
+
+
+wire_cache = WireCache(WIRE_CACHE_SIZE)
+
+
+def encode_check(rows: list, version: int, binary: bool) -> bytes:
+    """v2 check body for the claimed rows."""
+    if binary:
+        out = [WIRE_HEADER.pack(WIRE_FORMAT, len(rows), version & 0xFFFFFFFF)]
+        for r in rows:
+            out.append(bytes((WIRE_STATUSES.get(r["status"], 0),)))
+            out.append(wire_cache.get(r)[0])
+        return b"".join(out)
+    messages = ",".join(f"[{WIRE_STATUSES.get(r['status'], 0)},{wire_cache.get(r)[1]}]" for r in rows)
+    return f"[{version},[{messages}]]".encode()
+
+
+def decode_ack(body: bytes, binary: bool) -> list:
+    """msg_ids (hex, deduplicated) from a v2 ack body. RequestError if malformed or over MAX_BATCH."""
+    if binary:
+        ok = len(body) >= 2 and body[0] == WIRE_FORMAT and len(body) == 2 + 8 * body[1]
+        msg_ids = [body[i:i + 8].hex() for i in range(2, len(body), 8)] if ok else None
+    else:
+        try:
+            msg_ids = json.loads(body)
+        except ValueError:
+            msg_ids = None
+        ok = isinstance(msg_ids, list) and all(isinstance(m, str) for m in msg_ids)
+    if not ok or len(msg_ids) > MAX_BATCH:
+        raise RequestError(400, "bad_msg_ids", max=MAX_BATCH)
+    return list(dict.fromkeys(msg_ids))
+
+
+def encode_acked(acked: int, binary: bool) -> bytes:
+    return bytes((WIRE_FORMAT, acked)) if binary else f"[{acked}]".encode()
+
+
+def wire_response(body: bytes, binary: bool, status: int = 200):
+    resp = Response(body, status=status, mimetype=WIRE_MIMETYPE if binary else "application/json")
+    resp.vary.add("Accept")
+    return resp
+
+
+@app.get("/api/v2/check")
+def api_v2_check():
+    box_id = request.args.get("box_id", "")
+    token = request.args.get("token", "")
+    info = auth_box(box_id, token)
+    if not info:
+        return jsonify({"ok": False, "error": "auth_failed"}), 401
+
+    binary = wire_binary(request.headers.get("Accept"))
+    limit = check_limit(request.args.get("max"), binary)
+    rows, version = poll_queue(box_id, limit, wait_seconds(request.args.get("wait")), client_has_version)
+    if rows is None:
+        resp = not_modified(version)
+        resp.vary.add("Accept")
+        return resp
+
+    resp = wire_response(encode_check(rows, version, binary), binary)
+    resp.set_etag(str(version))
+    return resp
+
+
+@app.post("/api/v2/ack")
+def api_v2_ack():
+    box_id = request.args.get("box_id", "")
+    token = request.args.get("token", "")
+    info = auth_box(box_id, token)
+    if not info:
+        return jsonify({"ok": False, "error": "auth_failed"}), 401
+
+    msg_ids = decode_ack(request.get_data(), request.mimetype == WIRE_MIMETYPE)
+    acked = ack_messages(box_id, msg_ids)
+    binary = wire_binary(request.headers.get("Accept"))
+    return wire_response(encode_acked(acked, binary), binary)
+
+
+@app.get("/health")
+def health():
+    return jsonify({"ok": True})
+
+
+@app.get("/metrics")
+def metrics_endpoint():
+    if METRICS_TOKEN:
+        supplied = request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+        if not hmac.compare_digest(supplied.encode(), METRICS_TOKEN.encode()):
+            abort(401)
+
+    # Queue depth comes straight from the store (box_counters for SQLite), which every worker shares.
+    depth = []
+    for box_id, pending, seen in get_store().depths():
+        depth.append(([["box", box_id], ["state", "pending"]], pending))
+        depth.append(([["box", box_id], ["state", "seen"]], seen))
+
+    body = render_metrics(metrics.collect(), [
+        ("lovebox_queue_depth", "gauge", depth),
+        ("lovebox_sqlite_wal_bytes", "gauge",
+         [([["db", os.path.basename(p)]], maintenance.wal_bytes(p)) for p in maintenance.paths]),
+    ])
+    return Response(body, mimetype="text/plain; version=0.0.4")
+
+
+# =========================
+# CLI
+# =========================
+@app.cli.command("provision")
+@click.argument("csv_file", type=click.File("r"), required=False)
+@click.option("--pairs", type=int, default=0, help="Create this many new pairs instead of reading a CSV.")
+@click.option("--prefix", default="box", help="box_id prefix for created pairs.")
+def provision_command(csv_file, pairs, prefix):
+    """
+    Bulk-register devices.
+
+    \b
+      flask --app server provision devices.csv   # rows of box_id,token,paired_to[,group_id]
+      flask --app server provision --pairs 500   # new pairs, credentials printed as CSV
+    """
+    devices = []
+    if pairs:
+        for _ in range(pairs):
+            group = secrets.token_hex(4)
+            a, b = f"{prefix}_{group}_a", f"{prefix}_{group}_b"
+            devices.append((a, secrets.token_urlsafe(16), b, f"pair_{group}"))
+            devices.append((b, secrets.token_urlsafe(16), a, f"pair_{group}"))
+    elif csv_file is not None:
+        for n, row in enumerate(csv.DictReader(csv_file), start=2):
+            box_id, token, paired_to = (row.get(k, "").strip() for k in ("box_id", "token", "paired_to"))
+            if not (box_id and token and paired_to):
+                raise click.ClickException(f"line {n}: box_id, token and paired_to are required")
+            devices.append((box_id, token, paired_to, (row.get("group_id") or "").strip() or None))
+    else:
+        raise click.UsageError("give a CSV file or --pairs N")
+
+    for i in range(0, len(devices), 1000):
+        register_devices(devices[i:i + 1000])
+
+    if pairs:
+        out = csv.writer(click.get_text_stream("stdout"))
+        out.writerow(["box_id", "token", "paired_to", "group_id"])
+        out.writerows(devices)
+    click.echo(f"registered {len(devices)} devices", err=True)
+
+
+if __name__ == "__main__":
+    app.run(host="0.0.0.0", port=5000, debug=True)
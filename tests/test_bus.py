@@ -0,0 +1,101 @@
+"""
+BrokerBus against LocalBroker: two workers' buses sharing one in-process
+broker, both replaying into this process's box_events.
+
+    python -m unittest discover tests     # or: python -m pytest tests
+"""
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+# server.py sets itself up at import: a throwaway database, no bus of its own.
+os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(), "lovebox.db")
+os.environ["NOTIFY_BUS"] = "off"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import BrokerBus, LocalBroker, box_events
+
+COALESCE = 0.2  # seconds
+GAP = 0.01      # seconds between the publishes of a burst, well inside COALESCE
+SETTLE = 0.5    # seconds to let stray or duplicate events arrive
+
+
+class RecordingBus(BrokerBus):
+    """A BrokerBus that also remembers every batch it delivered."""
+
+    def __init__(self, broker):
+        super().__init__(broker, COALESCE)
+        self.delivered = []
+
+    def _deliver(self, box_ids):
+        self.delivered.append(list(box_ids))
+        super()._deliver(box_ids)
+
+
+class CountingBroker(LocalBroker):
+    """A LocalBroker that counts what is published on it."""
+
+    def __init__(self):
+        super().__init__()
+        self.published = []
+
+    def publish(self, channel: str, data):
+        self.published.append(data)
+        super().publish(channel, data)
+
+
+class BrokerBusTest(unittest.TestCase):
+    def setUp(self):
+        self.broker = CountingBroker()
+        self.sender = RecordingBus(self.broker)
+        self.peer = RecordingBus(self.broker)
+        self.sender.start()
+        self.peer.start()
+        time.sleep(SETTLE)  # both listeners subscribed
+
+    def box(self) -> str:
+        return f"{self.id()}-{time.monotonic_ns()}"
+
+    def test_publish_reaches_peer_not_sender(self):
+        box = self.box()
+        seq = box_events.seq(box)
+        self.sender.publish(box)
+
+        self.assertTrue(box_events.wait(box, seq, 2.0))
+        time.sleep(SETTLE)
+        self.assertEqual(self.peer.delivered, [[box]])
+        self.assertEqual(self.sender.delivered, [])
+        self.assertEqual(box_events.seq(box), seq + 1)
+
+    def test_burst_is_coalesced(self):
+        box = self.box()
+        seq = box_events.seq(box)
+        for _ in range(10):
+            self.sender.publish(box)
+            time.sleep(GAP)
+
+        self.assertTrue(box_events.wait(box, seq, 2.0))
+        time.sleep(SETTLE)
+        self.assertEqual(len(self.broker.published), 1)
+        self.assertEqual(self.peer.delivered, [[box]])
+        self.assertEqual(box_events.seq(box), seq + 1)
+
+    def test_burst_over_several_boxes_is_one_event(self):
+        boxes = [self.box() for _ in range(3)]
+        seqs = {box: box_events.seq(box) for box in boxes}
+        for _ in range(5):
+            for box in boxes:
+                self.sender.publish(box)
+                time.sleep(GAP)
+
+        self.assertTrue(box_events.wait_any(seqs, 2.0))
+        time.sleep(SETTLE)
+        self.assertEqual(len(self.broker.published), 1)
+        self.assertEqual([sorted(batch) for batch in self.peer.delivered], [sorted(boxes)])
+        self.assertEqual({box: box_events.seq(box) for box in boxes}, {box: seq + 1 for box, seq in seqs.items()})
+
+
+if __name__ == "__main__":
+    unittest.main()